@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/3.1/ref/settings/
 from datetime import timedelta
 import os
 from pathlib import Path
+import dj_database_url
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent.parent
@@ -56,6 +57,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.db_router.ReplicaStickinessMiddleware',
 ]
 
 INTERNAL_IPS = [
@@ -95,6 +97,19 @@ WSGI_APPLICATION = 'OrderService.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
+# Workers keep their database connections for DATABASE_CONN_MAX_AGE seconds, 0 opens one per request.
+# Settings modules merge CONNECTION_SETTINGS into their DATABASES, see api.db_connections for the health
+# checks. Set DATABASE_POOLER=pgbouncer when the database hosts are a transaction pooling pgbouncer,
+# it cannot keep server side cursors across transactions
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 600))
+DATABASE_HEALTH_CHECK_IDLE = 30
+DATABASE_POOLER = os.environ.get('DATABASE_POOLER', '')
+CONNECTION_SETTINGS = {
+    'ENGINE': 'api.postgresql',
+    'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+    'DISABLE_SERVER_SIDE_CURSORS': DATABASE_POOLER == 'pgbouncer',
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -137,9 +152,92 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# Cache lifetime of media names hashed from their content, they never change
+MEDIA_MAX_AGE = 60 * 60 * 24 * 365
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Read replicas from DATABASE_REPLICA_URLS, comma separated database URLs. Settings modules add
+# REPLICA_DATABASES to their DATABASES. Views listing actions in replica_actions read from them,
+# a client that wrote something reads from the primary for REPLICA_STICKINESS seconds after
+REPLICA_DATABASES = {
+    f'replica_{number}': dict(dj_database_url.parse(url), **CONNECTION_SETTINGS, TEST={'MIRROR': 'default'})
+    for number, url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')), 1)
+}
+DATABASE_ROUTERS = ['api.db_router.ReplicaRouter']
+REPLICA_STICKINESS = 10
+
+# Compiled product tariffs are cached under Product.updated_at, which moves with every change of the
+# product or its intervals, so no process reads a stale one even from a local cache. The rendered catalogue
+# and the required product graph are cached under versions kept in the database (api.versions). With
+# REDIS_URL the `default` cache is shared by all processes.
+PRICING_CACHE_TIMEOUT = 60 * 60
+# Lines a single getPrices request may quote, they are all checked for bookings in one query
+MAX_QUOTE_ITEMS = 100
+CATALOGUE_CACHE_TIMEOUT = 60 * 60
+
+# Carts are kept in the `carts` cache and expire CART_TTL seconds after their last change,
+# the cache must be shared by all workers. Without REDIS_URL they stay in the Cart tables instead.
+CART_STORE = 'api.cart_store.DatabaseCartStore'
+CART_CACHE = 'carts'
+CART_TTL = 60 * 60 * 24 * 3
+
+if os.environ.get('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+        'carts': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['REDIS_URL'],
+        },
+    }
+    CART_STORE = 'api.cart_store.CacheCartStore'
+
+# Orders waiting for their code hold their dates for UNVERIFIED_ORDER_TTL seconds.
+# `manage.py expire_stale` deletes carts kept in the tables after CART_TTL and fails
+# orders whose hold ran out, run it periodically
+UNVERIFIED_ORDER_TTL = 60 * 60
+CLEANUP_BATCH_SIZE = 500
+
+# Text messages are queued in the database and sent by `manage.py sms_worker`
+SMS_GATEWAY = 'api.sms.SmsAeroGateway'
+SMS_BATCH_SIZE = 50
+SMS_MAX_ATTEMPTS = 5
+SMS_RETRY_DELAY = 30
+# Seconds to wait for the gateway. Other workers skip the messages of a batch until every
+# group of it could have taken that long
+SMS_TIMEOUT = 10
+
+# Uploaded product photos are stored as is and converted by `manage.py process_images`,
+# IMAGE_WORKERS processes at a time. Besides the JPEG image and thumbnail each photo gets
+# WebP copies of these widths, never wider than the original
+IMAGE_WORKERS = 2
+IMAGE_BATCH_SIZE = 8
+# Seconds a worker may take for a batch before other workers convert its uploads again
+IMAGE_CLAIM_TIMEOUT = 10 * 60
+IMAGE_VARIANT_WIDTHS = [320, 640, 1280]
+
+# Files no row refers to anymore are queued and removed from the storage by `manage.py delete_files`
+FILE_DELETION_BATCH_SIZE = 100
+FILE_DELETION_MAX_ATTEMPTS = 5
+FILE_DELETION_RETRY_DELAY = 30
+
+# Photos can be uploaded straight to the storage: `presign` hands out forms valid for UPLOAD_URL_TTL
+# seconds and `confirm` accepts their ids for UPLOAD_CONFIRM_TTL. Unless UPLOAD_BACKEND names one,
+# forms post to the bucket of an S3 default storage and to the API itself with any other storage
+UPLOAD_BACKEND = None
+UPLOAD_URL_TTL = 15 * 60
+UPLOAD_CONFIRM_TTL = 60 * 60 * 24
+UPLOAD_MAX_SIZE = 20 * 1024 * 1024
+
+# Expo publishes push receipts some time after the tickets, `manage.py check_push_receipts`
+# only looks at tickets older than this many seconds. Tickets still without a receipt after
+# PUSH_RECEIPTS_MAX_AGE seconds are dropped, Expo keeps receipts for a day
+PUSH_RECEIPTS_DELAY = 60 * 15
+PUSH_RECEIPTS_MAX_AGE = 60 * 60 * 24
+
 REST_FRAMEWORK = {
     'COERCE_DECIMAL_TO_STRING': False,
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -2,6 +2,19 @@ from .common import *
 
 DEBUG = True
 
+SMS_GATEWAY = 'api.sms.FakeGateway'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'carts': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'carts',
+    },
+}
+CART_STORE = 'api.cart_store.CacheCartStore'
+
 SECRET_KEY = 'c_-0n*cl_fk066!yj#mmph68fc4il%p!=c58qp6j()u870$a=1'
 
 DATABASES = {
@@ -11,5 +24,7 @@ DATABASES = {
         'USER': 'Test',
         'PASSWORD': 'test',
         'HOST': 'localhost',
-    }
+        **CONNECTION_SETTINGS,
+    },
+    **REPLICA_DATABASES,
 }
\ No newline at end of file
@@ -15,10 +15,12 @@ Including another URLconf
 """
 from django.conf import settings
 from django.contrib import admin
-from django.conf.urls.static import static
-from django.urls import path, include
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.urls import path, re_path, include
 import debug_toolbar
 
+from api import media
+
 admin.site.site_header = 'Order Service Admin'
 admin.site.index_title = 'Admin'
 
@@ -28,4 +30,8 @@ urlpatterns = [
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.jwt')),
     path('__debug__/', include(debug_toolbar.urls)),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
+
+# Remote storages serve their own urls
+if settings.DEBUG or isinstance(default_storage, FileSystemStorage):
+    urlpatterns.append(re_path(rf'^{settings.MEDIA_URL.lstrip("/")}(?P<path>.+)$', media.serve))
@@ -45,6 +45,11 @@ class CartItemAdmin(admin.ModelAdmin):
 class ProductSpecialIntervalAdmin(admin.ModelAdmin):
     list_display = ['product', 'is_weekends', 'start_datetime', 'end_datetime', 'additional_price_per_unit']
 
+@admin.register(models.SmsMessage)
+class SmsMessageAdmin(admin.ModelAdmin):
+    list_display = ['phone', 'status', 'attempts', 'created_at', 'sent_at']
+    list_filter = ['status']
+
 @admin.register(models.UserPushNotificationToken)
 class UserPushNotificationTokenAdmin(admin.ModelAdmin):
     list_display = ['user', 'push_token']
\ No newline at end of file
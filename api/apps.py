@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from . import db_connections, files, images, signals
+        files.track_file_fields(extra_references=[images.referenced_variant_names])
@@ -0,0 +1,154 @@
+""" Per product calendar of busy buckets, kept up to date from order items so calendar reads never scan OrderItem.
+
+Hourly products are bucketed by hour. Daily products are bucketed by day, a day bucket covers
+the night from check-in to check-out for products using hotel booking time and the whole day otherwise.
+Unverified orders aren't counted as bookings, a bucket they hold stays busy until the latest of their holds expires.
+"""
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.holds import active_order_items
+from api.models import AvailabilitySlot, Order, Product
+from api.pricing import condition_constructor, getStartEnd
+
+BOOKING_FIELDS = ['start_datetime', 'end_datetime',
+                  'order_status', 'hold_expires_at']
+
+
+def bucket_step(product):
+    return timedelta(hours=1) if product.time_unit == Product.TIME_UNIT_HOUR else timedelta(days=1)
+
+
+def floor_bucket(product, moment):
+    if product.time_unit == Product.TIME_UNIT_HOUR:
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_window(product, bucket):
+    step = bucket_step(product)
+    if product.time_unit == Product.TIME_UNIT_DAY and product.use_hotel_booking_time:
+        start, end, _ = getStartEnd(bucket, bucket + step, True)
+        return start, end
+    return bucket, bucket + step
+
+
+def buckets_between(product, start, end):
+    """ Buckets whose windows overlap start - end, in order """
+    step = bucket_step(product)
+    bucket = floor_bucket(product, start) - step
+    buckets = []
+    while bucket < end:
+        window_start, window_end = bucket_window(product, bucket)
+        if window_start < end and window_end > start:
+            buckets.append(bucket)
+        bucket += step
+    return buckets
+
+
+def _count_bookings(product, buckets, bookings):
+    """ {bucket: (bookings, held_until)} from (start, end, order status, hold expiry) rows """
+    first_start = bucket_window(product, buckets[0])[0]
+    last_end = bucket_window(product, buckets[-1])[1]
+    slots = {}
+    for start, end, status, hold_expires_at in bookings:
+        for bucket in buckets_between(product, max(start, first_start), min(end, last_end)):
+            count, held_until = slots.get(bucket, (0, None))
+            if status != Order.PAYMENT_STATUS_WAITING:
+                count += 1
+            elif held_until is None or hold_expires_at > held_until:
+                held_until = hold_expires_at
+            slots[bucket] = (count, held_until)
+    return slots
+
+
+def _slot(product, bucket, counted):
+    count, held_until = counted
+    return AvailabilitySlot(product=product, bucket=bucket, bookings=count, held_until=held_until)
+
+
+def _lock_products(product_ids):
+    # Serialize recounts of the same product so concurrent refreshes don't interleave
+    list(Product.objects.select_for_update().filter(
+        pk__in=product_ids).order_by('pk').values_list('pk', flat=True))
+
+
+def _replace_slots(product, slots, **bucket_range):
+    AvailabilitySlot.objects.filter(product=product, **bucket_range).delete()
+    AvailabilitySlot.objects.bulk_create(
+        [_slot(product, bucket, counted) for bucket, counted in slots.items()])
+
+
+def refresh_spans(spans):
+    """ Recount the buckets overlapping each (product, start, end) span, with the same few queries however many spans there are """
+    windows = {}
+    for product, start, end in spans:
+        buckets = buckets_between(product, start, end)
+        if buckets:
+            windows[product.pk] = (product, buckets, bucket_window(product, buckets[0])[0],
+                                   bucket_window(product, buckets[-1])[1])
+    if not windows:
+        return
+
+    bookings_condition = Q()
+    slots_condition = Q()
+    for product_id, (product, buckets, window_start, window_end) in windows.items():
+        bookings_condition |= Q(product_id=product_id) & condition_constructor(
+            window_start, window_end)
+        slots_condition |= Q(product_id=product_id, bucket__gte=buckets[0],
+                             bucket__lte=buckets[-1])
+
+    with transaction.atomic():
+        _lock_products(list(windows))
+        bookings = {product_id: [] for product_id in windows}
+        for product_id, *booking in active_order_items().filter(bookings_condition).values_list('product_id', *BOOKING_FIELDS):
+            bookings[product_id].append(booking)
+
+        AvailabilitySlot.objects.filter(slots_condition).delete()
+        AvailabilitySlot.objects.bulk_create([_slot(product, bucket, counted)
+                                              for product_id, (product, buckets, _, _) in windows.items()
+                                              for bucket, counted in _count_bookings(product, buckets, bookings[product_id]).items()])
+
+
+def refresh(product, start, end):
+    """ Recount the buckets overlapping start - end from the order items booked on them """
+    refresh_spans([(product, start, end)])
+
+
+def refresh_items(items):
+    """ Refresh the calendar once per product for the whole span of the given order items """
+    spans = {}
+    for item in items:
+        product, start, end = spans.get(
+            item.product_id, (item.product, item.start_datetime, item.end_datetime))
+        spans[item.product_id] = (product, min(start, item.start_datetime), max(
+            end, item.end_datetime))
+
+    refresh_spans(spans.values())
+
+
+def rebuild(product):
+    """ Recount the whole calendar of a product, used after its bucketing changed """
+    with transaction.atomic():
+        _lock_products([product.pk])
+        bookings = list(active_order_items().filter(
+            product=product).values_list(*BOOKING_FIELDS))
+        slots = {}
+        if bookings:
+            buckets = buckets_between(product, min(booking[0] for booking in bookings),
+                                      max(booking[1] for booking in bookings))
+            slots = _count_bookings(product, buckets, bookings)
+        _replace_slots(product, slots)
+
+
+def bitmap(product, start, end):
+    """ '1' for every busy bucket and '0' for every free one between start and end """
+    buckets = buckets_between(product, start, end)
+    if not buckets:
+        return [], ''
+
+    busy = set(AvailabilitySlot.objects.filter(product=product, bucket__gte=buckets[0], bucket__lte=buckets[-1]).filter(
+        Q(bookings__gt=0) | Q(held_until__gt=timezone.now())).values_list('bucket', flat=True))
+    return buckets, ''.join('1' if bucket in busy else '0' for bucket in buckets)
@@ -0,0 +1,370 @@
+""" Seeds a realistic data set and measures every API route: database queries, wall time and response size.
+
+Used by the `benchmark_api` command and by the query budget test. Every case runs in a transaction that is
+rolled back afterwards, so cases don't see each other's writes and the order they run in doesn't matter.
+"""
+import json
+import time
+from datetime import datetime, time as daytime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlparse
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext, override_settings
+from PIL import Image
+from rest_framework.test import APIClient
+
+from api import availability, uploads
+from api.cart_store import CacheCartStore, get_store
+from api.models import CartItem, Order, OrderItem, Product, ProductFile, ProductSpecialInterval, UserPushNotificationToken
+from api.pricing import get_tariffs, getStartEnd
+
+BASELINE_PATH = Path(__file__).resolve().parent / 'benchmark_baseline.json'
+
+PHONE = '+79990000000'
+CODE = '1234'
+
+
+def at(year, month, day, hour=0):
+    return datetime(year, month, day, hour, tzinfo=timezone.utc)
+
+
+def iso(moment):
+    return moment.isoformat().replace('+00:00', 'Z')
+
+
+def seed(products=200, orders=2000, carts=50):
+    """ Products in groups of four: three daily houses and an hourly add-on requiring the house before it """
+    # Tariffs and graphs cached for rows of an earlier, rolled back seed would be served for the new ones
+    cache.clear()
+    admin = User.objects.create_superuser(
+        'benchmark', 'benchmark@example.com', 'benchmark')
+    UserPushNotificationToken.objects.create(
+        user=admin, push_token='ExponentPushToken[benchmark]')
+
+    created_products = []
+    for index in range(products):
+        hourly = index % 4 == 3
+        created_products.append(Product(
+            title=f'Product {index}', unit_price=1000 + index, min_unit=1, max_unit=12 if hourly else 30,
+            time_unit=Product.TIME_UNIT_HOUR if hourly else Product.TIME_UNIT_DAY,
+            min_hour=daytime(8) if hourly else None, max_hour=daytime(23) if hourly else None,
+            use_hotel_booking_time=not hourly, max_persons=None if hourly else 4,
+            description='Seeded for benchmarks'))
+    created_products = Product.objects.bulk_create(created_products)
+    for index, product in enumerate(created_products):
+        if index % 4 == 3:
+            product.required_product = created_products[index - 1]
+    Product.objects.bulk_update(created_products, ['required_product'])
+    orphan = Product.objects.create(title='Orphan', unit_price=1, min_unit=1, max_unit=30,
+                                    time_unit=Product.TIME_UNIT_DAY, use_hotel_booking_time=True)
+
+    intervals = []
+    files = []
+    for product in created_products:
+        intervals.append(ProductSpecialInterval(
+            product=product, is_weekends=True, additional_price_per_unit=300))
+        intervals.append(ProductSpecialInterval(product=product, start_datetime=at(2031, 6, 1), end_datetime=at(2031, 6, 15),
+                                                is_weekends=False, additional_price_per_unit=500))
+        files += [ProductFile(product=product, file=f'files/benchmark-{product.pk}-{number}.jpg',
+                              file_thumbnail=f'files/thumbnails/benchmark-{product.pk}-{number}.jpg', is_primary=number == 0) for number in range(3)]
+    ProductSpecialInterval.objects.bulk_create(intervals)
+    ProductFile.objects.bulk_create(files)
+
+    statuses = [Order.PAYMENT_STATUS_WAITING, Order.PAYMENT_STATUS_PENDING,
+                Order.PAYMENT_STATUS_COMPLETE, Order.PAYMENT_STATUS_FAILED]
+    created_orders = Order.objects.bulk_create([Order(
+        phone=PHONE, name=f'Guest {index}', status=statuses[index % 4], code=CODE, attempts_left=3, resends_left=3,
+        persons=2, ip_address='127.0.0.1') for index in range(orders)])
+
+    # Each order books a house and the product after it, so every fourth order also has an add-on
+    cursors = {product.pk: at(2020, 1, 1) for product in created_products}
+    items = []
+    for index, order in enumerate(created_orders):
+        first = (index * 2) % products
+        for product in created_products[first:first + 2]:
+            cursor = cursors[product.pk]
+            if product.time_unit == Product.TIME_UNIT_HOUR:
+                start, end = cursor.replace(hour=10), cursor.replace(hour=12)
+                cursors[product.pk] = cursor + timedelta(days=1)
+            else:
+                start, end = cursor.replace(
+                    hour=14), (cursor + timedelta(days=2)).replace(hour=12)
+                cursors[product.pk] = cursor + timedelta(days=3)
+            items.append(OrderItem(order=order, product=product, start_datetime=start, end_datetime=end,
+                                   quantity=1, total_price=product.unit_price, order_status=order.status,
+                                   hold_expires_at=order.hold_expires_at))
+    OrderItem.objects.bulk_create(items)
+    availability.refresh_items(items)
+
+    tariffs = get_tariffs(created_products)
+    store = get_store()
+
+    def cart_item(product, start, end):
+        start, end, fixed_end = getStartEnd(
+            start, end, product.use_hotel_booking_time)
+        return CartItem(product=product, start_datetime=start, end_datetime=end, quantity=1,
+                        price=tariffs[product.pk].calculate(start, end, fixed_end, 1, ''))
+
+    created_carts = []
+    for index in range(carts):
+        cart = store.create(persons=2)
+        house = created_products[(index * 4 + 2) % products]
+        addon = created_products[(index * 4 + 3) % products]
+        day = at(2030, 3, 1) + timedelta(days=index * 5)
+        store.save_items(cart, [cart_item(house, day, day + timedelta(days=2)),
+                                cart_item(addon, day.replace(hour=15), day.replace(hour=17))])
+        created_carts.append(cart)
+
+    # The add-on is booked a day after its house, as when the house dates were changed afterwards
+    affected_cart = store.create(persons=2)
+    day = at(2030, 1, 10)
+    addon_day = day + timedelta(days=3)
+    store.save_items(affected_cart, [cart_item(created_products[2], day, day + timedelta(days=2)),
+                                     cart_item(created_products[3], addon_day.replace(hour=15), addon_day.replace(hour=17))])
+    created_carts.append(affected_cart)
+
+    waiting_order = next(
+        order for order in created_orders if order.status == Order.PAYMENT_STATUS_WAITING)
+    addon_order = next(order for index, order in enumerate(created_orders)
+                       if order.status == Order.PAYMENT_STATUS_PENDING and ((index * 2) % products) % 4 == 2)
+    house = created_products[2]
+    house_files = list(ProductFile.objects.filter(
+        product=house).order_by('pk'))
+    dated_interval = ProductSpecialInterval.objects.get(
+        product=house, is_weekends=False)
+
+    return {
+        'admin': admin,
+        'house': house,
+        'addon': created_products[3],
+        'other_house': created_products[0],
+        'orphan': orphan,
+        'files': house_files,
+        'interval': dated_interval,
+        'waiting_order': waiting_order,
+        'order': addon_order,
+        'order_item': addon_order.items.order_by('pk').first(),
+        'cart': created_carts[0],
+        'cart_items': created_carts[0].cart_items,
+        'checkout_cart': created_carts[1],
+        'affected_cart': affected_cart,
+        'carts': created_carts,
+    }
+
+
+def image_upload():
+    content = BytesIO()
+    Image.new('RGB', (800, 600), 'green').save(content, 'JPEG')
+    return SimpleUploadedFile('benchmark.jpg', content.getvalue(), content_type='image/jpeg')
+
+
+def issue_uploads(product, count):
+    """ Upload ids and form urls handed out by the presign route, through LocalUploadBackend like in development """
+    request = RequestFactory().post('/')
+    with override_settings(UPLOAD_BACKEND='api.uploads.LocalUploadBackend'):
+        issued = [uploads.issue(product.pk, 'photo.jpg', 'image/jpeg', request) for _ in range(count)]
+    return [(upload['upload_id'], urlparse(upload['url']).path) for upload in issued]
+
+
+def cases(data):
+    """ (name, method, path, body, as_admin, format) for every route registered in api/urls.py, the photos to
+    confirm are put in the storage here """
+    house = data['house'].pk
+    addon = data['addon'].pk
+    order = data['order'].pk
+    waiting = data['waiting_order'].pk
+    cart = data['cart'].pk
+    window = {'start_datetime': '2031-02-02T10:00:00Z',
+              'end_datetime': '2031-02-05T10:00:00Z', 'quantity': 1}
+    product_fields = {'title': 'Benchmark', 'unit_price': 1500, 'min_unit': 1, 'max_unit': 30, 'time_unit': 'D',
+                      'use_hotel_booking_time': True, 'is_available': True, 'max_persons': 4}
+    interval_fields = {'start_datetime': '2032-01-01T00:00:00Z', 'end_datetime': '2032-01-10T00:00:00Z',
+                       'is_weekends': False, 'additional_price_per_unit': 100}
+    issued = issue_uploads(data['house'], 11)
+    upload_ids = [upload_id for upload_id, _ in issued[:10]]
+    for key in uploads.confirmed_keys(house, upload_ids):
+        default_storage.save(key, image_upload())
+    upload_path = issued[10][1]
+
+    return [
+        ('products-list', 'get', '/api/products/', None, False, None),
+        ('products-detail', 'get', f'/api/products/{house}/', None, False, None),
+        ('products-create', 'post', '/api/products/',
+         product_fields, True, 'json'),
+        ('products-update', 'put', f'/api/products/{house}/',
+         product_fields, True, 'json'),
+        ('products-delete', 'delete',
+         f'/api/products/{data["orphan"].pk}/', None, True, None),
+        ('products-catalogue', 'get', '/api/products/catalogue/', None, False, None),
+        ('products-getPrice', 'post', f'/api/products/{house}/getPrice/',
+         {**window, 'exclude_order_item_id': None}, False, 'json'),
+        ('products-getPrices', 'post', '/api/products/getPrices/', {'items': [
+            {'product_id': product_id, **window} for product_id in range(house, house + 20)]}, False, 'json'),
+        ('products-timeView', 'post', f'/api/products/{house}/timeView/',
+         {'current_datetime': '2020-01-01T00:00:00Z', 'exclude_order_item_id': None}, False, 'json'),
+        ('products-availability', 'post', f'/api/products/{house}/availability/',
+         {'start_datetime': '2020-01-01T00:00:00Z', 'end_datetime': '2020-03-01T00:00:00Z'}, False, 'json'),
+        ('intervals-list', 'get',
+         f'/api/products/{house}/intervals/', None, False, None),
+        ('intervals-detail', 'get',
+         f'/api/products/{house}/intervals/{data["interval"].pk}/', None, False, None),
+        ('intervals-create', 'post',
+         f'/api/products/{house}/intervals/', interval_fields, True, 'json'),
+        ('intervals-update', 'put', f'/api/products/{house}/intervals/{data["interval"].pk}/',
+         interval_fields, True, 'json'),
+        ('intervals-deleteIds', 'post', f'/api/products/{house}/intervals/deleteIds/',
+         {'intervals_ids': [data['interval'].pk]}, True, 'json'),
+        ('files-list', 'get', f'/api/products/{house}/files/', None, True, None),
+        ('files-detail', 'get',
+         f'/api/products/{house}/files/{data["files"][0].pk}/', None, True, None),
+        ('files-create', 'post', f'/api/products/{house}/files/',
+         {'files': [image_upload()]}, True, 'multipart'),
+        ('files-makePrimary', 'post', f'/api/products/{house}/files/makePrimary/',
+         {'id': data['files'][1].pk}, True, 'json'),
+        ('files-deleteIds', 'post', f'/api/products/{house}/files/deleteIds/',
+         {'files_ids': [data['files'][2].pk]}, True, 'json'),
+        ('files-presign', 'post', f'/api/products/{house}/files/presign/',
+         {'files': [{'name': 'photo.jpg', 'content_type': 'image/jpeg'}] * 10}, True, 'json'),
+        ('files-confirm', 'post', f'/api/products/{house}/files/confirm/',
+         {'upload_ids': upload_ids}, True, 'json'),
+        ('local-upload', 'post', upload_path,
+         {'file': image_upload()}, False, 'multipart'),
+        ('orders-list', 'get', '/api/orders/', None, True, None),
+        ('orders-detail', 'get', f'/api/orders/{order}/', None, True, None),
+        ('orders-create', 'post', '/api/orders/', {'cart_id': str(data['checkout_cart'].pk),
+         'phone': PHONE, 'name': 'guest', 'agreement': True}, False, 'json'),
+        ('orders-partial-update', 'patch',
+         f'/api/orders/{order}/', {'name': 'Benchmark'}, True, 'json'),
+        ('orders-verify_order', 'post', f'/api/orders/{waiting}/verify_order/',
+         {'code': CODE, 'phone': PHONE}, False, 'json'),
+        ('orders-get_new_code', 'post',
+         f'/api/orders/{waiting}/get_new_code/', {'phone': PHONE}, False, 'json'),
+        ('orders-get_order', 'post', f'/api/orders/{order}/get_order/',
+         {'code': CODE, 'phone': PHONE}, False, 'json'),
+        ('order-items-list', 'get', '/api/order-items/', None, True, None),
+        ('order-items-detail', 'get',
+         f'/api/order-items/{data["order_item"].pk}/', None, True, None),
+        ('order-items-nested-list', 'get',
+         f'/api/orders/{order}/items/', None, True, None),
+        ('order-items-nested-detail', 'get',
+         f'/api/orders/{order}/items/{data["order_item"].pk}/', None, True, None),
+        ('order-items-nested-create', 'post', f'/api/orders/{order}/items/',
+         {'product': data['other_house'].pk, **window}, True, 'json'),
+        ('order-items-nested-update', 'put', f'/api/orders/{order}/items/{data["order_item"].pk}/',
+         {'product': house, **window}, True, 'json'),
+        ('order-items-get_allowed_interval', 'post',
+         f'/api/orders/{order}/items/get_allowed_interval/', {'product_id': addon}, True, 'json'),
+        ('order-items-check_affected', 'get',
+         f'/api/orders/{order}/items/check_affected/', None, True, None),
+        ('order-items-deleteIds', 'post', f'/api/orders/{order}/items/deleteIds/',
+         {'order_item_ids': [data['order_item'].pk]}, True, 'json'),
+        ('push-tokens-list', 'get', '/api/push-tokens/', None, True, None),
+        ('push-tokens-create', 'post', '/api/push-tokens/',
+         {'push_token': 'ExponentPushToken[new]'}, True, 'json'),
+        ('push-tokens-is_token', 'get',
+         '/api/push-tokens/is_token/', None, True, None),
+        ('push-tokens-delete_token', 'delete',
+         '/api/push-tokens/delete_token/', None, True, None),
+        ('carts-list', 'get', '/api/carts/', None, True, None),
+        ('carts-create', 'post', '/api/carts/',
+         {'persons': 2}, False, 'json'),
+        ('carts-detail', 'get', f'/api/carts/{cart}/', None, False, None),
+        ('carts-update', 'put', f'/api/carts/{cart}/',
+         {'persons': 3}, False, 'json'),
+        ('cart-items-list', 'get', f'/api/carts/{cart}/items/', None, False, None),
+        ('cart-items-detail', 'get',
+         f'/api/carts/{cart}/items/{data["cart_items"][0].pk}/', None, False, None),
+        ('cart-items-create', 'post', f'/api/carts/{cart}/items/',
+         {'product': data['other_house'].pk, **window}, False, 'json'),
+        ('cart-items-update', 'put', f'/api/carts/{cart}/items/{data["cart_items"][1].pk}/',
+         {'start_datetime': '2030-03-01T16:00:00Z', 'end_datetime': '2030-03-01T18:00:00Z', 'quantity': 1}, False, 'json'),
+        ('cart-items-delete', 'delete',
+         f'/api/carts/{cart}/items/{data["cart_items"][1].pk}/', None, False, None),
+        ('cart-items-is_valid', 'get',
+         f'/api/carts/{cart}/items/is_valid/', None, False, None),
+        ('cart-items-check_affected', 'get',
+         f'/api/carts/{data["affected_cart"].pk}/items/check_affected/', None, False, None),
+        ('cart-items-get_allowed_interval', 'post',
+         f'/api/carts/{cart}/items/get_allowed_interval/', {'product_id': addon}, False, 'json'),
+    ]
+
+
+def snapshot_carts(carts):
+    """ Carts kept outside the database survive the rollback, the returned callable puts them back """
+    store = get_store()
+    if not isinstance(store, CacheCartStore):
+        return lambda: None
+
+    keys = [store.key(cart.pk) for cart in carts]
+    records = store.cache.get_many(keys)
+
+    def restore():
+        # The versions the request claimed have to be free again for the next one
+        claimed = [f'{key}:version:{version}'
+                   for key, record in store.cache.get_many(keys).items()
+                   for version in range(records.get(key, {}).get('version', 0) + 1, record.get('version', 0) + 1)]
+        store.cache.delete_many(keys + claimed)
+        store.cache.set_many(records, settings.CART_TTL)
+    return restore
+
+
+def measure(client, method, path, body, format, carts):
+    cache.clear()
+    restore_carts = snapshot_carts(carts)
+    with transaction.atomic():
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, body, format=format)
+            elapsed = time.perf_counter() - started
+        transaction.set_rollback(True)
+    restore_carts()
+
+    return {'status': response.status_code, 'queries': len(queries),
+            'time_ms': round(elapsed * 1000, 1), 'bytes': len(response.content)}
+
+
+def run(data):
+    anonymous = APIClient()
+    admin = APIClient()
+    admin.force_authenticate(data['admin'])
+
+    return {name: measure(admin if as_admin else anonymous, method, path, body, format, data['carts'])
+            for name, method, path, body, as_admin, format in cases(data)}
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=4, sort_keys=True)
+        file.write('\n')
+
+
+def compare(results, baseline, time_tolerance=None):
+    """ Budget violations: a different status, more queries than the baseline or, when asked, a slower response """
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            failures.append(f'{name}: no baseline recorded')
+            continue
+        if result['status'] != expected['status']:
+            failures.append(
+                f'{name}: status {result["status"]}, baseline {expected["status"]}')
+        if result['queries'] > expected['queries']:
+            failures.append(
+                f'{name}: {result["queries"]} queries, budget {expected["queries"]}')
+        if time_tolerance and result['time_ms'] > expected['time_ms'] * time_tolerance:
+            failures.append(
+                f'{name}: {result["time_ms"]} ms, budget {expected["time_ms"] * time_tolerance} ms')
+    return failures
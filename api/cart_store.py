@@ -0,0 +1,165 @@
+""" Where anonymous carts live until checkout.
+
+CacheCartStore keeps each cart as a single record in a key-value cache with a TTL, so browsing and filling a cart
+never writes to the database, the order created at checkout is the only thing persisted. DatabaseCartStore keeps
+carts in the Cart and CartItem tables. Either way a cart is returned as an unsaved or saved Cart with its
+lines, products attached, in `cart.cart_items`.
+"""
+from uuid import UUID
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.http import Http404
+from django.utils.module_loading import import_string
+from rest_framework.exceptions import APIException
+
+from api.models import Cart, CartItem, Product
+
+ITEM_FIELDS = ['product_id', 'start_datetime',
+               'end_datetime', 'quantity', 'price']
+
+
+class DatabaseCartStore:
+    def create(self, persons):
+        cart = Cart.objects.create(persons=persons)
+        cart.cart_items = []
+        return cart
+
+    def get(self, cart_id):
+        cart = Cart.objects.filter(pk=cart_id).first()
+        if cart is not None:
+            cart.cart_items = list(cart.items.select_related(
+                'product').order_by('pk'))
+        return cart
+
+    def save_cart(self, cart):
+        cart.save(update_fields=['persons'])
+
+    def save_items(self, cart, items):
+        """ Insert the new lines and write back the changed ones """
+        changed = [item for item in items if item.pk is not None]
+        for item in items:
+            if item.pk is None:
+                item.cart = cart
+                item.save()
+                cart.cart_items.append(item)
+        CartItem.objects.bulk_update(
+            changed, ['start_datetime', 'end_datetime', 'quantity', 'price'])
+
+    def delete_items(self, cart, items):
+        ids = {item.pk for item in items}
+        CartItem.objects.filter(cart=cart, pk__in=ids).delete()
+        cart.cart_items = [item for item in cart.cart_items if item.pk not in ids]
+
+    def delete(self, cart):
+        cart.delete()
+
+
+class CartChanged(APIException):
+    status_code = 409
+    default_detail = {'message': 'Корзина изменилась, повторите действие'}
+    default_code = 'cart_changed'
+
+
+class CacheCartStore:
+    """ Carts saved before the switch are moved over from the tables the first time they are read.
+
+    Every write claims the next version of the record with cache.add, which only one writer can do, so of two
+    requests changing the same cart the later one fails with CartChanged instead of dropping the other's change.
+    """
+
+    def __init__(self):
+        self.cache = caches[settings.CART_CACHE]
+        self.fallback = DatabaseCartStore()
+
+    def key(self, cart_id):
+        return f'cart:{cart_id}'
+
+    def write(self, cart):
+        version = getattr(cart, 'version', 0) + 1
+        if not self.cache.add(f'{self.key(cart.pk)}:version:{version}', True, settings.CART_TTL):
+            raise CartChanged()
+        self.cache.set(self.key(cart.pk), {
+            'persons': cart.persons,
+            'next_item_id': cart.next_item_id,
+            'version': version,
+            'items': [dict({field: getattr(item, field) for field in ITEM_FIELDS}, id=item.pk) for item in cart.cart_items],
+        }, settings.CART_TTL)
+        cart.version = version
+
+    def create(self, persons):
+        cart = Cart(persons=persons)
+        cart.cart_items = []
+        cart.next_item_id = 1
+        self.write(cart)
+        return cart
+
+    def get(self, cart_id):
+        record = self.cache.get(self.key(cart_id))
+        if record is None:
+            return self.move_from_database(cart_id)
+
+        cart = Cart(pk=cart_id, persons=record['persons'])
+        cart.next_item_id = record['next_item_id']
+        # Records written before versions were kept claimed none
+        cart.version = record.get('version', 0)
+        products = Product.objects.in_bulk(
+            {item['product_id'] for item in record['items']})
+        # Products can be deleted while a cart waits in the cache, their lines just disappear
+        cart.cart_items = [CartItem(id=item['id'], cart=cart, product=products[item['product_id']], start_datetime=item['start_datetime'],
+                                    end_datetime=item['end_datetime'], quantity=item['quantity'], price=item['price'])
+                           for item in record['items'] if item['product_id'] in products]
+        return cart
+
+    def move_from_database(self, cart_id):
+        cart = self.fallback.get(cart_id)
+        if cart is None:
+            return None
+        cart.next_item_id = max(
+            [item.pk for item in cart.cart_items], default=0) + 1
+        self.write(cart)
+        Cart.objects.filter(pk=cart.pk).delete()
+        return cart
+
+    def save_cart(self, cart):
+        self.write(cart)
+
+    def save_items(self, cart, items):
+        for item in items:
+            if item.pk is None:
+                item.pk = cart.next_item_id
+                item.cart = cart
+                cart.next_item_id += 1
+                cart.cart_items.append(item)
+        self.write(cart)
+
+    def delete_items(self, cart, items):
+        ids = {item.pk for item in items}
+        cart.cart_items = [item for item in cart.cart_items if item.pk not in ids]
+        self.write(cart)
+
+    def delete(self, cart):
+        # A checkout that rolls back must leave the cart in place
+        transaction.on_commit(lambda: self.cache.delete(self.key(cart.pk)))
+
+
+def get_store():
+    return import_string(settings.CART_STORE)()
+
+
+def get_cart_or_404(cart_id):
+    try:
+        cart_id = UUID(str(cart_id))
+    except ValueError:
+        raise Http404
+    cart = get_store().get(cart_id)
+    if cart is None:
+        raise Http404
+    return cart
+
+
+def prefetch_product_details(items):
+    """ What ProductSerializer renders for the products of the given lines """
+    prefetch_related_objects([item.product for item in items],
+                             'files', 'product_special_intervals', 'required_product')
@@ -0,0 +1,86 @@
+""" Checks every line of a cart in one pass over data loaded once: the tariffs, the bookings and the required product graph. """
+from dataclasses import dataclass, field
+from rest_framework import serializers
+
+from api.dependencies import get_graph
+from api.pricing import find_conflicts, getStartEnd, get_tariffs
+
+UNAVAILABLE = 'unavailable'
+CART_OVERLAP = 'cart_overlap'
+BOOKED = 'booked'
+INVALID_DATES = 'invalid_dates'
+
+
+@dataclass
+class CartLine:
+    item: object
+    start: object
+    end: object
+    fixed_end: object
+    price: object = None
+    errors: list = field(default_factory=list)
+
+    @property
+    def is_valid(self):
+        return not self.errors
+
+    @property
+    def price_changed(self):
+        return self.price is not None and self.price != self.item.price
+
+
+@dataclass
+class CartReport:
+    lines: list
+    persons: int
+    max_persons: int
+
+    def invalid_lines(self, *codes):
+        """ Lines with any error, or only with one of the given errors """
+        return [line for line in self.lines if any(not codes or error in codes for error in line.errors)]
+
+    @property
+    def is_valid(self):
+        return self.persons <= self.max_persons and not self.invalid_lines()
+
+
+def validate(cart):
+    """ cart comes from the cart store, with its lines and their products in cart.cart_items """
+    items = cart.cart_items
+    tariffs = get_tariffs([item.product for item in items])
+    lines = [CartLine(item, *getStartEnd(item.start_datetime, item.end_datetime,
+                      item.product.use_hotel_booking_time)) for item in items]
+    conflicts = find_conflicts(
+        [(line.item.product_id, line.start, line.end) for line in lines])
+    containment = get_graph().check_containment(
+        (index, line.item.product_id, line.start, line.end) for index, line in enumerate(lines))
+
+    lines_by_product = {}
+    for line in lines:
+        lines_by_product.setdefault(line.item.product_id, []).append(line)
+
+    max_persons = 0
+    for index, line in enumerate(lines):
+        product = line.item.product
+        if product.max_persons:
+            max_persons += product.max_persons
+
+        if not product.is_available:
+            line.errors.append(UNAVAILABLE)
+
+        if index in containment:
+            line.errors.append(containment[index])
+
+        if any(other is not line and other.start < line.end and other.end > line.start for other in lines_by_product[product.pk]):
+            line.errors.append(CART_OVERLAP)
+
+        if index in conflicts:
+            line.errors.append(BOOKED)
+
+        try:
+            line.price = tariffs[product.pk].calculate(
+                line.start, line.end, line.fixed_end, line.item.quantity, '')
+        except serializers.ValidationError:
+            line.errors.append(INVALID_DATES)
+
+    return CartReport(lines, cart.persons, max_persons)
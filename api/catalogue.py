@@ -0,0 +1,70 @@
+""" Compact product list served as pre-rendered JSON, rebuilt only after the catalogue changed.
+
+The version checked on every request is kept in the database, see api.versions. Media URLs are absolute like in the
+rest of the API, a body is cached for each host the catalogue is asked on.
+"""
+from hashlib import md5
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+
+from api import images, versions
+from api.db_router import primary
+from api.models import Product, ProductFile
+
+VERSION = 'catalogue'
+
+
+def invalidate():
+    versions.bump(VERSION)
+
+
+def thumbnail_url(product, url):
+    files = product.primary_files
+    if not files:
+        return None
+    image = files[0].file_thumbnail or files[0].file
+    return url(image.name) if image else None
+
+
+def thumbnail_srcset(product, url):
+    files = product.primary_files
+    return images.srcset(files[0], url) if files else {}
+
+
+def build(url=None):
+    url = url or default_storage.url
+    queryset = Product.objects.prefetch_related(
+        Prefetch('files', queryset=ProductFile.objects.filter(is_primary=True), to_attr='primary_files'), 'product_special_intervals')
+
+    return [{
+        'id': product.pk,
+        'title': product.title,
+        'unit_price': product.unit_price,
+        'time_unit': product.time_unit,
+        'max_persons': product.max_persons,
+        'required_product': product.required_product_id,
+        'thumbnail': thumbnail_url(product, url),
+        'thumbnail_srcset': thumbnail_srcset(product, url),
+        'is_available': product.is_available,
+        'use_hotel_booking_time': product.use_hotel_booking_time,
+        'has_special_price': len(product.product_special_intervals.all()) > 0,
+    } for product in queryset]
+
+
+def media_url(request):
+    return lambda name: request.build_absolute_uri(default_storage.url(name))
+
+
+def rendered(request):
+    """ (etag, body) of the current catalogue as seen from the host of the request """
+    key = f'catalogue:rendered:{versions.get(VERSION)}:{request.build_absolute_uri("/")}'
+    cached = cache.get(key)
+    if cached is None:
+        with primary():
+            body = JSONRenderer().render(build(media_url(request)))
+        cached = (f'"{md5(body).hexdigest()}"', body)
+        cache.set(key, cached, settings.CATALOGUE_CACHE_TIMEOUT)
+    return cached
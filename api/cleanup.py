@@ -0,0 +1,70 @@
+""" Expiry of carts nobody checked out and orders nobody verified.
+
+Rows are walked by primary key in bounded batches, each batch in its own short transaction, so a large backlog
+never turns into one long statement holding locks.
+"""
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from api import availability
+from api.holds import expired
+from api.models import Cart, Order, OrderItem
+
+
+def keyset_batches(queryset, batch_size):
+    """ Primary keys of queryset in batches, each one starting after the last key of the previous batch """
+    last_pk = None
+    while True:
+        page = queryset.order_by('pk')
+        if last_pk is not None:
+            page = page.filter(pk__gt=last_pk)
+        pks = list(page.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last_pk = pks[-1]
+
+
+def expire_carts(cutoff, batch_size):
+    """ Carts kept in the tables, the cache store expires its own """
+    reclaimed = {'carts': 0, 'cart_items': 0}
+    for pks in keyset_batches(Cart.objects.filter(created_at__lt=cutoff), batch_size):
+        with transaction.atomic():
+            _, deleted = Cart.objects.filter(pk__in=pks).delete()
+        reclaimed['carts'] += deleted.get('api.Cart', 0)
+        reclaimed['cart_items'] += deleted.get('api.CartItem', 0)
+    return reclaimed
+
+
+def expire_orders(batch_size):
+    """ Fail orders whose hold ran out before they were verified and recount the calendar around them """
+    reclaimed = {'orders': 0, 'order_items': 0}
+    stale = Order.objects.filter(expired())
+    for pks in keyset_batches(stale, batch_size):
+        with transaction.atomic():
+            # Orders another worker is expiring right now are left to it
+            pks = list(stale.select_for_update(skip_locked=True).filter(
+                pk__in=pks).values_list('pk', flat=True))
+            items = list(OrderItem.objects.filter(
+                order_id__in=pks).select_related('product'))
+            reclaimed['orders'] += Order.objects.filter(
+                pk__in=pks).update(status=Order.PAYMENT_STATUS_FAILED)
+            reclaimed['order_items'] += OrderItem.objects.filter(
+                order_id__in=pks).update(order_status=Order.PAYMENT_STATUS_FAILED)
+            availability.refresh_items(items)
+    return reclaimed
+
+
+def collect(batch_size=None):
+    """ One pass over both, returns how many rows of each kind were reclaimed and how long it took """
+    batch_size = batch_size or settings.CLEANUP_BATCH_SIZE
+    started = time.monotonic()
+    now = timezone.now()
+
+    metrics = expire_carts(now - timedelta(seconds=settings.CART_TTL), batch_size)
+    metrics.update(expire_orders(batch_size))
+    metrics['seconds'] = round(time.monotonic() - started, 3)
+    return metrics
@@ -0,0 +1,33 @@
+""" Calendar arithmetic used by pricing, computed in constant time however long the ranges are. """
+
+
+def _weekend_days_below(day_number):
+    # Weekend days among day numbers [0, day_number) where day 0 is a Monday.
+    return (day_number // 7) * 2 + max(0, day_number % 7 - 5)
+
+
+def count_of_weekends(start_time, end_time):
+    """ Saturdays and Sundays among the days that follow start_time, up to the whole days of the range. """
+    days = (end_time - start_time).days
+    if days <= 0:
+        return 0
+
+    first = start_time.weekday() + 1
+    return _weekend_days_below(first + days) - _weekend_days_below(first)
+
+
+def overlapping(r1_start_time, r1_end_time, r2_start_time, r2_end_time, days=True):
+    latest_start = max(r1_start_time, r2_start_time)
+    earliest_end = min(r1_end_time, r2_end_time)
+    delta = (earliest_end - latest_start)
+
+    return delta.days if days else delta.seconds // 3600
+
+
+def overlapping_days(r1_start_time, r1_end_time, r2_start_time, r2_end_time):
+    return overlapping(r1_start_time, r1_end_time, r2_start_time, r2_end_time)
+
+
+def overlapping_hours(r1_start_time, r1_end_time, r2_start_time, r2_end_time):
+    return overlapping(r1_start_time, r1_end_time, r2_start_time, r2_end_time, days=False)
+
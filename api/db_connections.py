@@ -0,0 +1,80 @@
+""" Persistent database connections for the web workers.
+
+Django keeps a connection for CONN_MAX_AGE seconds but only tests it after an error, so a connection the server
+or pgbouncer dropped while the worker was idle fails the next request. A kept connection idle for more than
+DATABASE_HEALTH_CHECK_IDLE seconds is pinged once before its request uses it and reopened when dead, busy
+connections skip the round trip. Every worker counts how often requests reused a connection, how many it had to
+open and how long it waited for them.
+"""
+import time
+from django.conf import settings
+from django.core.signals import request_finished, request_started
+from django.db import connections
+from django.dispatch import receiver
+
+stats = {
+    'requests': 0,
+    'reused': 0,
+    'opened': 0,
+    'dropped': 0,
+    'connect_time': 0.0,
+    'max_connect_time': 0.0,
+}
+
+
+class HealthCheckedConnectionMixin(object):
+    """ Database wrapper mixin, see api.postgresql """
+    health_check_due = False
+    idle_since = None
+
+    def connect(self):
+        started = time.monotonic()
+        super().connect()
+        waited = time.monotonic() - started
+        stats['opened'] += 1
+        stats['connect_time'] += waited
+        stats['max_connect_time'] = max(stats['max_connect_time'], waited)
+
+    def ensure_connection(self):
+        if self.health_check_due and not self.in_atomic_block:
+            self.health_check_due = False
+            if self.connection is not None and not self.is_usable():
+                stats['dropped'] += 1
+                self.close()
+        super().ensure_connection()
+
+    def start_request(self):
+        if self.connection is None:
+            return
+        stats['reused'] += 1
+        self.health_check_due = (self.idle_since is None or
+                                 time.monotonic() - self.idle_since > settings.DATABASE_HEALTH_CHECK_IDLE)
+
+    def finish_request(self):
+        self.health_check_due = False
+        self.idle_since = time.monotonic()
+
+
+def summary():
+    average = stats['connect_time'] / stats['opened'] if stats['opened'] else 0
+    return (f"{stats['requests']} requests, {stats['reused']} reused and {stats['opened']} opened connections, "
+            f"{stats['dropped']} dropped by health checks, connect time {average * 1000:.1f} ms on average "
+            f"and {stats['max_connect_time'] * 1000:.1f} ms at most")
+
+
+def _health_checked():
+    return [conn for conn in connections.all() if isinstance(conn, HealthCheckedConnectionMixin)]
+
+
+# Connected after django.db's close_old_connections, which drops expired connections first
+@receiver(request_started, dispatch_uid='api.db_connections.start_request')
+def start_request(**kwargs):
+    stats['requests'] += 1
+    for conn in _health_checked():
+        conn.start_request()
+
+
+@receiver(request_finished, dispatch_uid='api.db_connections.finish_request')
+def finish_request(**kwargs):
+    for conn in _health_checked():
+        conn.finish_request()
@@ -0,0 +1,76 @@
+""" Reads that tolerate a little staleness go to the read replicas, everything else to the primary.
+
+Views opt in per action with ReplicaReadsMixin.replica_actions. A client that just wrote something gets a cookie
+pinning it to the primary for REPLICA_STICKINESS seconds, so it reads its own writes whatever replication lag is.
+Anything cached for other requests is loaded inside primary(), a stale copy would outlive the lag.
+"""
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+STICKY_COOKIE = 'read_primary'
+
+_state = threading.local()
+
+
+def replicas():
+    return list(settings.REPLICA_DATABASES)
+
+
+@contextmanager
+def primary():
+    """ Reads inside go to the primary even in a view reading from the replicas """
+    previous = getattr(_state, 'replica', False)
+    _state.replica = False
+    try:
+        yield
+    finally:
+        _state.replica = previous
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        if getattr(_state, 'replica', False) and replicas():
+            return random.choice(replicas())
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+class ReplicaStickinessMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.replica = False
+        _state.wrote = False
+        request.pinned_to_primary = STICKY_COOKIE in request.COOKIES
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.replica = False
+        if _state.wrote and replicas():
+            response.set_cookie(STICKY_COOKIE, '1', max_age=settings.REPLICA_STICKINESS,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+class ReplicaReadsMixin(object):
+    """ Actions listed in replica_actions read from the replicas, unless the client is pinned to the primary """
+    replica_actions = []
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        _state.replica = self.action in self.replica_actions and not getattr(
+            request._request, 'pinned_to_primary', False)
@@ -0,0 +1,102 @@
+""" The required_product tree of all products, built with one query and cached under a version bumped by every product change.
+
+Add-ons can require other add-ons, each line of a cart or order only has to sit inside a line of its direct parent.
+"""
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import cache
+
+from api import versions
+from api.db_router import primary
+from api.models import Product
+
+VERSION = 'dependency_graph'
+
+REQUIRED_MISSING = 'required_missing'
+REQUIRED_INTERVAL = 'required_interval'
+
+
+def _walk(start, edges):
+    """ Everything reachable from start, nearest first, stopping on cycles """
+    reached = []
+    pending = list(edges.get(start, ()))
+    while pending:
+        product_id = pending.pop(0)
+        if product_id == start or product_id in reached:
+            continue
+        reached.append(product_id)
+        pending += edges.get(product_id, ())
+    return tuple(reached)
+
+
+@dataclass(frozen=True)
+class DependencyGraph:
+    parents: dict
+    children: dict
+    ancestors: dict
+    descendants: dict
+
+    @classmethod
+    def from_edges(cls, edges):
+        """ edges are (product_id, required_product_id) pairs """
+        parents = {product_id: required_id for product_id,
+                   required_id in edges if required_id is not None}
+        children = {}
+        for product_id, required_id in parents.items():
+            children.setdefault(required_id, []).append(product_id)
+        children = {product_id: tuple(sorted(ids))
+                    for product_id, ids in children.items()}
+        single_parents = {product_id: (required_id,)
+                          for product_id, required_id in parents.items()}
+
+        return cls(
+            parents=parents,
+            children=children,
+            ancestors={product_id: _walk(product_id, single_parents)
+                       for product_id in parents},
+            descendants={product_id: _walk(product_id, children)
+                         for product_id in children},
+        )
+
+    def parent(self, product_id):
+        return self.parents.get(product_id)
+
+    def dependents(self, product_id):
+        """ Products that can't be booked without this one, directly or through another add-on """
+        return self.descendants.get(product_id, ())
+
+    def check_containment(self, lines):
+        """ Errors of (key, product_id, start, end) lines whose parent product is missing or doesn't cover them.
+
+        Returns a {key: REQUIRED_MISSING or REQUIRED_INTERVAL} dict for the failing lines only.
+        """
+        lines = list(lines)
+        windows = {}
+        for _, product_id, start, end in lines:
+            windows.setdefault(product_id, []).append((start, end))
+
+        errors = {}
+        for key, product_id, start, end in lines:
+            required_id = self.parent(product_id)
+            if required_id is None:
+                continue
+            if required_id not in windows:
+                errors[key] = REQUIRED_MISSING
+            elif not any(start >= required_start and end <= required_end for required_start, required_end in windows[required_id]):
+                errors[key] = REQUIRED_INTERVAL
+        return errors
+
+
+def get_graph():
+    key = f'products:dependency_graph:{versions.get(VERSION)}'
+    graph = cache.get(key)
+    if graph is None:
+        with primary():
+            graph = DependencyGraph.from_edges(
+                list(Product.objects.values_list('pk', 'required_product_id')))
+        cache.set(key, graph, settings.CATALOGUE_CACHE_TIMEOUT)
+    return graph
+
+
+def invalidate():
+    versions.bump(VERSION)
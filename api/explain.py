@@ -0,0 +1,32 @@
+""" Checks that the hot queries can be answered from the indexes declared for them.
+
+On the small tables of a test database PostgreSQL prefers sequential scans whatever indexes exist, so plans are
+taken with them discouraged: the question asked is whether an index applies, not whether it pays off yet.
+"""
+from contextlib import contextmanager
+from django.db import connection, transaction
+
+
+@contextmanager
+def index_scans_preferred():
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        yield
+
+
+def plan(queryset):
+    with index_scans_preferred():
+        return queryset.explain()
+
+
+def primary_key_index(model):
+    """ How the plan names a lookup by primary key """
+    if connection.vendor == 'postgresql':
+        return f'{model._meta.db_table}_pkey'
+    return 'PRIMARY KEY'
+
+
+def uses_index(queryset, index_name):
+    return index_name in plan(queryset)
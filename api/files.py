@@ -0,0 +1,218 @@
+""" Lifecycle of stored files: a file is removed from the storage once no row of its model refers to it.
+
+Instances of models with file fields remember the names they were loaded with, so saving one only looks at the
+database when a file was actually replaced. Files to remove are queued as FileDeletion rows in the transaction
+that dropped them, so a rollback leaves them in place, and the delete_files command removes them from the storage
+once the change is committed, retrying failures with backoff. It skips names a row refers to again by then, the same
+content is stored under the same name. Whole querysets are deleted with delete_rows, which looks
+up the files of all rows at once, and the worker removes files from S3 a thousand per DeleteObjects call.
+"""
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.deletion import Collector
+from django.db.models.signals import post_delete, post_init, post_save
+from django.utils import timezone
+
+from api.models import FileDeletion
+
+LOADED_NAMES = '_loaded_file_names'
+# DeleteObjects takes at most this many keys
+S3_DELETE_LIMIT = 1000
+
+_bulk = threading.local()
+# Callables (names) -> the ones rows refer to outside their file fields, see track_file_fields
+_extra_references = []
+
+
+def file_fields(model):
+    return [field for field in model._meta.concrete_fields if isinstance(field, models.FileField)]
+
+
+def name_of(value):
+    """ Name behind the raw attribute value, which is a string straight from the database or some kind of File """
+    if value is None or isinstance(value, str):
+        return value or ''
+    return value.name or ''
+
+
+def current_names(instance):
+    # Deferred fields are skipped, reading them would load them
+    return {field.attname: name_of(instance.__dict__[field.attname])
+            for field in file_fields(type(instance)) if field.attname in instance.__dict__}
+
+
+def remember_names(sender, instance, **kwargs):
+    setattr(instance, LOADED_NAMES, current_names(instance))
+
+
+def release_replaced(sender, instance, created=False, update_fields=None, **kwargs):
+    """ Runs once the UPDATE went through, a save that fails leaves the old files in place """
+    if created:
+        return
+    loaded = getattr(instance, LOADED_NAMES, {})
+    current = current_names(instance)
+    replaced = [(field, loaded[field.attname]) for field in file_fields(sender)
+                if (update_fields is None or field.name in update_fields) and field.attname in loaded
+                and field.attname in current and loaded[field.attname] and loaded[field.attname] != current[field.attname]]
+    release(sender, [instance.pk], replaced)
+
+
+def release_deleted(sender, instance, **kwargs):
+    if in_bulk_deletion():
+        return
+    current = current_names(instance)
+    release(sender, [instance.pk], [(field, current[field.attname]) for field in file_fields(sender)
+                                    if current.get(field.attname)])
+
+
+def release(model, pks, dropped, extra_names=()):
+    """ Queue the dropped (field, name) pairs no row of the model besides pks still refers to """
+    if not dropped:
+        queue_deletion(extra_names)
+        return
+    condition = Q()
+    for field, name in dropped:
+        condition |= Q(**{field.attname: name})
+    still_used = set()
+    for row in model.objects.filter(condition).exclude(pk__in=pks).values(*{field.attname for field, _ in dropped}):
+        still_used.update(row.items())
+    queue_deletion([name for field, name in dropped if (field.attname, name) not in still_used] + list(extra_names))
+
+
+@contextmanager
+def bulk_deletion():
+    """ Rows deleted inside leave their files to the caller """
+    _bulk.active = True
+    try:
+        yield
+    finally:
+        _bulk.active = False
+
+
+def in_bulk_deletion():
+    return getattr(_bulk, 'active', False)
+
+
+def delete_rows(queryset, extra_names=None):
+    """ Delete the rows and queue their files with a fixed number of queries however many rows there are.
+    extra_names(instances) lists files of the rows their file fields don't know about and no other row refers to """
+    instances = list(queryset)
+    pks = [instance.pk for instance in instances]
+    dropped = set()
+    for instance in instances:
+        current = current_names(instance)
+        dropped.update((field, current[field.attname]) for field in file_fields(
+            queryset.model) if current.get(field.attname))
+    extra = extra_names(instances) if extra_names else []
+
+    # Collecting the loaded rows spares the select queryset.delete() would run again
+    collector = Collector(using=queryset.db)
+    collector.collect(instances)
+    with bulk_deletion():
+        collector.delete()
+    release(queryset.model, pks, dropped, extra)
+
+
+def queue_deletion(names):
+    FileDeletion.objects.bulk_create(
+        [FileDeletion(name=name) for name in names if name])
+
+
+def track_file_fields(extra_references=()):
+    """ Connect the handlers to every installed model with a file field, called once the apps are ready.
+    extra_references are the lookups referenced_names consults besides the file fields """
+    _extra_references[:] = extra_references
+    for model in apps.get_models():
+        if file_fields(model):
+            post_init.connect(remember_names, sender=model)
+            # Before remember_names, which forgets the names the instance was loaded with
+            post_save.connect(release_replaced, sender=model)
+            post_save.connect(remember_names, sender=model)
+            post_delete.connect(release_deleted, sender=model)
+
+
+def referenced_names(names):
+    """ The names some row refers to, the same content stored again gets the name of a file queued before """
+    used = set()
+    for model in apps.get_models():
+        fields = file_fields(model)
+        if not fields:
+            continue
+        condition = Q()
+        for field in fields:
+            condition |= Q(**{f'{field.attname}__in': names})
+        for row in model.objects.filter(condition).values_list(*[field.attname for field in fields]):
+            used.update(row)
+    for lookup in _extra_references:
+        used.update(lookup(names))
+    return used & set(names)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.FILE_DELETION_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def delete_from_storage(storage, names):
+    """ Remove the files, returns {name: error} of the ones that could not be removed """
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is None:
+        errors = {}
+        for name in names:
+            try:
+                storage.delete(name)
+            except Exception as error:
+                errors[name] = str(error)
+        return errors
+
+    # S3Boto3Storage, its keys are the saved names with the storage location prepended
+    keys = {storage._normalize_name(name): name for name in names}
+    errors = {}
+    chunks = [list(keys)[start:start + S3_DELETE_LIMIT]
+              for start in range(0, len(keys), S3_DELETE_LIMIT)]
+    for chunk in chunks:
+        try:
+            response = bucket.delete_objects(
+                Delete={'Objects': [{'Key': key} for key in chunk], 'Quiet': True})
+        except Exception as error:
+            errors.update({keys[key]: str(error) for key in chunk})
+        else:
+            errors.update({keys[failure['Key']]: failure.get('Message', failure.get('Code', ''))
+                           for failure in response.get('Errors', [])})
+    return errors
+
+
+def delete_batch(storage=default_storage, batch_size=None):
+    """ Remove the queued files that are due from the storage, returns how many were processed """
+    now = timezone.now()
+    with transaction.atomic():
+        deletions = list(FileDeletion.objects.select_for_update(skip_locked=True).filter(
+            status=FileDeletion.STATUS_PENDING, next_attempt_at__lte=now).order_by('next_attempt_at')[:batch_size or settings.FILE_DELETION_BATCH_SIZE])
+
+        # Referred to again since they were queued, the files stay
+        used = referenced_names(list({deletion.name for deletion in deletions}))
+        FileDeletion.objects.filter(pk__in=[deletion.pk for deletion in deletions if deletion.name in used]).delete()
+        deletions_left = [deletion for deletion in deletions if deletion.name not in used]
+
+        errors = delete_from_storage(
+            storage, list({deletion.name: None for deletion in deletions_left}))
+        failed = []
+        for deletion in deletions_left:
+            if deletion.name in errors:
+                deletion.attempts += 1
+                deletion.last_error = errors[deletion.name]
+                deletion.next_attempt_at = now + retry_delay(deletion.attempts)
+                if deletion.attempts >= settings.FILE_DELETION_MAX_ATTEMPTS:
+                    deletion.status = FileDeletion.STATUS_FAILED
+                failed.append(deletion)
+
+        FileDeletion.objects.filter(pk__in=[deletion.pk for deletion in deletions_left if deletion.name not in errors]).delete()
+        FileDeletion.objects.bulk_update(
+            failed, ['status', 'attempts', 'last_error', 'next_attempt_at'])
+
+    return len(deletions)
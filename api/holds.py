@@ -0,0 +1,46 @@
+""" Unverified orders hold their dates only until Order.hold_expires_at, which their items carry a copy of.
+
+Past that an order still waiting for its code is treated as free everywhere, whether or not `expire_stale`
+has failed it yet. The booking exclusion constraint doesn't know about expiry, so expired holds overlapping the
+dates about to be booked are failed right before the insert.
+"""
+from django.db.models import Q
+from django.utils import timezone
+
+from api.models import Order, OrderItem
+
+
+def expired():
+    """ Condition matching orders whose hold ran out """
+    return Q(status=Order.PAYMENT_STATUS_WAITING, hold_expires_at__lte=timezone.now())
+
+
+def expired_items():
+    """ The same for order items, from the status and hold copied on them """
+    return Q(order_status=Order.PAYMENT_STATUS_WAITING, hold_expires_at__lte=timezone.now())
+
+
+def active_order_items():
+    """ Order items that keep their dates: neither failed nor an expired hold """
+    # Reads only the item's own columns, so lookups stay on the partial booking index
+    return OrderItem.objects.exclude(order_status=Order.PAYMENT_STATUS_FAILED).exclude(expired_items())
+
+
+def release_expired(windows):
+    """ Fail the expired holds overlapping these (product_id, start, end) windows, returns how many orders were released """
+    overlapping = Q()
+    for product_id, start, end in windows:
+        overlapping |= Q(product_id=product_id, start_datetime__lt=end, end_datetime__gt=start)
+    if not overlapping:
+        return 0
+    order_ids = list(OrderItem.objects.filter(expired_items()).filter(overlapping).values_list(
+        'order_id', flat=True).distinct())
+    if not order_ids:
+        return 0
+
+    # Orders are locked before their items, like a verification does, and checked again once locked
+    order_ids = list(Order.objects.select_for_update().filter(expired(), pk__in=order_ids).order_by(
+        'pk').values_list('pk', flat=True))
+    OrderItem.objects.filter(order_id__in=order_ids).update(
+        order_status=Order.PAYMENT_STATUS_FAILED)
+    return Order.objects.filter(pk__in=order_ids).update(status=Order.PAYMENT_STATUS_FAILED)
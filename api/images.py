@@ -0,0 +1,176 @@
+""" Conversion of uploaded product photos, run by the process_images command.
+
+Uploads are stored untouched in ProductFile.original and left pending. The worker renders the same JPEG image and
+thumbnail the imagekit fields produce plus WebP copies of IMAGE_VARIANT_WIDTHS in a process pool, writes them to
+the storage under names hashed from their content and only then stores the names, so the fields never process
+anything a second time. Uploads are claimed in a short transaction first, the rendering runs outside of it.
+"""
+import json
+from datetime import timedelta
+from hashlib import sha256
+from io import BytesIO
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import BooleanField, Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from PIL import Image
+from pilkit.processors import Resize, ResizeToFill
+from pilkit.utils import save_image
+
+from api import catalogue
+from api.files import release
+from api.models import ProductFile
+
+FULL_OPTIONS = {'quality': 60}
+THUMBNAIL_SIZE = (600, 600)
+VARIANT_FORMAT = 'webp'
+VARIANT_OPTIONS = {'quality': 75}
+HASH_LENGTH = 20
+
+
+def encode(image, format, options):
+    output = BytesIO()
+    save_image(image, output, format, options)
+    return output.getvalue()
+
+
+def render(data, widths):
+    """ Runs in the pool: original bytes to {'file': bytes, 'file_thumbnail': bytes, 'variants': {width: bytes}} """
+    image = Image.open(BytesIO(data))
+    image.load()
+    variants = {}
+    for width in widths:
+        if width < image.width:
+            height = max(1, round(image.height * width / image.width))
+            variants[width] = encode(
+                Resize(width, height).process(image), VARIANT_FORMAT, VARIANT_OPTIONS)
+    return {
+        'file': encode(image, 'JPEG', FULL_OPTIONS),
+        'file_thumbnail': encode(ResizeToFill(*THUMBNAIL_SIZE).process(image), 'JPEG', FULL_OPTIONS),
+        'variants': variants,
+    }
+
+
+def hashed_name(directory, data, extension):
+    """ Name derived from the content, so whatever is stored under it never changes and can be cached for good """
+    return f'{directory}/{sha256(data).hexdigest()[:HASH_LENGTH]}.{extension}'
+
+
+def store(product_file, rendered):
+    for name, directory in [('file', 'files'), ('file_thumbnail', 'files/thumbnails')]:
+        setattr(product_file, name, default_storage.save(
+            hashed_name(directory, rendered[name], 'jpg'), ContentFile(rendered[name])))
+    product_file.variants = {VARIANT_FORMAT: {
+        str(width): default_storage.save(hashed_name('files/variants', data, VARIANT_FORMAT), ContentFile(data))
+        for width, data in rendered['variants'].items()}}
+
+
+def variant_names(product_file):
+    for sizes in product_file.variants.values():
+        yield from sizes.values()
+
+
+def unused_variant_names(product_files):
+    """ Variant names of the given files no other ProductFile refers to, the same photo uploaded twice renders
+    to the same names """
+    names = {name for product_file in product_files for name in variant_names(product_file)}
+    if not names:
+        return []
+
+    # A name is hashed from the content, so it sits under the same format and width in every row. Width keys look
+    # like array indexes to JSON key lookups, containment matches the whole entry instead and can use the GIN index
+    condition = Q()
+    for product_file in product_files:
+        for format, sizes in product_file.variants.items():
+            for width, name in sizes.items():
+                condition |= Q(variants__contains={format: {width: name}})
+    others = ProductFile.objects.filter(condition).exclude(
+        pk__in=[product_file.pk for product_file in product_files])
+    for product_file in others.only('variants'):
+        names.difference_update(variant_names(product_file))
+    return sorted(names)
+
+
+def referenced_variant_names(names):
+    """ The names some ProductFile has among its variants, whatever format and width they are under """
+    path = ' || '.join(f'@ == {json.dumps(name)}' for name in names)
+    if not path:
+        return set()
+    used = set()
+    for product_file in ProductFile.objects.filter(RawSQL(
+            'variants @? %s::jsonpath', [f'$.*.* ? ({path})'], output_field=BooleanField())).only('variants'):
+        used.update(variant_names(product_file))
+    return used & set(names)
+
+
+def srcset(product_file, url=None):
+    """ {format: srcset attribute} of the resized copies, narrowest first """
+    url = url or default_storage.url
+    return {format: ', '.join(f'{url(sizes[width])} {width}w' for width in sorted(sizes, key=int))
+            for format, sizes in product_file.variants.items()}
+
+
+def claim(batch_size):
+    """ Pending uploads leased to this worker for IMAGE_CLAIM_TIMEOUT seconds, committed before anything is
+    rendered so the conversion holds neither row locks nor a transaction """
+    now = timezone.now()
+    with transaction.atomic():
+        files = list(ProductFile.objects.select_for_update(skip_locked=True).filter(
+            Q(claimed_until__isnull=True) | Q(claimed_until__lte=now),
+            status=ProductFile.STATUS_PENDING).order_by('pk')[:batch_size])
+        ProductFile.objects.filter(pk__in=[product_file.pk for product_file in files]).update(
+            claimed_until=now + timedelta(seconds=settings.IMAGE_CLAIM_TIMEOUT))
+    return files
+
+
+def read_original(product_file):
+    """ Bytes of the uploaded original, None when it is missing or can't be read """
+    try:
+        with product_file.original.open('rb') as original:
+            return original.read()
+    except Exception:
+        return None
+
+
+def process_batch(pool, batch_size=None):
+    """ Convert the oldest pending uploads, returns how many were processed """
+    files = claim(batch_size or settings.IMAGE_BATCH_SIZE)
+    if not files:
+        return 0
+
+    futures = [pool.submit(render, data, settings.IMAGE_VARIANT_WIDTHS) if data is not None else None
+               for data in map(read_original, files)]
+
+    for product_file, future in zip(files, futures):
+        try:
+            rendered = future.result() if future else None
+        except Exception:
+            # Not an image Pillow can read
+            rendered = None
+        if rendered is None:
+            # The row stays visible to the admin as failed
+            product_file.status = ProductFile.STATUS_FAILED
+        else:
+            store(product_file, rendered)
+            product_file.status = ProductFile.STATUS_READY
+        product_file.claimed_until = None
+
+    with transaction.atomic():
+        existing = set(ProductFile.objects.select_for_update().filter(
+            pk__in=[product_file.pk for product_file in files]).values_list('pk', flat=True))
+        ProductFile.objects.bulk_update([product_file for product_file in files if product_file.pk in existing],
+                                        ['file', 'file_thumbnail', 'variants', 'status', 'claimed_until'])
+
+        # Photos deleted while they were converted leave what was stored for them to the deletion queue
+        deleted = [product_file for product_file in files if product_file.pk not in existing]
+        fields = [ProductFile._meta.get_field(name) for name in ['file', 'file_thumbnail']]
+        release(ProductFile, [product_file.pk for product_file in deleted],
+                [(field, field.value_from_object(product_file).name) for product_file in deleted
+                 for field in fields if field.value_from_object(product_file)],
+                unused_variant_names(deleted))
+
+    catalogue.invalidate()
+    return len(files)
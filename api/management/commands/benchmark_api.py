@@ -0,0 +1,52 @@
+import json
+import tempfile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = 'Measure queries, time and response size of every API route on a seeded test database and compare them with the baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--update-baseline', action='store_true',
+                            help='Record the results as the new baseline instead of comparing')
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--time-tolerance', type=float,
+                            help='Also fail routes slower than the baseline time multiplied by this factor')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+                results = benchmark.run(benchmark.seed())
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            self.stdout.write(
+                f'{name:<36} {result["status"]:>4} {result["queries"]:>4} queries {result["time_ms"]:>9} ms {result["bytes"]:>9} bytes')
+
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(results, file, indent=4, sort_keys=True)
+
+        if options['update_baseline']:
+            benchmark.save_baseline(results)
+            self.stdout.write(self.style.SUCCESS(
+                f'Baseline written to {benchmark.BASELINE_PATH}'))
+            return
+
+        if not benchmark.BASELINE_PATH.exists():
+            raise CommandError(
+                'No baseline recorded yet, run with --update-baseline first')
+        failures = benchmark.compare(
+            results, benchmark.load_baseline(), options['time_tolerance'])
+        if failures:
+            raise CommandError('\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('Within budget'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.utils.pushNotifications import check_push_receipts
+
+
+class Command(BaseCommand):
+    help = 'Check the receipts of sent push notifications and drop unregistered device tokens'
+
+    def handle(self, *args, **options):
+        checked = check_push_receipts()
+        self.stdout.write(f'Checked {checked} push receipts')
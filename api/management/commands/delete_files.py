@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+
+from api.files import delete_batch
+
+
+class Command(BaseCommand):
+    help = 'Remove files no row refers to anymore from the storage, retrying failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Remove the due files and exit')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds to wait when nothing is due')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = delete_batch(batch_size=options['batch_size'])
+            if processed:
+                self.stdout.write(f'Processed {processed} files')
+                continue
+            if options['once']:
+                return
+            time.sleep(options['interval'])
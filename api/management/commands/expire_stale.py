@@ -0,0 +1,22 @@
+import time
+from django.core.management.base import BaseCommand
+
+from api import cleanup
+
+
+class Command(BaseCommand):
+    help = 'Delete expired carts and fail orders left unverified, releasing the dates they booked'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--interval', type=float,
+                            help='Keep running, collecting again every this many seconds')
+
+    def handle(self, *args, **options):
+        while True:
+            metrics = cleanup.collect(options['batch_size'])
+            self.stdout.write(' '.join(
+                f'{name}={value}' for name, value in metrics.items()))
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
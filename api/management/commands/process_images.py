@@ -0,0 +1,30 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.images import process_batch
+
+
+class Command(BaseCommand):
+    help = 'Convert uploaded product photos into the full image, thumbnail and resized copies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Convert the pending uploads and exit')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--workers', type=int,
+                            help='Processes converting images, IMAGE_WORKERS by default')
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds to wait when nothing is pending')
+
+    def handle(self, *args, **options):
+        with ProcessPoolExecutor(options['workers'] or settings.IMAGE_WORKERS) as pool:
+            while True:
+                processed = process_batch(pool, options['batch_size'])
+                if processed:
+                    self.stdout.write(f'Processed {processed} images')
+                    continue
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from api import availability
+from api.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Recount the availability calendar of every product from its order items'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--product', type=int,
+                            help='Only rebuild the calendar of this product')
+
+    def handle(self, *args, **options):
+        products = Product.objects.all()
+        if options['product']:
+            products = products.filter(pk=options['product'])
+
+        for product in products.iterator():
+            availability.rebuild(product)
+            self.stdout.write(f'Rebuilt availability of {product}')
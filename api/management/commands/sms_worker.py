@@ -0,0 +1,26 @@
+import time
+from django.core.management.base import BaseCommand
+
+from api.sms import dispatch_batch, get_gateway
+
+
+class Command(BaseCommand):
+    help = 'Send queued text messages, retrying failed ones with backoff'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the due messages and exit')
+        parser.add_argument('--batch-size', type=int)
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds to wait when nothing is due')
+
+    def handle(self, *args, **options):
+        gateway = get_gateway()
+        while True:
+            processed = dispatch_batch(gateway, options['batch_size'])
+            if processed:
+                self.stdout.write(f'Processed {processed} messages')
+                continue
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,90 @@
+""" Media files served by the API when they live on the local storage.
+
+Only the images, thumbnails and variants are served, never the uploaded originals or anything else in the storage.
+Names hashed from their content (see images.hashed_name) never change, they are sent with a far-future Cache-Control
+so browsers and a CDN in front keep them. Legacy names stored before hashing are revalidated against an ETag of
+their size and modification time. Single byte ranges are honoured for partial downloads.
+"""
+import mimetypes
+import posixpath
+import re
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_safe
+
+from api.images import HASH_LENGTH
+
+IMAGE_DIRECTORIES = {'files', 'files/thumbnails', 'files/variants'}
+HASHED_NAME = re.compile(rf'^[0-9a-f]{{{HASH_LENGTH}}}(_\w+)?\.\w+$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def is_served(name):
+    return posixpath.dirname(name) in IMAGE_DIRECTORIES
+
+
+def is_immutable(name):
+    return is_served(name) and bool(HASHED_NAME.match(posixpath.basename(name)))
+
+
+def parse_range(header, size):
+    """ (start, end) inclusive of a single satisfiable range, None to send the whole file, False if unsatisfiable """
+    match = RANGE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def read_range(file, start, length):
+    with file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_safe
+def serve(request, path):
+    name = posixpath.normpath(path).lstrip('/')
+    if not is_served(name) or not default_storage.exists(name):
+        raise Http404
+
+    size = default_storage.size(name)
+    immutable = is_immutable(name)
+    if immutable:
+        etag = f'"{posixpath.splitext(posixpath.basename(name))[0]}"'
+    else:
+        etag = f'"{size}-{int(default_storage.get_modified_time(name).timestamp())}"'
+    if request.headers.get('If-None-Match') == etag:
+        response = HttpResponse(status=304)
+    else:
+        byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        elif byte_range is None:
+            response = FileResponse(default_storage.open(name, 'rb'))
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(read_range(
+                default_storage.open(name, 'rb'), start, end - start + 1), status=206)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Type'] = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={settings.MEDIA_MAX_AGE}, immutable' if immutable else 'no-cache'
+    return response
@@ -0,0 +1,86 @@
+# Generated by Django 4.0.6 on 2026-10-18 18:53
+
+from datetime import timedelta
+import api.models
+import django.contrib.postgres.constraints
+import django.contrib.postgres.fields.ranges
+from django.contrib.postgres.operations import BtreeGistExtension
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+
+def copy_order_status(apps, schema_editor):
+    Order = apps.get_model('api', 'Order')
+    OrderItem = apps.get_model('api', 'OrderItem')
+    OrderItem.objects.update(order_status=Subquery(
+        Order.objects.filter(pk=OuterRef('order_id')).values('status')[:1]))
+
+
+OVERLAPPING_BOOKINGS = """
+    SELECT a.id, a.order_id, a.order_status, b.id, b.order_id, b.order_status, a.product_id
+    FROM api_orderitem a JOIN api_orderitem b ON a.product_id = b.product_id AND a.id < b.id
+        AND a.start_datetime < b.end_datetime AND b.start_datetime < a.end_datetime
+    WHERE a.order_status <> 'F' AND b.order_status <> 'F'
+    ORDER BY a.id, b.id
+"""
+
+
+def fail_orders(apps, order_ids):
+    apps.get_model('api', 'OrderItem').objects.filter(order_id__in=order_ids).update(order_status='F')
+    apps.get_model('api', 'Order').objects.filter(pk__in=order_ids).update(status='F')
+
+
+def resolve_overlapping_bookings(apps, schema_editor):
+    """ The constraint can't be added over bookings the old race let overlap.
+
+    Orders waiting for their code never expired before, the ones older than the hour every order gets now are
+    failed. Of the remaining overlaps the newest waiting order is failed, overlaps of verified orders need a
+    decision and stop the migration.
+    """
+    Order = apps.get_model('api', 'Order')
+    fail_orders(apps, list(Order.objects.filter(
+        status='W', created_at__lt=timezone.now() - timedelta(hours=1)).values_list('pk', flat=True)))
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(OVERLAPPING_BOOKINGS)
+        overlaps = cursor.fetchall()
+
+    failed = set()
+    conflicts = []
+    for item_id, order_id, order_status, other_item_id, other_order_id, other_status, product_id in overlaps:
+        if order_id in failed or other_order_id in failed:
+            continue
+        waiting = [pk for pk, status in [(order_id, order_status), (other_order_id, other_status)] if status == 'W']
+        if waiting:
+            failed.add(max(waiting))
+        else:
+            conflicts.append(f'product {product_id}: item {item_id} of order {order_id}, '
+                             f'item {other_item_id} of order {other_order_id}')
+    fail_orders(apps, failed)
+
+    if conflicts:
+        raise RuntimeError('Verified orders book the same dates, mark one order of each pair as failed and migrate again:\n'
+                           + '\n'.join(conflicts))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0058_alter_productspecialinterval_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='order_status',
+            field=models.CharField(choices=[('W', 'Waiting For Phone Verification'), ('P', 'Pending'), ('C', 'Complete'), ('F', 'Failed')], default='W', editable=False, max_length=1),
+        ),
+        migrations.RunPython(copy_order_status, migrations.RunPython.noop),
+        migrations.RunPython(resolve_overlapping_bookings, migrations.RunPython.noop),
+        BtreeGistExtension(),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=django.contrib.postgres.constraints.ExclusionConstraint(condition=models.Q(('order_status', 'F'), _negated=True), expressions=[('product', '='), (api.models.TsTzRange('start_datetime', 'end_datetime', django.contrib.postgres.fields.ranges.RangeBoundary()), '&&')], name='api_orderitem_no_overlapping_bookings'),
+        ),
+    ]
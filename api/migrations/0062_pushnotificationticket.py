@@ -0,0 +1,22 @@
+# Generated by Django 4.0.6 on 2026-10-18 20:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0061_smsmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushNotificationTicket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ticket_id', models.CharField(max_length=255)),
+                ('push_token', models.CharField(max_length=255)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 4.0.6 on 2026-10-18 21:05
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0062_pushnotificationticket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 4.0.6 on 2026-10-18 21:40
+
+from datetime import timedelta
+import api.models
+from django.db import migrations, models
+from django.db.models import F
+
+
+def hold_from_creation(apps, schema_editor):
+    # Orders already waiting keep their dates for an hour after they were placed
+    Order = apps.get_model('api', 'Order')
+    Order.objects.update(hold_expires_at=F('created_at') + timedelta(hours=1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0063_cart_created_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='availabilityslot',
+            name='held_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='hold_expires_at',
+            field=models.DateTimeField(default=api.models.default_hold_expiry),
+        ),
+        migrations.RunPython(hold_from_creation, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(condition=models.Q(('status', 'W')), fields=['status', 'hold_expires_at'], name='api_order_waiting_hold_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.6 on 2026-10-18 22:05
+
+import imagekit.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0064_order_hold_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productfile',
+            name='original',
+            field=models.FileField(blank=True, null=True, upload_to='files/originals'),
+        ),
+        migrations.AddField(
+            model_name='productfile',
+            name='status',
+            field=models.CharField(choices=[('P', 'Pending'), ('R', 'Ready'), ('F', 'Failed')], default='R', max_length=1),
+        ),
+        migrations.AddField(
+            model_name='productfile',
+            name='variants',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name='productfile',
+            name='file',
+            field=imagekit.models.fields.ProcessedImageField(blank=True, null=True, upload_to='files'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.6 on 2026-10-18 23:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0066_filedeletion'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-created_at', '-id'], name='api_order_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(('order_status', 'P')), fields=['-start_datetime', '-id'], name='api_orderitem_paid_feed_idx'),
+        ),
+    ]
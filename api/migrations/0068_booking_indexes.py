@@ -0,0 +1,21 @@
+# Generated by Django 4.0.6 on 2026-10-18 23:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0067_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cart',
+            index=models.Index(fields=['created_at'], name='api_cart_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='orderitem',
+            index=models.Index(condition=models.Q(('order_status', 'F'), _negated=True), fields=['product', 'end_datetime', 'start_datetime'], name='api_orderitem_booking_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.6 on 2026-10-18 23:55
+
+import api.models
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_hold_expiry(apps, schema_editor):
+    Order = apps.get_model('api', 'Order')
+    OrderItem = apps.get_model('api', 'OrderItem')
+    OrderItem.objects.update(hold_expires_at=Subquery(
+        Order.objects.filter(pk=OuterRef('order_id')).values('hold_expires_at')[:1]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0068_booking_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='orderitem',
+            name='hold_expires_at',
+            field=models.DateTimeField(default=api.models.default_hold_expiry, editable=False),
+        ),
+        migrations.RunPython(copy_hold_expiry, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.6 on 2026-10-18 20:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0071_cacheversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productfile',
+            name='claimed_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
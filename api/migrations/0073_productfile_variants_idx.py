@@ -0,0 +1,18 @@
+# Generated by Django 4.0.6 on 2026-10-18 20:39
+
+import django.contrib.postgres.indexes
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0072_productfile_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='productfile',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['variants'], name='api_productfile_variants_idx', opclasses=['jsonb_path_ops']),
+        ),
+    ]
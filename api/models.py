@@ -1,58 +1,16 @@
+from datetime import timedelta
 from uuid import uuid4
-from django.db.models.signals import post_delete, pre_save
-from django.dispatch import receiver
-from django.db import models
+from django.conf import settings
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateTimeRangeField, RangeBoundary, RangeOperators
+from django.contrib.postgres.indexes import GinIndex
+from django.db import models, transaction
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.core.validators import MinValueValidator
 from imagekit.models import ProcessedImageField
 from imagekit.processors import ResizeToFill
 
-""" Whenever ANY model is deleted, if it has a file field on it, delete the associated file too."""
-
-
-@receiver(post_delete)
-def delete_files_when_row_deleted_from_db(sender, instance, **kwargs):
-    for field in sender._meta.concrete_fields:
-        if isinstance(field, models.FileField):
-            instance_file_field = getattr(instance, field.name)
-            delete_file_if_unused(sender, instance, field, instance_file_field)
-
-
-""" Delete the file if something else get uploaded in its place"""
-
-
-@receiver(pre_save)
-def delete_files_when_file_changed(sender, instance, **kwargs):
-    # Don't run on initial save
-    if not instance.pk:
-        return
-    for field in sender._meta.concrete_fields:
-        if isinstance(field, models.FileField):
-            # its got a file field. Let's see if it changed
-            try:
-                instance_in_db = sender.objects.get(pk=instance.pk)
-            except sender.DoesNotExist:
-                # We are probably in a transaction and the PK is just temporary
-                # Don't worry about deleting attachments if they aren't actually saved yet.
-                return
-            instance_in_db_file_field = getattr(instance_in_db, field.name)
-            instance_file_field = getattr(instance, field.name)
-            if instance_in_db_file_field.name != instance_file_field.name:
-                delete_file_if_unused(
-                    sender, instance, field, instance_in_db_file_field)
-
-
-""" Only delete the file if no other instances of that model are using it"""
-
-
-def delete_file_if_unused(model, instance, field, instance_file_field):
-    dynamic_field = {}
-    dynamic_field[field.name] = instance_file_field.name
-    other_refs_exist = model.objects.filter(
-        **dynamic_field).exclude(pk=instance.pk).exists()
-    if not other_refs_exist:
-        instance_file_field.delete(False)
-
 
 class Product(models.Model):
 
@@ -78,25 +36,61 @@ class Product(models.Model):
     description = models.TextField(null=True, blank=True)
     max_persons = models.PositiveSmallIntegerField(
         null=True, blank=True, validators=[MinValueValidator(0)])
+    # Also moved by changes of the special intervals, cached tariffs are keyed by it
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        # Remember how the availability calendar of this product is bucketed
+        instance._loaded_time_unit = (loaded.get('time_unit'),
+                                      loaded.get('use_hotel_booking_time'))
+        return instance
 
     def __str__(self) -> str:
         return self.title
 
 
 class ProductFile(models.Model):
+
+    STATUS_PENDING = 'P'
+    STATUS_READY = 'R'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed')
+    ]
+
     product = models.ForeignKey(
         to=Product, on_delete=models.CASCADE, related_name='files')
     file = ProcessedImageField(upload_to='files',
                                format='JPEG',
-                               options={'quality': 60})
+                               options={'quality': 60}, null=True, blank=True)
     file_thumbnail = ProcessedImageField(upload_to='files/thumbnails',
                                          processors=[ResizeToFill(600, 600)],
                                          format='JPEG',
                                          options={'quality': 60}, null=True, blank=True)
     is_primary = models.BooleanField(default=False)
+    # Uploads through the API are stored as is and converted by `manage.py process_images`
+    original = models.FileField(
+        upload_to='files/originals', null=True, blank=True)
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=STATUS_READY)
+    # {format: {width: name}} of the resized copies
+    variants = models.JSONField(default=dict, blank=True)
+    # A worker converting the pending upload, other workers leave it alone until then
+    claimed_until = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         ordering = ['-is_primary']
+        # Deleting a photo looks up the other rows sharing its variants, see images.unused_variant_names
+        indexes = [GinIndex(fields=['variants'], opclasses=['jsonb_path_ops'], name='api_productfile_variants_idx')]
+
+
+def default_hold_expiry():
+    return timezone.now() + timedelta(seconds=settings.UNVERIFIED_ORDER_TTL)
 
 
 class Order(models.Model):
@@ -122,6 +116,38 @@ class Order(models.Model):
     persons = models.PositiveSmallIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
     ip_address = models.GenericIPAddressField()
+    # While waiting for the code the order only holds its dates until then
+    hold_expires_at = models.DateTimeField(default=default_hold_expiry)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'hold_expires_at'], condition=models.Q(
+            status='W'), name='api_order_waiting_hold_idx'),
+            # The admin list pages by creation time
+            models.Index(fields=['-created_at', '-id'], name='api_order_created_idx')]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = dict(zip(field_names, values)).get('status')
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Keep the status and hold copied on the items in sync, the booking exclusion constraint and
+        # availability queries read them from there. Synced first, so the calendar recount after save sees them
+        with transaction.atomic(savepoint=False):
+            if not self._state.adding:
+                self.items.exclude(order_status=self.status, hold_expires_at=self.hold_expires_at).update(
+                    order_status=self.status, hold_expires_at=self.hold_expires_at)
+            super().save(*args, **kwargs)
+
+
+# Live order items of a product can't book overlapping times, see api.serializers.booking_conflict_as_validation_error
+BOOKING_EXCLUSION_CONSTRAINT = 'api_orderitem_no_overlapping_bookings'
+
+
+class TsTzRange(models.Func):
+    function = 'TSTZRANGE'
+    output_field = DateTimeRangeField()
 
 
 class OrderItem(models.Model):
@@ -134,12 +160,47 @@ class OrderItem(models.Model):
     quantity = models.PositiveSmallIntegerField(
         default=1, validators=[MinValueValidator(1)])
     total_price = models.IntegerField()
+    order_status = models.CharField(
+        max_length=1, choices=Order.PAYMENT_STATUS_CHOICES, default=Order.PAYMENT_STATUS_WAITING, editable=False)
+    hold_expires_at = models.DateTimeField(
+        default=default_hold_expiry, editable=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        loaded = dict(zip(field_names, values))
+        instance._loaded_booking = (loaded.get('product_id'), loaded.get(
+            'start_datetime'), loaded.get('end_datetime'))
+        return instance
+
+    class Meta:
+        # The feed of paid items pages by start time
+        indexes = [models.Index(fields=['-start_datetime', '-id'], condition=models.Q(
+            order_status='P'), name='api_orderitem_paid_feed_idx'),
+            # Overlap checks and the time view look up the live bookings of a product ending after some moment
+            models.Index(fields=['product', 'end_datetime', 'start_datetime'], condition=~models.Q(
+                order_status='F'), name='api_orderitem_booking_idx')]
+        constraints = [ExclusionConstraint(
+            name=BOOKING_EXCLUSION_CONSTRAINT,
+            expressions=[('product', RangeOperators.EQUAL),
+                         (TsTzRange('start_datetime', 'end_datetime', RangeBoundary()), RangeOperators.OVERLAPS)],
+            condition=~models.Q(order_status='F'))]
+
+    def save(self, *args, **kwargs):
+        self.order_status = self.order.status
+        self.hold_expires_at = self.order.hold_expires_at
+        super().save(*args, **kwargs)
 
 
 class Cart(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid4)
     persons = models.PositiveSmallIntegerField(
         validators=[MinValueValidator(1)])
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # expire_stale looks for carts created before the cutoff
+        indexes = [models.Index(fields=['created_at'], name='api_cart_created_idx')]
 
 
 class ProductSpecialInterval(models.Model):
@@ -166,7 +227,78 @@ class CartItem(models.Model):
     price = models.IntegerField()
 
 
+class AvailabilitySlot(models.Model):
+    product = models.ForeignKey(
+        to=Product, on_delete=models.CASCADE, related_name='availability_slots')
+    bucket = models.DateTimeField()
+    bookings = models.PositiveSmallIntegerField()
+    # Latest expiry of the unverified orders holding the bucket, they aren't counted in bookings
+    held_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        unique_together = [['product', 'bucket']]
+
+
+class SmsMessage(models.Model):
+
+    STATUS_PENDING = 'P'
+    STATUS_SENT = 'S'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_SENT, 'Sent'),
+        (STATUS_FAILED, 'Failed')
+    ]
+
+    phone = models.CharField(max_length=15)
+    text = models.TextField()
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+
+class FileDeletion(models.Model):
+    """ A stored file no row refers to anymore, removed by `manage.py delete_files` """
+
+    STATUS_PENDING = 'P'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_FAILED, 'Failed')
+    ]
+
+    name = models.CharField(max_length=255)
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+
 class UserPushNotificationToken(models.Model):
     user = models.ForeignKey(
         to=User, on_delete=models.CASCADE, related_name='push_token')
     push_token = models.CharField(max_length=255)
+
+
+class PushNotificationTicket(models.Model):
+    ticket_id = models.CharField(max_length=255)
+    push_token = models.CharField(max_length=255)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class CacheVersion(models.Model):
+    """ Bumped on every change of what a cache holds, cache keys carry it so no process reads stale data """
+    name = models.CharField(max_length=50, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
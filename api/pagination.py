@@ -1,4 +1,20 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 class DefaultPagination(PageNumberPagination):
-    page_size = 10
\ No newline at end of file
+    page_size = 10
+
+
+class KeysetPagination(CursorPagination):
+    """ Pages start after the last row of the previous one instead of at an offset and aren't counted,
+    so a deep page costs as much as the first. Clients pick page_size up to max_page_size """
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+
+class OrderPagination(KeysetPagination):
+    ordering = ('-created_at', '-id')
+
+
+class OrderItemFeedPagination(KeysetPagination):
+    ordering = ('-start_datetime', '-id')
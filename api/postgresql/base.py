@@ -0,0 +1,8 @@
+""" PostgreSQL backend with the health checks and connection metrics of api.db_connections """
+from django.db.backends.postgresql import base
+
+from api.db_connections import HealthCheckedConnectionMixin
+
+
+class DatabaseWrapper(HealthCheckedConnectionMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,189 @@
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework import serializers
+
+from api.dates import count_of_weekends, overlapping_days, overlapping_hours
+from api.db_router import primary
+from api.holds import active_order_items
+from api.models import Product, ProductSpecialInterval
+
+
+def condition_constructor(start_time, end_time):
+
+    universal_query = Q(start_datetime__lt=end_time) & Q(
+        end_datetime__gt=start_time)
+
+    return universal_query
+
+
+def getStartEnd(start, end, use_hotel_booking_time):
+    return [start.replace(hour=14, minute=0, second=0, microsecond=0), end.replace(hour=12, minute=0, second=0, microsecond=0), end.replace(hour=14, minute=0, second=0, microsecond=0)] if use_hotel_booking_time else [start, end, end]
+
+
+def is_time_in_range(start, end, x):
+    if start <= end:
+        return start <= x <= end
+    else:
+        return start <= x or x <= end
+
+
+@dataclass(frozen=True)
+class SpecialInterval:
+    start_datetime: object
+    end_datetime: object
+    additional_price_per_unit: int
+    weekends: int
+
+
+@dataclass(frozen=True)
+class Tariff:
+    """ Everything needed to price a product, loaded once and reused until the product or its intervals change. """
+
+    product_id: int
+    unit_price: int
+    time_unit: str
+    min_unit: int
+    max_unit: int
+    min_hour: object
+    max_hour: object
+    use_hotel_booking_time: bool
+    intervals: tuple
+    weekends_price: object
+
+    @classmethod
+    def from_product(cls, product, intervals):
+        dated = sorted((interval for interval in intervals if not interval.is_weekends),
+                       key=lambda interval: interval.start_datetime)
+        weekends = [interval for interval in intervals if interval.is_weekends]
+
+        return cls(
+            product_id=product.pk,
+            unit_price=product.unit_price,
+            time_unit=product.time_unit,
+            min_unit=product.min_unit,
+            max_unit=product.max_unit,
+            min_hour=product.min_hour,
+            max_hour=product.max_hour,
+            use_hotel_booking_time=product.use_hotel_booking_time,
+            intervals=tuple(SpecialInterval(interval.start_datetime, interval.end_datetime, interval.additional_price_per_unit,
+                                            count_of_weekends(interval.start_datetime, interval.end_datetime))
+                            for interval in dated),
+            weekends_price=weekends[0].additional_price_per_unit if weekends else None
+        )
+
+    def find_interval(self, start, end):
+        for interval in self.intervals:
+            if interval.start_datetime < end and interval.end_datetime > start:
+                return interval
+        return None
+
+    def calculate(self, start, end, fixed_end, quantity, error_message, info=False):
+        time_difference = fixed_end - start
+
+        if self.time_unit == 'H':
+            seconds = 3600
+            units = int(time_difference.seconds / 3600)
+        else:
+            seconds = (60*60*24)
+            units = time_difference.days
+
+        if (time_difference.seconds % seconds != 0) or \
+            (not self.use_hotel_booking_time and (not is_time_in_range(self.min_hour, self.max_hour, start.time()) or
+                                                  not is_time_in_range(self.min_hour, self.max_hour, end.time()))) or \
+                (start >= end) or (units < self.min_unit) or (units > self.max_unit):
+            raise serializers.ValidationError(
+                {'product_id': self.product_id, 'message': error_message})
+
+        extra_price = 0
+        interval = self.find_interval(start, end)
+
+        if interval:
+            if self.time_unit == 'H':
+                extra_price += interval.additional_price_per_unit * \
+                    overlapping_hours(interval.start_datetime, interval.end_datetime,
+                                      start, fixed_end)
+            else:
+                extra_price += overlapping_days(interval.start_datetime, interval.end_datetime,
+                                                start, fixed_end) * interval.additional_price_per_unit
+                if self.weekends_price is not None:
+                    user_weekends = count_of_weekends(start, fixed_end)
+                    extra_price += self.weekends_price * \
+                        max(0, (user_weekends - interval.weekends))
+
+        elif self.weekends_price is not None:
+            if self.time_unit == 'H' and start.weekday() > 4:
+                extra_price += self.weekends_price * units
+            elif self.time_unit == 'D':
+                extra_price += count_of_weekends(
+                    start, fixed_end) * self.weekends_price
+
+        total_price = (self.unit_price * units + extra_price) * quantity
+        return total_price if not info else {'normal_price': self.unit_price * units * quantity, 'extra_price': extra_price * quantity, 'total_price': total_price}
+
+
+def tariff_cache_key(product):
+    """ Every change of the product or its intervals moves updated_at, no process can read a stale tariff """
+    # v2: intervals carry their weekend count, tariffs cached before that can't be read back
+    return f'pricing:tariff:v2:{product.pk}:{product.updated_at.timestamp()}'
+
+
+def get_tariff(product):
+    """ Intervals come from the prefetch cache when the product was loaded with them. """
+    key = tariff_cache_key(product)
+    tariff = cache.get(key)
+    if tariff is None:
+        tariff = Tariff.from_product(
+            product, product.product_special_intervals.all())
+        cache.set(key, tariff, settings.PRICING_CACHE_TIMEOUT)
+    return tariff
+
+
+def get_tariffs(products):
+    """ Tariffs for many products at once, loading the intervals of all cache misses with one query. """
+    products = {product.pk: product for product in products}
+    keys = {pk: tariff_cache_key(product) for pk, product in products.items()}
+    cached = cache.get_many(keys.values())
+    tariffs = {pk: cached[key] for pk, key in keys.items() if key in cached}
+
+    missing = [pk for pk in products if pk not in tariffs]
+    if missing:
+        intervals = {pk: [] for pk in missing}
+        with primary():
+            for interval in ProductSpecialInterval.objects.filter(product_id__in=missing):
+                intervals[interval.product_id].append(interval)
+
+        compiled = {pk: Tariff.from_product(
+            products[pk], intervals[pk]) for pk in missing}
+        cache.set_many({keys[pk]: tariff for pk, tariff in compiled.items()},
+                       settings.PRICING_CACHE_TIMEOUT)
+        tariffs.update(compiled)
+
+    return tariffs
+
+
+def touch(product_id):
+    """ Moves updated_at of a product whose tariff changed without saving it, with its intervals """
+    Product.objects.filter(pk=product_id).update(updated_at=timezone.now())
+
+
+def find_conflicts(windows):
+    """ Indexes of the (product_id, start, end) windows already booked, checked with a single query. """
+    if not windows:
+        return set()
+
+    condition = Q()
+    for product_id, start, end in windows:
+        condition |= Q(product_id=product_id) & condition_constructor(start, end)
+
+    booked = active_order_items().filter(
+        condition).values_list('product_id', 'start_datetime', 'end_datetime')
+
+    conflicts = set()
+    for product_id, booked_start, booked_end in booked:
+        for index, (window_product_id, start, end) in enumerate(windows):
+            if window_product_id == product_id and booked_start < end and booked_end > start:
+                conflicts.add(index)
+    return conflicts
@@ -1,24 +1,46 @@
-from datetime import datetime, timedelta
+from contextlib import contextmanager
+from datetime import datetime
 from multiprocessing import context
 import random
 from rest_framework import status
+from django.conf import settings
 from django.utils import timezone
-from django.db import transaction
+from django.db import IntegrityError, transaction
 from django.db.models import Q, Sum
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
-from api.models import Cart, CartItem, ProductSpecialInterval, Order, OrderItem, Product, ProductFile, UserPushNotificationToken
+from api.models import BOOKING_EXCLUSION_CONSTRAINT, Cart, CartItem, ProductSpecialInterval, Order, OrderItem, Product, ProductFile, UserPushNotificationToken
 
-from django.conf import settings
+from django.core.files.storage import default_storage
 
-from .utils.pushNotifications import send_push_message
-from .smsaero import SmsAero
+from . import availability, cart_store, cart_validation, dependencies, files, uploads
+from .images import srcset, unused_variant_names
+from .holds import active_order_items, release_expired
+from .pricing import condition_constructor, find_conflicts, getStartEnd, get_tariff, get_tariffs
+from .utils.pushNotifications import notify_admins
+from .sms import queue_sms
 
 
 class ProductFileSerializer(serializers.ModelSerializer):
+    variants = serializers.SerializerMethodField()
+    srcset = serializers.SerializerMethodField()
+
+    def media_url(self, name):
+        request = self.context.get('request')
+        return request.build_absolute_uri(default_storage.url(name)) if request else default_storage.url(name)
+
+    def get_variants(self, product_file):
+        # {format: {width: url}}, empty until the upload is processed
+        return {format: {width: self.media_url(name) for width, name in sizes.items()}
+                for format, sizes in product_file.variants.items()}
+
+    def get_srcset(self, product_file):
+        return srcset(product_file, self.media_url)
+
     class Meta:
         model = ProductFile
-        exclude = ['product']
+        exclude = ['product', 'original', 'claimed_until']
 
 
 class CreateProductFilesSerializer(serializers.Serializer):
@@ -30,13 +52,56 @@ class CreateProductFilesSerializer(serializers.Serializer):
         product = get_object_or_404(Product.objects.all(), pk=product_id)
         files = self.validated_data['files']
 
-        list_for_create = [ProductFile(
-            product=product, file=file, file_thumbnail=file) for file in files]
+        # Stored as uploaded, `manage.py process_images` renders the image and its sizes
+        uploads.register(product, files)
+
+
+class UploadRequestSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=255)
+    content_type = serializers.CharField(max_length=100)
+
+    def validate_content_type(self, value):
+        if not value.startswith('image/'):
+            raise serializers.ValidationError('Можно загружать только изображения')
+        return value
+
+
+class PresignProductFilesSerializer(serializers.Serializer):
+    files = UploadRequestSerializer(many=True, allow_empty=False)
 
-        if not ProductFile.objects.filter(product_id=product_id).exists():
-            list_for_create[0].is_primary = True
+    def save(self, **kwargs):
+        product = get_object_or_404(
+            Product.objects.all(), pk=self.context['product_id'])
+        return {'uploads': [uploads.issue(product.pk, file['name'], file['content_type'], self.context['request'])
+                            for file in self.validated_data['files']]}
+
+
+class ConfirmProductFilesSerializer(serializers.Serializer):
+    upload_ids = serializers.ListField(
+        child=serializers.CharField(), allow_empty=False)
+
+    def save(self, **kwargs):
+        product = get_object_or_404(
+            Product.objects.all(), pk=self.context['product_id'])
+        keys = uploads.confirmed_keys(
+            product.pk, self.validated_data['upload_ids'])
+        if keys is None:
+            raise serializers.ValidationError(
+                {'message': 'Недействительный идентификатор загрузки'})
+        if not all(default_storage.exists(key) for key in keys):
+            raise serializers.ValidationError(
+                {'message': 'Файл не загружен'})
 
-        ProductFile.objects.bulk_create(list_for_create)
+        with transaction.atomic():
+            # Confirms of the same product wait for each other, so confirming again after a lost response
+            # doesn't register the photos twice even while the first request is still running
+            product = get_object_or_404(
+                Product.objects.select_for_update(), pk=product.pk)
+            registered = set(ProductFile.objects.filter(
+                original__in=keys).values_list('original', flat=True))
+            uploads.register(
+                product, [key for key in dict.fromkeys(keys) if key not in registered])
+        return ProductFileSerializer(ProductFile.objects.filter(original__in=keys), many=True, context=self.context).data
 
 
 class DeleteProductFilesSerializer(serializers.Serializer):
@@ -52,14 +117,14 @@ class DeleteProductFilesSerializer(serializers.Serializer):
                 pk__in=files_ids, product=product)
 
             if queryset.filter(is_primary=True).exists():
-                queryset.delete()
+                files.delete_rows(queryset, unused_variant_names)
                 queryset_general = ProductFile.objects.filter(product=product)
                 if (queryset_general.exists()):
                     file = queryset_general.first()
                     file.is_primary = True
                     file.save()
             else:
-                queryset.delete()
+                files.delete_rows(queryset, unused_variant_names)
 
 
 class MakeFilePrimarySerializer(serializers.Serializer):
@@ -166,114 +231,39 @@ class ProductSerializer(serializers.ModelSerializer):
     product_special_intervals = ProductSpecialIntervalSerializer(many=True)
 
 
-def condition_constructor(start_time, end_time):
-
-    universal_query = Q(start_datetime__lt=end_time) & Q(
-        end_datetime__gt=start_time)
-
-    return universal_query
-
-
-def count_of_weekends(start_time, end_time):
+ALREADY_BOOKED_MESSAGE = 'Похоже, что кто то уже забронировал этот товар на введённое вами время'
+CART_LINE_MESSAGES = {
+    cart_validation.UNAVAILABLE: 'Товар недоступен',
+    dependencies.REQUIRED_MISSING: 'Бронь этого товара невозможна без брони основного',
+    dependencies.REQUIRED_INTERVAL: 'Вы не можете забронировать товар на больший интервал, чем основной товар',
+    cart_validation.CART_OVERLAP: 'Время брони этого объекта пересекается с таким же объектом, который у вас уже в корзине',
+    cart_validation.BOOKED: ALREADY_BOOKED_MESSAGE,
+    cart_validation.INVALID_DATES: 'Некорректный ввод даты',
+}
 
-    weekends = 0
 
-    for day in range(1, (end_time - start_time).days + 1):
-        if (start_time + timedelta(days=day)).weekday() > 4:
-            weekends += 1
-
-    return weekends
-
-
-def overlapping(r1_start_time, r1_end_time, r2_start_time, r2_end_time, days=True):
-    delta = 0
-
-    latest_start = max(r1_start_time, r2_start_time)
-    earliest_end = min(r1_end_time, r2_end_time)
-    delta = (earliest_end - latest_start)
-    difference = delta.days if days else delta.seconds // 3600
-
-    return difference
-
-
-def getStartEnd(start, end, use_hotel_booking_time):
-    return [start.replace(hour=14, minute=0, second=0, microsecond=0), end.replace(hour=12, minute=0, second=0, microsecond=0), end.replace(hour=14, minute=0, second=0, microsecond=0)] if use_hotel_booking_time else [start, end, end]
-
-
-def is_time_in_range(start, end, x):
-    if start <= end:
-        return start <= x <= end
-    else:
-        return start <= x or x <= end
+@contextmanager
+def booking_conflict_as_validation_error(product_id=None):
+    """ Concurrent checkouts can both pass the availability query, the exclusion constraint rejects the second one """
+    try:
+        with transaction.atomic():
+            yield
+    except IntegrityError as error:
+        if BOOKING_EXCLUSION_CONSTRAINT not in str(error):
+            raise
+        detail = {'message': ALREADY_BOOKED_MESSAGE}
+        if product_id is not None:
+            detail['product_id'] = product_id
+        raise serializers.ValidationError(detail)
 
 
 def calculateProductTotalPrice(start, end, fixed_end, product, quantity, error_message, order_item_pk=None, info=False):
 
-    if OrderItem.objects.exclude(order__status='F').filter(product=product).exclude(pk=order_item_pk).filter(condition_constructor(start, end)).exists():
-        raise serializers.ValidationError(
-            {'product_id': product.pk, 'message': 'Похоже, что кто то уже забронировал этот товар на введённое вами время'})
-
-    unit_price = product.unit_price
-    time_unit = product.time_unit
-    min_unit = product.min_unit
-    max_unit = product.max_unit
-    min_hour = product.min_hour
-    max_hour = product.max_hour
-    use_hotel_booking_time = product.use_hotel_booking_time
-
-    # product total price calculator
-    time_difference = fixed_end - start
-
-    if time_unit == 'H':
-        seconds = 3600
-        units = int(time_difference.seconds / 3600)
-    else:
-        seconds = (60*60*24)
-        units = time_difference.days
-
-    if (time_difference.seconds % seconds != 0) or \
-        (not use_hotel_booking_time and (not is_time_in_range(min_hour, max_hour, start.time()) or
-                                         not is_time_in_range(min_hour, max_hour, end.time()))) or \
-            (start >= end) or (units < min_unit) or (units > max_unit):
+    if active_order_items().filter(product=product).exclude(pk=order_item_pk).filter(condition_constructor(start, end)).exists():
         raise serializers.ValidationError(
-            {'product_id': product.pk, 'message': error_message})
-
-    extra_price = 0
-    interval_queryset = ProductSpecialInterval.objects.filter(
-        condition_constructor(start, end)).filter(product=product)
-    weekends_queryset = ProductSpecialInterval.objects.filter(
-        is_weekends=True, product=product)
-    if interval_queryset.exists():
-        interval = interval_queryset.get()
-        interval_start = interval.start_datetime
-        interval_end = interval.end_datetime
-
-        if time_unit == 'H':
-            extra_price += interval.additional_price_per_unit * \
-                overlapping(interval_start, interval_end,
-                            start, fixed_end, days=False)
-        else:
-            extra_price += overlapping(interval_start, interval_end,
-                                       start, fixed_end) * interval.additional_price_per_unit
-            if weekends_queryset.exists():
-                weekends_price = weekends_queryset.get()
-                interval_weekends = count_of_weekends(
-                    interval_start, interval_end)
-                user_weekends = count_of_weekends(start, fixed_end)
-                extra_price += weekends_price.additional_price_per_unit * \
-                    max(0, (user_weekends - interval_weekends))
-
-    elif weekends_queryset.exists():
-        weekends_price = weekends_queryset.get()
-        if time_unit == 'H' and start.weekday() > 4:
-            extra_price += weekends_price.additional_price_per_unit * units
-        elif time_unit == 'D':
-            extra_price += count_of_weekends(
-                start, fixed_end) * weekends_price.additional_price_per_unit
-
-    total_price = (unit_price * units + extra_price) * quantity
-    return total_price if not info else {'normal_price': unit_price * units * quantity, 'extra_price': extra_price * quantity, 'total_price': total_price}
-    # /product total price calculator
+            {'product_id': product.pk, 'message': ALREADY_BOOKED_MESSAGE})
+
+    return get_tariff(product).calculate(start, end, fixed_end, quantity, error_message, info)
 
 
 class GetProductPriceSerializer(serializers.ModelSerializer):
@@ -300,6 +290,57 @@ class GetProductPriceSerializer(serializers.ModelSerializer):
         return price_info
 
 
+class ProductPriceQuoteSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    start_datetime = serializers.DateTimeField()
+    end_datetime = serializers.DateTimeField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
+
+class GetProductsPricesSerializer(serializers.Serializer):
+    items = ProductPriceQuoteSerializer(
+        many=True, allow_empty=False, max_length=settings.MAX_QUOTE_ITEMS)
+
+    def save(self, **kwargs):
+        items = self.validated_data['items']
+        products = Product.objects.in_bulk(
+            {item['product_id'] for item in items})
+        tariffs = get_tariffs(products.values())
+
+        windows = {}
+        for index, item in enumerate(items):
+            product = products.get(item['product_id'])
+            if product:
+                windows[index] = getStartEnd(
+                    item['start_datetime'], item['end_datetime'], product.use_hotel_booking_time)
+
+        checked = list(windows)
+        conflicts = find_conflicts(
+            [(items[index]['product_id'], *windows[index][:2]) for index in checked])
+        booked = {checked[position] for position in conflicts}
+
+        prices = []
+        for index, item in enumerate(items):
+            product_id = item['product_id']
+            if index not in windows:
+                prices.append(
+                    {'product_id': product_id, 'message': 'Товар не найден'})
+            elif index in booked:
+                prices.append(
+                    {'product_id': product_id, 'message': ALREADY_BOOKED_MESSAGE})
+            else:
+                start, end, fixed_end = windows[index]
+                try:
+                    price_info = tariffs[product_id].calculate(
+                        start, end, fixed_end, item['quantity'], 'Некорректный ввод даты', info=True)
+                    prices.append({'product_id': product_id, **price_info})
+                except serializers.ValidationError as error:
+                    prices.append(
+                        {'product_id': product_id, 'message': error.detail['message']})
+
+        return prices
+
+
 class OrderItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = OrderItem
@@ -334,11 +375,39 @@ class OrderItemTimeSerializer(serializers.Serializer):
         current_datetime = self.validated_data['current_datetime']
         exclude_order_item_id = self.validated_data['exclude_order_item_id']
         product_id = self.context['product_id']
-        queryset = OrderItem.objects.filter(
+        queryset = active_order_items().filter(
             end_datetime__gt=current_datetime, product_id=product_id).exclude(pk=exclude_order_item_id)
         return OrderItemTimeInnerSerializer(queryset, many=True).data
 
 
+class ProductAvailabilitySerializer(serializers.Serializer):
+    MAX_BUCKETS = 24 * 62
+
+    start_datetime = serializers.DateTimeField()
+    end_datetime = serializers.DateTimeField()
+
+    def validate(self, data):
+        if data['start_datetime'] >= data['end_datetime']:
+            raise serializers.ValidationError(
+                {'message': 'Некорректный ввод даты'})
+        return data
+
+    def save(self, **kwargs):
+        product_id = self.context['product_id']
+        product = get_object_or_404(Product.objects.only(
+            'time_unit', 'use_hotel_booking_time'), pk=product_id)
+        start = self.validated_data['start_datetime']
+        end = self.validated_data['end_datetime']
+
+        if (end - start) / availability.bucket_step(product) > self.MAX_BUCKETS:
+            raise serializers.ValidationError(
+                {'message': 'Слишком большой интервал'})
+
+        buckets, bitmap = availability.bitmap(product, start, end)
+
+        return {'time_unit': product.time_unit, 'first_bucket': buckets[0] if buckets else None, 'bitmap': bitmap}
+
+
 class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
@@ -356,10 +425,11 @@ class CreateOrderSerializer(serializers.ModelSerializer):
     agreement = serializers.BooleanField()
 
     def validate_cart_id(self, cart_id):
-        if not Cart.objects.filter(pk=cart_id).exists():
+        self.cart = cart_store.get_store().get(cart_id)
+        if self.cart is None:
             raise serializers.ValidationError({
                 'message': 'Корзина не найдена'})
-        if not CartItem.objects.filter(cart_id=cart_id).exists():
+        if not self.cart.cart_items:
             raise serializers.ValidationError({'message': 'Корзина пуста'})
         return cart_id
 
@@ -371,70 +441,49 @@ class CreateOrderSerializer(serializers.ModelSerializer):
 
     def save(self, **kwargs):
 
-        cart_id = self.validated_data['cart_id']
         phone = self.validated_data['phone']
         name = self.validated_data['name'].capitalize()
 
-        cart = get_object_or_404(Cart.objects.all(), pk=cart_id)
+        store = cart_store.get_store()
+        cart = self.cart
         cart_persons = cart.persons
-        queryset = CartItem.objects.filter(
-            cart=cart).select_related('product__required_product')
+        report = cart_validation.validate(cart)
 
         list_for_filling = []
         total = 0
         cart_items_total = 0
-        total_max_persons = 0
+        total_max_persons = report.max_persons
         cart_item_ids = []
+        drifted_cart_items = []
 
-        for cart_item in queryset:
+        for line in report.lines:
+            cart_item = line.item
             product = cart_item.product
 
-            use_hotel_booking_time = product.use_hotel_booking_time
-            required_product = product.required_product
-            max_persons = product.max_persons
-
-            start_dat = cart_item.start_datetime
-            end_dat = cart_item.end_datetime
-            quantity = cart_item.quantity
-            price = cart_item.price
-
-            start, end, fixed_end = getStartEnd(
-                start_dat, end_dat, use_hotel_booking_time)
-
-            if not product.is_available:
-                raise serializers.ValidationError(
-                    {'product_id': product.pk, 'message': 'Товар недоступен'})
-
-            if (required_product):
-                required_product_cart_item = CartItem.objects.filter(
-                    cart_id=cart_id, product=required_product)
-                if not required_product_cart_item.exists():
+            if line.errors:
+                error = line.errors[0]
+                if error == dependencies.REQUIRED_MISSING:
                     raise serializers.ValidationError(
-                        {'product_id': required_product.pk, 'message': 'Бронь этого товара невозможна без брони основного'})
-
-                required_product_cart_item = required_product_cart_item.get()
-
-                if (start < required_product_cart_item.start_datetime) or (end > required_product_cart_item.end_datetime):
+                        {'product_id': product.required_product_id, 'message': CART_LINE_MESSAGES[error]})
+                if error == cart_validation.INVALID_DATES:
                     raise serializers.ValidationError(
-                        {'product_id': product.pk,
-                            'message': 'Вы не можете забронировать товар на больший интервал, чем основной товар'}
-                    )
-
-            total_price = calculateProductTotalPrice(
-                start, end, fixed_end, product, quantity, 'Условия брони изменились, пожалуйста, перебронируйте товар')
+                        {'product_id': product.pk, 'message': 'Условия брони изменились, пожалуйста, перебронируйте товар'})
+                raise serializers.ValidationError(
+                    {'product_id': product.pk, 'message': CART_LINE_MESSAGES[error]})
 
             list_for_filling.append(
-                {'product': product, 'start_datetime': start, 'end_datetime': end, 'total_price': total_price, 'quantity': quantity})
+                {'product': product, 'start_datetime': line.start, 'end_datetime': line.end, 'total_price': line.price, 'quantity': cart_item.quantity})
 
-            total += total_price
-            cart_items_total += price
-            if max_persons:
-                total_max_persons += max_persons
+            total += line.price
+            cart_items_total += cart_item.price
             cart_item_ids.append(product.pk)
 
-            if price != total_price:
-                cart_item.price = total_price
-                cart_item.save()
+            if line.price_changed:
+                cart_item.price = line.price
+                drifted_cart_items.append(cart_item)
+
+        if drifted_cart_items:
+            store.save_items(cart, drifted_cart_items)
 
         if total != cart_items_total:
             raise serializers.ValidationError(
@@ -460,22 +509,19 @@ class CreateOrderSerializer(serializers.ModelSerializer):
                 name=name, phone=phone, code=code, ip_address=self.context['ip'], persons=cart_persons, attempts_left=3, resends_left=3)
 
             list_for_creating = [
-                OrderItem(order=self.instance, **data) for data in list_for_filling]
-            OrderItem.objects.bulk_create(list_for_creating)
+                OrderItem(order=self.instance, order_status=self.instance.status, hold_expires_at=self.instance.hold_expires_at, **data) for data in list_for_filling]
+            with booking_conflict_as_validation_error():
+                release_expired([(data['product'].pk, data['start_datetime'], data['end_datetime'])
+                                 for data in list_for_filling])
+                OrderItem.objects.bulk_create(list_for_creating)
+            availability.refresh_items(list_for_creating)
 
-            cart.delete()
+            store.delete(cart)
 
-            if not settings.DEBUG:
-                smsApi = SmsAero(settings.SMSAERO_LOGIN,
-                                 settings.SMSAERO_API_KEY)
-                send = smsApi.send(
-                    phone, f'Forest House. Подтвердите бронирование. Код верификации: {code}')
+            queue_sms(
+                phone, f'Forest House. Подтвердите бронирование. Код верификации: {code}')
 
-            try:
-                sending = [send_push_message(tokenObj.push_token, 'Forest House', 'Поступил новый заказ!')
-                           for tokenObj in UserPushNotificationToken.objects.all()]
-            except:
-                pass
+            notify_admins('Forest House', 'Поступил новый заказ!')
 
             return self.instance
 
@@ -491,19 +537,27 @@ class VerifyOrderWithCodeSerializer(serializers.ModelSerializer):
         phone = self.validated_data['phone']
 
         try:
-            order = Order.objects.get(status='W', pk=order_id, phone=phone)
-            if order.code == code:
-                order.status = 'P'
-                order.save()
-                return {'status': status.HTTP_200_OK, 'message': 'Заказ принят'}
-            else:
-                order.attempts_left = order.attempts_left - 1
-                if order.attempts_left == 0:
-                    order.status = 'F'
+            # Locked so that a booking releasing this hold as expired waits for the verification, or the other way round
+            with transaction.atomic():
+                order = Order.objects.select_for_update().get(status='W', pk=order_id, phone=phone)
+                if order.code == code:
+                    # Once the hold ran out the dates may have been booked by someone else
+                    if order.hold_expires_at <= timezone.now() and find_conflicts(list(order.items.values_list('product_id', 'start_datetime', 'end_datetime'))):
+                        order.status = 'F'
+                        order.save()
+                        return {'status': status.HTTP_409_CONFLICT, 'message': 'Время подтверждения истекло, и за это время товар успели забронировать. Пожалуйста, оформите заказ заново'}
+                    with booking_conflict_as_validation_error():
+                        order.status = 'P'
+                        order.save()
+                    return {'status': status.HTTP_200_OK, 'message': 'Заказ принят'}
+                else:
+                    order.attempts_left = order.attempts_left - 1
+                    if order.attempts_left == 0:
+                        order.status = 'F'
+                        order.save()
+                        return {'status': status.HTTP_403_FORBIDDEN, 'message': 'Вы превысили количество попыток ввода верификационного кода. Заказ помечен как недействительный. Позвоните нам чтобы верифицировать заказ.'}
                     order.save()
-                    return {'status': status.HTTP_403_FORBIDDEN, 'message': 'Вы превысили количество попыток ввода верификационного кода. Заказ помечен как недействительный. Позвоните нам чтобы верифицировать заказ.'}
-                order.save()
-                return {'status': status.HTTP_400_BAD_REQUEST, 'message': 'Неверный код верификации'}
+                    return {'status': status.HTTP_400_BAD_REQUEST, 'message': 'Неверный код верификации'}
         except Order.DoesNotExist:
             return {'status': status.HTTP_403_FORBIDDEN, 'message':
                     'Заказ со статусом "Ожидает верификационный код" не найден'}
@@ -526,15 +580,13 @@ class GetNewOrderCodeSerializer(serializers.ModelSerializer):
             digits = '0123456789'
             code = ''.join(random.choices(digits, k=4))
 
-            if not settings.DEBUG:
-                smsApi = SmsAero(settings.SMSAERO_LOGIN,
-                                 settings.SMSAERO_API_KEY)
-                send = smsApi.send(
+            with transaction.atomic():
+                queue_sms(
                     order.phone, f'Forest House. Новый код верификации: {code}')
 
-            order.code = code
-            order.resends_left = order.resends_left - 1
-            order.save()
+                order.code = code
+                order.resends_left = order.resends_left - 1
+                order.save()
         except Order.DoesNotExist:
             raise serializers.ValidationError(
                 {'message': 'Заказ со статусом "Ожидает верификационный код" не найден'})
@@ -575,8 +627,10 @@ class CreateOrderItemSerializer(serializers.ModelSerializer):
         price = calculateProductTotalPrice(
             start, end, fixed_end, product, quantity, 'Некорректный ввод даты')
 
-        self.instance = OrderItem.objects.create(
-            order=order, product=product, start_datetime=start, end_datetime=end, quantity=quantity, total_price=price)
+        with booking_conflict_as_validation_error(product.pk):
+            release_expired([(product.pk, start, end)])
+            self.instance = OrderItem.objects.create(
+                order=order, product=product, start_datetime=start, end_datetime=end, quantity=quantity, total_price=price)
         return self.instance
 
 
@@ -604,7 +658,9 @@ class UpdateOrderItemSerializer(serializers.ModelSerializer):
         order_item.start_datetime = start
         order_item.end_datetime = end
         order_item.total_price = price
-        order_item.save()
+        with booking_conflict_as_validation_error(product.pk):
+            release_expired([(product.pk, start, end)])
+            order_item.save()
 
         self.instance = order_item
         return self.instance
@@ -627,13 +683,10 @@ class CreateCartItemSerializer(serializers.ModelSerializer):
     def validate(self, data):
         data = super().validate(data)
 
-        cart_id = self.context['cart_id']
+        cart = self.context['cart']
         context_instance = self.context.get('instance')
-
-        try:
-            Cart.objects.get(pk=cart_id)
-        except Cart.DoesNotExist:
-            raise serializers.ValidationError({'message': 'Такой корзины нет'})
+        other_items = [item for item in cart.cart_items if (
+            context_instance is None or item.pk != context_instance.pk)]
 
         product = data['product']
         start = data['start_datetime']
@@ -641,25 +694,23 @@ class CreateCartItemSerializer(serializers.ModelSerializer):
         quantity = data['quantity']
         start, end, fixed_end = getStartEnd(
             start, end, product.use_hotel_booking_time)
-        required_product = product.required_product
+        graph = dependencies.get_graph()
+        required_product_id = graph.parent(product.pk)
 
         if not product.is_available:
             raise serializers.ValidationError({'message': 'Товар недоступен'})
 
-        if required_product:
-            if not CartItem.objects.filter(cart_id=cart_id, product=required_product).exists():
+        if required_product_id:
+            error = graph.check_containment([(None, product.pk, start, end)] + [(item.pk, item.product_id, item.start_datetime, item.end_datetime)
+                                                                                for item in other_items if item.product_id == required_product_id]).get(None)
+            if error == dependencies.REQUIRED_MISSING:
                 raise serializers.ValidationError(
-                    {'product_id': required_product.pk, 'message': 'Бронь этого товара невозможна без брони основного'})
-
-            required_product_cart_item = CartItem.objects.get(
-                cart_id=cart_id, product=required_product)
-            if (start < required_product_cart_item.start_datetime) or (end > required_product_cart_item.end_datetime):
+                    {'product_id': required_product_id, 'message': CART_LINE_MESSAGES[error]})
+            if error == dependencies.REQUIRED_INTERVAL:
                 raise serializers.ValidationError(
-                    {'product_id': product.pk,
-                        'message': 'Вы не можете забронировать товар на больший интервал, чем основной товар'}
-                )
+                    {'product_id': product.pk, 'message': CART_LINE_MESSAGES[error]})
 
-        if CartItem.objects.filter(cart_id=cart_id, product=product).exclude(pk=(context_instance.pk if context_instance else None)).filter(condition_constructor(start, end)).exists():
+        if any(item.product_id == product.pk and item.start_datetime < end and item.end_datetime > start for item in other_items):
             raise serializers.ValidationError(
                 {'product_id': product.pk, 'message': 'Время брони этого объекта пересекается с таким же объектом, который у вас уже в корзине'})
 
@@ -671,7 +722,7 @@ class CreateCartItemSerializer(serializers.ModelSerializer):
         return data
 
     def save(self, **kwargs):
-        cart_id = self.context['cart_id']
+        cart = self.context['cart']
         context_instance = self.context.get('instance')
         product = self.validated_data['product']
         start = self.validated_data['start']
@@ -685,11 +736,11 @@ class CreateCartItemSerializer(serializers.ModelSerializer):
             self.instance.end_datetime = end
             self.instance.price = price
             self.instance.quantity = quantity
-            self.instance.save()
-            return self.instance
+        else:
+            self.instance = CartItem(
+                product=product, start_datetime=start, end_datetime=end, price=price, quantity=quantity)
 
-        self.instance = CartItem.objects.create(
-            cart_id=cart_id, product=product, start_datetime=start, end_datetime=end, price=price, quantity=quantity)
+        cart_store.get_store().save_items(cart, [self.instance])
         return self.instance
 
 
@@ -703,29 +754,28 @@ class UpdateCartItemSerializer(serializers.ModelSerializer):
     product = ProductSerializer(read_only=True)
 
     def save(self, **kwargs):
-        with transaction.atomic():
-            cart_item = self.instance
-            start = self.validated_data['start_datetime']
-            end = self.validated_data['end_datetime']
-            quantity = self.validated_data['quantity']
-            cart = cart_item.cart
-            product = cart_item.product
+        cart_item = self.instance
+        start = self.validated_data['start_datetime']
+        end = self.validated_data['end_datetime']
+        quantity = self.validated_data['quantity']
+        product = cart_item.product
 
-            serializer = CreateCartItemSerializer(
-                data={'product': product.pk, 'start_datetime': start, 'end_datetime': end, 'quantity': quantity}, context={'cart_id': cart.pk, 'instance': cart_item})
-            serializer.is_valid(raise_exception=True)
-            self.instance = serializer.save()
+        serializer = CreateCartItemSerializer(
+            data={'product': product.pk, 'start_datetime': start, 'end_datetime': end, 'quantity': quantity}, context={'cart': self.context['cart'], 'instance': cart_item})
+        serializer.is_valid(raise_exception=True)
+        self.instance = serializer.save()
 
-            return self.instance
+        return self.instance
 
 
 class CartSerializer(serializers.ModelSerializer):
     class Meta:
         model = Cart
-        fields = '__all__'
+        fields = ['id', 'persons', 'items']
         read_only_fields = ['id']
 
-    items = CartItemSerializer(many=True, read_only=True)
+    items = CartItemSerializer(
+        many=True, read_only=True, source='cart_items')
 
     def save(self, **kwargs):
         persons = self.validated_data['persons']
@@ -736,11 +786,12 @@ class CartSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(
                 {'message': f'Максимально возможное заселение: {query_total_max} чел.'})
 
+        store = cart_store.get_store()
         if self.instance:
             self.instance.persons = persons
-            self.instance.save()
+            store.save_cart(self.instance)
         else:
-            self.instance = Cart.objects.create(**self.validated_data)
+            self.instance = store.create(persons)
 
         return self.instance
 
@@ -769,12 +820,14 @@ class GetAllowedIntervalInCart(serializers.Serializer):
     product_id = serializers.IntegerField()
 
     def save(self, **kwargs):
-        cart_id = self.context['cart_id']
+        cart = self.context['cart']
         product_id = self.validated_data['product_id']
-        cart = get_object_or_404(Cart.objects.all(), pk=cart_id)
         product = get_object_or_404(Product.objects.all(), pk=product_id)
-        required_cart_item = get_object_or_404(
-            CartItem.objects.all(), cart=cart, product_id=product.required_product)
+        required_product_id = dependencies.get_graph().parent(product.pk)
+        required_cart_item = next(
+            (item for item in cart.cart_items if item.product_id == required_product_id), None)
+        if required_cart_item is None:
+            raise Http404
         start_datetime = required_cart_item.start_datetime
         end_datetime = required_cart_item.end_datetime
 
@@ -798,7 +851,7 @@ class GetAllowedIntervalInOrder(serializers.Serializer):
         order = get_object_or_404(Order.objects.all(), pk=order_id)
         product = get_object_or_404(Product.objects.all(), pk=product_id)
         required_order_item = get_object_or_404(
-            OrderItem.objects.all(), order=order, product_id=product.required_product)
+            OrderItem.objects.all(), order=order, product_id=dependencies.get_graph().parent(product.pk))
         start_datetime = required_order_item.start_datetime
         end_datetime = required_order_item.end_datetime
 
@@ -813,76 +866,62 @@ class GetAllowedIntervalInOrder(serializers.Serializer):
         return {'start_datetime': start_datetime, 'end_datetime': end_datetime}
 
 
+def cart_line_report(line):
+    return {
+        'cart_item_id': line.item.pk,
+        'product_id': line.item.product_id,
+        'price': line.item.price,
+        'actual_price': line.price,
+        'price_changed': line.price_changed,
+        'errors': [{'code': error, 'message': CART_LINE_MESSAGES[error]} for error in line.errors],
+    }
+
+
 class CheckAffectedInCart(serializers.Serializer):
     def save(self, **kwargs):
-        cart_id = self.context['cart_id']
-        cart = get_object_or_404(Cart.objects.all(), pk=cart_id)
-        cart_items = CartItem.objects.filter(cart=cart)
-        invalid_cart_item_ids = []
-        empty_cart_item_ids = []
-        for item in cart_items.exclude(product__required_product=None):
-            try:
-                required_cart_item = cart_items.get(
-                    product=item.product.required_product)
-                if item.start_datetime < required_cart_item.start_datetime or item.end_datetime > required_cart_item.end_datetime:
-                    invalid_cart_item_ids.append(item.pk)
-            except CartItem.DoesNotExist:
-                empty_cart_item_ids.append(item.pk)
-
-        if len(empty_cart_item_ids) > 0:
-            return {'cart_item_ids': empty_cart_item_ids, 'required_product_id': item.product.required_product.pk, 'message': 'Отсутствует необходимый товар'}
-
-        if len(invalid_cart_item_ids) > 0:
-            return {'cart_item_ids': invalid_cart_item_ids, 'message': 'Забронирован на больший интервал чем основной товар'}
+        report = cart_validation.validate(self.context['cart'])
+
+        empty_lines = report.invalid_lines(dependencies.REQUIRED_MISSING)
+        if len(empty_lines) > 0:
+            return {'cart_item_ids': [line.item.pk for line in empty_lines], 'required_product_id': dependencies.get_graph().parent(empty_lines[-1].item.product_id), 'message': 'Отсутствует необходимый товар'}
+
+        invalid_lines = report.invalid_lines(
+            dependencies.REQUIRED_INTERVAL)
+        if len(invalid_lines) > 0:
+            return {'cart_item_ids': [line.item.pk for line in invalid_lines], 'message': 'Забронирован на больший интервал чем основной товар'}
 
         return {'not_found': True}
 
 
 class IsCartValid(serializers.Serializer):
     def save(self, **kwargs):
-        cart_id = self.context['cart_id']
-        cart = get_object_or_404(Cart.objects.all(), pk=cart_id)
-        cart_items = CartItem.objects.filter(cart=cart)
-        cart_persons = cart.persons
-        invalid_cart_item_ids = []
-        total_max_persons = 0
-        for item in cart_items:
-            serializer = CreateCartItemSerializer(
-                data={'product': item.product.pk, 'start_datetime': item.start_datetime, 'end_datetime': item.end_datetime, 'quantity': item.quantity}, context={'cart_id': cart.pk, 'instance': item})
-
-            if not serializer.is_valid():
-                invalid_cart_item_ids.append(item.pk)
+        report = cart_validation.validate(self.context['cart'])
+        items = [cart_line_report(line) for line in report.lines]
+        invalid_lines = report.invalid_lines()
 
-            max_persons = item.product.max_persons
-            if max_persons:
-                total_max_persons += max_persons
-
-        if cart_persons > total_max_persons:
-            return {'is_valid': False, 'message': 'В вашей корзине не хватает спальных мест'}
-        if len(invalid_cart_item_ids) > 0:
-            return {'is_valid': False, 'message': 'Некорректное заполнение дат', 'cart_item_ids': invalid_cart_item_ids}
+        if report.persons > report.max_persons:
+            return {'is_valid': False, 'message': 'В вашей корзине не хватает спальных мест', 'items': items}
+        if len(invalid_lines) > 0:
+            return {'is_valid': False, 'message': 'Некорректное заполнение дат', 'cart_item_ids': [line.item.pk for line in invalid_lines], 'items': items}
 
-        return {'is_valid': True}
+        return {'is_valid': True, 'items': items}
 
 
 class CheckAffectedInOrder(serializers.Serializer):
     def save(self, **kwargs):
         order_id = self.context['order_id']
         order = get_object_or_404(Order.objects.all(), pk=order_id)
-        order_items = OrderItem.objects.filter(order=order)
-        invalid_order_item_ids = []
-        empty_order_item_ids = []
-        for item in order_items.exclude(product__required_product=None):
-            try:
-                required_order_item = order_items.get(
-                    product=item.product.required_product)
-                if item.start_datetime < required_order_item.start_datetime or item.end_datetime > required_order_item.end_datetime:
-                    invalid_order_item_ids.append(item.pk)
-            except CartItem.DoesNotExist:
-                empty_order_item_ids.append(item.pk)
-
-        if len(empty_order_item_ids) > 0:
-            return {'order_item_ids': empty_order_item_ids, 'required_product_id': item.product.required_product.pk, 'message': 'Отсутствует необходимый товар'}
+        order_items = list(OrderItem.objects.filter(order=order).order_by('pk'))
+        graph = dependencies.get_graph()
+        errors = graph.check_containment(
+            (item.pk, item.product_id, item.start_datetime, item.end_datetime) for item in order_items)
+        invalid_order_item_ids = [item.pk for item in order_items
+                                  if errors.get(item.pk) == dependencies.REQUIRED_INTERVAL]
+        empty_order_items = [item for item in order_items
+                             if errors.get(item.pk) == dependencies.REQUIRED_MISSING]
+
+        if len(empty_order_items) > 0:
+            return {'order_item_ids': [item.pk for item in empty_order_items], 'required_product_id': graph.parent(empty_order_items[-1].product_id), 'message': 'Отсутствует необходимый товар'}
 
         if len(invalid_order_item_ids) > 0:
             return {'order_item_ids': invalid_order_item_ids, 'message': 'Забронирован на больший интервал чем основной товар'}
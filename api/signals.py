@@ -0,0 +1,72 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api import availability, catalogue, dependencies
+from api.files import in_bulk_deletion, queue_deletion
+from api.images import unused_variant_names
+from api.models import Order, OrderItem, Product, ProductFile, ProductSpecialInterval
+from api.pricing import touch
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_dependency_graph(sender, instance, **kwargs):
+    dependencies.invalidate()
+
+
+@receiver(post_save, sender=ProductSpecialInterval)
+@receiver(post_delete, sender=ProductSpecialInterval)
+def invalidate_interval_tariff(sender, instance, **kwargs):
+    touch(instance.product_id)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=ProductFile)
+@receiver(post_delete, sender=ProductFile)
+@receiver(post_save, sender=ProductSpecialInterval)
+@receiver(post_delete, sender=ProductSpecialInterval)
+def invalidate_catalogue(sender, instance, **kwargs):
+    catalogue.invalidate()
+
+
+@receiver(post_save, sender=Product)
+def rebuild_product_availability(sender, instance, created, **kwargs):
+    time_unit = (instance.time_unit, instance.use_hotel_booking_time)
+    if not created and getattr(instance, '_loaded_time_unit', None) != time_unit:
+        availability.rebuild(instance)
+    instance._loaded_time_unit = time_unit
+
+
+@receiver(post_save, sender=OrderItem)
+def refresh_order_item_availability(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_booking', None)
+    if loaded and loaded != (instance.product_id, instance.start_datetime, instance.end_datetime):
+        product_id, start, end = loaded
+        if product_id != instance.product_id:
+            availability.refresh(Product.objects.get(pk=product_id), start, end)
+        else:
+            availability.refresh(instance.product, start, end)
+    availability.refresh(
+        instance.product, instance.start_datetime, instance.end_datetime)
+    instance._loaded_booking = (
+        instance.product_id, instance.start_datetime, instance.end_datetime)
+
+
+@receiver(post_delete, sender=OrderItem)
+def release_order_item_availability(sender, instance, **kwargs):
+    availability.refresh(
+        instance.product, instance.start_datetime, instance.end_datetime)
+
+
+@receiver(post_save, sender=Order)
+def refresh_order_availability(sender, instance, created, **kwargs):
+    if not created and getattr(instance, '_loaded_status', None) != instance.status:
+        availability.refresh_items(instance.items.select_related('product'))
+    instance._loaded_status = instance.status
+
+
+@receiver(post_delete, sender=ProductFile)
+def delete_image_variants(sender, instance, **kwargs):
+    if not in_bulk_deletion():
+        queue_deletion(unused_variant_names([instance]))
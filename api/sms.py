@@ -0,0 +1,86 @@
+""" Outbox for text messages: requests only queue a row, the sms_worker command sends them. """
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from api.models import SmsMessage
+from api.smsaero import SmsAero
+
+
+class SmsAeroGateway(object):
+    def __init__(self):
+        self.client = SmsAero(settings.SMSAERO_LOGIN, settings.SMSAERO_API_KEY, timeout=settings.SMS_TIMEOUT)
+
+    def send(self, numbers, text):
+        self.client.send(numbers if len(numbers) > 1 else numbers[0], text)
+
+
+class FakeGateway(object):
+    """ Keeps messages in memory instead of sending them, for development and offline load tests """
+    sent = []
+
+    def send(self, numbers, text):
+        FakeGateway.sent.append((list(numbers), text))
+
+
+def get_gateway():
+    return import_string(settings.SMS_GATEWAY)()
+
+
+def queue_sms(phone, text):
+    return SmsMessage.objects.create(phone=phone, text=text)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=settings.SMS_RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def claim(batch_size):
+    """ Messages that are due, grouped by text and leased to this worker until the gateway had its timeout for every
+    group. Committed before anything is sent, so the gateway calls hold neither row locks nor a transaction. """
+    now = timezone.now()
+    with transaction.atomic():
+        messages = list(SmsMessage.objects.select_for_update(skip_locked=True).filter(
+            status=SmsMessage.STATUS_PENDING, next_attempt_at__lte=now).order_by('next_attempt_at')[:batch_size])
+
+        by_text = {}
+        for message in messages:
+            by_text.setdefault(message.text, []).append(message)
+
+        lease = now + timedelta(seconds=settings.SMS_TIMEOUT * (len(by_text) + 1))
+        for message in messages:
+            # Counted up front, a worker dying mid-send still uses up an attempt
+            message.attempts += 1
+            message.next_attempt_at = lease
+        SmsMessage.objects.bulk_update(messages, ['attempts', 'next_attempt_at'])
+    return by_text
+
+
+def dispatch_batch(gateway, batch_size=None):
+    """ Send the messages that are due, one gateway call per distinct text. Returns how many were processed. """
+    by_text = claim(batch_size or settings.SMS_BATCH_SIZE)
+
+    messages = []
+    for text, group in by_text.items():
+        try:
+            gateway.send([message.phone for message in group], text)
+        except Exception as error:
+            # Anything raised must not keep the groups already sent from being recorded, they would be sent again
+            now = timezone.now()
+            for message in group:
+                message.last_error = f'{type(error).__name__}: {error}'
+                message.next_attempt_at = now + retry_delay(message.attempts)
+                if message.attempts >= settings.SMS_MAX_ATTEMPTS:
+                    message.status = SmsMessage.STATUS_FAILED
+        else:
+            now = timezone.now()
+            for message in group:
+                message.status = SmsMessage.STATUS_SENT
+                message.sent_at = now
+        messages += group
+
+    SmsMessage.objects.bulk_update(
+        messages, ['status', 'last_error', 'next_attempt_at', 'sent_at'])
+    return len(messages)
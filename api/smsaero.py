@@ -24,7 +24,8 @@ class SmsAero(object):
             self, email, api_key,
             url_gate=URL_GATE,
             signature=SIGNATURE,
-            type_send=TYPE_SEND
+            type_send=TYPE_SEND,
+            timeout=None
     ):
         self.email = email
         self.api_key = api_key
@@ -33,6 +34,7 @@ class SmsAero(object):
             quote_plus(email), api_key, url_gate)
         self.signature = signature
         self.type_send = type_send
+        self.timeout = timeout
         self.session = requests.session()
 
     def _request(self, selector, data=None, page=None):
@@ -40,7 +42,7 @@ class SmsAero(object):
         if page:
             url = urljoin(url, "?page={}".format(page))
         try:
-            response = self.session.post(url, json=data or {})
+            response = self.session.post(url, json=data or {}, timeout=self.timeout)
         except requests.RequestException as err:
             raise SmsAeroHTTPError(err)
         return self._check_response(response.content)
@@ -64,7 +66,7 @@ class SmsAero(object):
                 raise SmsAeroError(response['result'])
             return response
         except ValueError:
-            if 'incorrect language' in content:
+            if b'incorrect language' in content:
                 raise SmsAeroError("incorrect language in '...' use \
                     the cyrillic or roman alphabet.")
             else:
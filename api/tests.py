@@ -1,3 +1,1163 @@
+import tempfile
+from importlib import import_module
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import mock, skipUnless
+from datetime import datetime, time, timedelta, timezone
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import QuerySet
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from exponent_server_sdk import PushClient, PushReceipt
+from PIL import Image
+from rest_framework import serializers
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from api import (benchmark, catalogue, cleanup, db_connections, db_router, dependencies, explain, files, images, uploads,
+                 versions)
+from api.cart_store import CacheCartStore, CartChanged, get_store
+from api.dates import count_of_weekends
+from api.db_router import ReplicaRouter
+from api.files import delete_batch
+from api.holds import active_order_items, expired, release_expired
+from api.images import hashed_name
+from api.models import (AvailabilitySlot, Cart, CartItem, FileDeletion, Order, OrderItem, Product, ProductFile, ProductSpecialInterval,
+                        PushNotificationTicket, SmsMessage, UserPushNotificationToken)
+from api.pagination import OrderPagination
+from api.postgresql.base import DatabaseWrapper
+from api.pricing import condition_constructor, find_conflicts, get_tariff, get_tariffs, getStartEnd
+from api.serializers import (ALREADY_BOOKED_MESSAGE, BOOKING_EXCLUSION_CONSTRAINT, DeleteProductFilesSerializer,
+                             booking_conflict_as_validation_error)
+from api.sms import FakeGateway, dispatch_batch, queue_sms
+from api.smsaero import SmsAero, SmsAeroError
+from api.utils import pushNotifications
+
+
+def create_house(**fields):
+    """ Daily product booked from check-in to check-out, the one most tests book """
+    return Product.objects.create(**{'title': 'House', 'unit_price': 1000, 'min_unit': 1, 'max_unit': 30,
+                                     'time_unit': Product.TIME_UNIT_DAY, 'use_hotel_booking_time': True, **fields})
+
+
+def create_sauna():
+    """ Hourly product open from 8 to 23 """
+    return Product.objects.create(title='Sauna', unit_price=300, min_unit=1, max_unit=6, time_unit=Product.TIME_UNIT_HOUR,
+                                  use_hotel_booking_time=False, min_hour=time(8), max_hour=time(23))
+
+
+def new_order(**fields):
+    """ Unsaved order of a guest, waiting for its code unless given another status """
+    return Order(**{'phone': '+79990000000', 'name': 'guest', 'code': '0000', 'attempts_left': 3, 'resends_left': 3,
+                    'persons': 1, 'ip_address': '127.0.0.1', **fields})
+
+
+def create_order(**fields):
+    order = new_order(**fields)
+    order.save()
+    return order
+
+
+class CheckoutQueryBudgetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def create_cart(self, size):
+        cart = Cart.objects.create(persons=1)
+        start = datetime(2030, 1, 1, 14, tzinfo=timezone.utc)
+        main_product = None
+        for index in range(size):
+            product = create_house(title=f'House {index}', max_persons=2,
+                                   required_product=main_product if index % 2 else None)
+            main_product = main_product or product
+            CartItem.objects.create(cart=cart, product=product, start_datetime=start,
+                                    end_datetime=start + timedelta(days=2, hours=-2), price=2000)
+        return cart
+
+    def checkout(self, cart):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/orders/', {
+                'cart_id': cart.pk, 'phone': '+79990000000', 'name': 'guest', 'agreement': True}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return len(queries)
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            small_cart = self.create_cart(2)
+        small = self.checkout(small_cart)
+        with self.captureOnCommitCallbacks(execute=True):
+            large_cart = self.create_cart(8)
+        large = self.checkout(large_cart)
+
+        self.assertEqual(small, large)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(Order.objects.last().items.count(), 8)
+
+    def test_drifted_prices_are_written_back(self):
+        cart = self.create_cart(3)
+        CartItem.objects.filter(cart=cart).update(price=1)
+
+        response = self.client.post('/api/orders/', {
+            'cart_id': cart.pk, 'phone': '+79990000000', 'name': 'guest', 'agreement': True}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            [cart_item.price for cart_item in get_store().get(cart.pk).cart_items], [2000] * 3)
+
+
+class BookingConflictTests(TestCase):
+    CONFLICT = f'conflicting key value violates exclusion constraint "{BOOKING_EXCLUSION_CONSTRAINT}"'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = create_house()
+        cls.start = datetime(2030, 1, 1, 14, tzinfo=timezone.utc)
+
+    def book(self, status, age=timedelta()):
+        order = Order.objects.bulk_create([new_order(status=status)])[0]
+        Order.objects.filter(pk=order.pk).update(created_at=datetime.now(timezone.utc) - age)
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=self.product, start_datetime=self.start,
+                                                 end_datetime=self.start + timedelta(days=2), total_price=2000, order_status=status)])
+        return order
+
+    def statuses(self, *orders):
+        return [Order.objects.get(pk=order.pk).status for order in orders]
+
+    def test_migration_resolves_overlaps_left_by_the_old_race(self):
+        migration = import_module('api.migrations.0059_orderitem_order_status')
+        schema_editor = mock.Mock(connection=connection)
+        constraint = next(constraint for constraint in OrderItem._meta.constraints
+                          if constraint.name == BOOKING_EXCLUSION_CONSTRAINT)
+        # Overlaps from before the constraint can only be set up without it, the test's transaction restores it
+        with connection.schema_editor() as editor:
+            editor.remove_constraint(OrderItem, constraint)
+        paid = self.book(Order.PAYMENT_STATUS_PENDING)
+        stale = self.book(Order.PAYMENT_STATUS_WAITING, timedelta(hours=2))
+        waiting = self.book(Order.PAYMENT_STATUS_WAITING)
+
+        migration.resolve_overlapping_bookings(django_apps, schema_editor)
+        self.assertEqual(self.statuses(paid, stale, waiting), [Order.PAYMENT_STATUS_PENDING] + [Order.PAYMENT_STATUS_FAILED] * 2)
+        self.assertFalse(OrderItem.objects.filter(order__in=[stale, waiting]).exclude(order_status=Order.PAYMENT_STATUS_FAILED).exists())
+        # The constraint can be added over what is left, once the deferred foreign key checks have run
+        connection.check_constraints()
+        with connection.schema_editor() as editor:
+            editor.add_constraint(OrderItem, constraint)
+            editor.remove_constraint(OrderItem, constraint)
+
+        self.book(Order.PAYMENT_STATUS_COMPLETE)
+        with self.assertRaisesRegex(RuntimeError, f'item {paid.items.get().pk} of order {paid.pk}'):
+            migration.resolve_overlapping_bookings(django_apps, schema_editor)
+
+    def test_constraint_violations_are_validation_errors(self):
+        with self.assertRaises(serializers.ValidationError) as raised, booking_conflict_as_validation_error(self.product.pk):
+            raise IntegrityError(self.CONFLICT)
+        self.assertEqual(raised.exception.detail['product_id'], str(self.product.pk))
+
+        with self.assertRaises(IntegrityError), booking_conflict_as_validation_error():
+            raise IntegrityError('duplicate key value violates unique constraint')
+
+    def test_reviving_a_failed_order_onto_taken_dates_is_rejected(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        failed = self.book(Order.PAYMENT_STATUS_FAILED)
+
+        with mock.patch.object(Order, 'save', side_effect=IntegrityError(self.CONFLICT)):
+            response = client.patch(f'/api/orders/{failed.pk}/', {'status': Order.PAYMENT_STATUS_PENDING}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['message'], ALREADY_BOOKED_MESSAGE)
+
+    @skipUnless(connection.vendor == 'postgresql', 'the exclusion constraint only exists on PostgreSQL')
+    def test_the_constraint_rejects_overlapping_bookings(self):
+        self.book(Order.PAYMENT_STATUS_PENDING)
+        failed = self.book(Order.PAYMENT_STATUS_FAILED)
+
+        with self.assertRaises(serializers.ValidationError), booking_conflict_as_validation_error():
+            failed.status = Order.PAYMENT_STATUS_PENDING
+            failed.save()
+
+
+class CountOfWeekendsTests(TestCase):
+    def test_counts_the_days_following_the_start(self):
+        # 2030-01-05 is a Saturday, 2030-01-07 a Monday
+        table = [
+            ('empty', datetime(2030, 1, 9, 14), datetime(2030, 1, 7, 14), 0),
+            ('within a day', datetime(2030, 1, 7, 12), datetime(2030, 1, 7, 18), 0),
+            ('weekdays only', datetime(2030, 1, 7, 14), datetime(2030, 1, 9, 12), 0),
+            ('short of a week', datetime(2030, 1, 7, 14), datetime(2030, 1, 14, 12), 2),
+            ('whole week', datetime(2030, 1, 7, 14), datetime(2030, 1, 14, 14), 2),
+            ('starts on Saturday', datetime(2030, 1, 5, 14), datetime(2030, 1, 6, 12), 0),
+            ('starts on Saturday, ends on Monday', datetime(2030, 1, 5, 14), datetime(2030, 1, 7, 12), 1),
+            ('ends on Saturday', datetime(2030, 1, 4, 14), datetime(2030, 1, 5, 14), 1),
+            ('ends on Sunday', datetime(2030, 1, 4, 14), datetime(2030, 1, 6, 14), 2),
+            ('several weeks', datetime(2030, 1, 3, 14), datetime(2030, 1, 26, 14), 7),
+            ('Sunday to Sunday over two months', datetime(2030, 1, 6, 14), datetime(2030, 3, 3, 14), 16),
+        ]
+        for name, start, end, weekends in table:
+            with self.subTest(name):
+                self.assertEqual(count_of_weekends(start, end), weekends)
+
+
+class AvailabilityCalendarTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.sauna = create_sauna()
+        cls.start = datetime(2030, 1, 1, 10, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.order = create_order(status=Order.PAYMENT_STATUS_PENDING)
+        self.item = OrderItem.objects.create(order=self.order, product=self.sauna, start_datetime=self.start + timedelta(hours=1),
+                                             end_datetime=self.start + timedelta(hours=3), total_price=600)
+
+    def bitmap(self):
+        """ Hours 10:00 - 16:00 """
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().post(f'/api/products/{self.sauna.pk}/availability/', {
+                'start_datetime': self.start, 'end_datetime': self.start + timedelta(hours=6)}, format='json')
+        self.assertFalse([query for query in queries if 'api_orderitem' in query['sql']])
+        self.assertEqual(response.data['first_bucket'], self.start)
+        return response.data['bitmap']
+
+    def test_bookings_are_followed_as_they_change(self):
+        self.assertEqual(self.bitmap(), '011000')
+
+        self.item.start_datetime += timedelta(hours=2)
+        self.item.end_datetime += timedelta(hours=2)
+        self.item.save()
+        self.assertEqual(self.bitmap(), '000110')
+
+        self.order.status = Order.PAYMENT_STATUS_FAILED
+        self.order.save()
+        self.assertEqual(self.bitmap(), '000000')
+
+        self.order.status = Order.PAYMENT_STATUS_COMPLETE
+        self.order.save()
+        self.assertEqual(self.bitmap(), '000110')
+
+        self.item.delete()
+        self.assertEqual(self.bitmap(), '000000')
+
+    def test_rebuilt_when_the_bucketing_changes(self):
+        self.sauna.time_unit = Product.TIME_UNIT_DAY
+        self.sauna.save()
+        self.assertEqual(list(AvailabilitySlot.objects.filter(product=self.sauna).values_list('bucket', 'bookings')),
+                         [(self.start.replace(hour=0), 1)])
+
+
+class CartValidationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        def product(title, **fields):
+            return create_house(title=title, max_persons=2, **fields)
+        cls.house = product('House')
+        cls.cottage = product('Cottage')
+        cls.closed = product('Closed', is_available=False)
+        cls.boat = product('Boat', required_product=cls.house)
+        cls.guide = product('Guide', required_product=product('Lodge'))
+        cls.start = datetime(2030, 1, 1, 14, tzinfo=timezone.utc)
+        order = create_order(status=Order.PAYMENT_STATUS_PENDING)
+        OrderItem.objects.create(order=order, product=cls.cottage, start_datetime=cls.start,
+                                 end_datetime=cls.start + timedelta(days=2), total_price=2000)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def cart(self, lines, persons=1):
+        store = get_store()
+        cart = store.create(persons=persons)
+        store.save_items(cart, [CartItem(product=product, start_datetime=self.start + timedelta(days=first),
+                                         end_datetime=self.start + timedelta(days=last), price=price)
+                                for product, first, last, price in lines])
+        return cart
+
+    def report(self, cart):
+        response = self.client.get(f'/api/carts/{cart.pk}/items/is_valid/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_every_line_gets_its_errors(self):
+        cart = self.cart([(self.house, 0, 2, 2000), (self.boat, 0, 1, 1),
+                          (self.boat, 4, 5, 1000), (self.house, 1, 3, 2000),
+                          (self.closed, 0, 1, 1000), (self.cottage, 0, 1, 1000),
+                          (self.guide, 0, 1, 1000), (self.house, 3, 2, 0)], persons=2)
+
+        report = self.report(cart)
+
+        self.assertFalse(report['is_valid'])
+        self.assertEqual([[error['code'] for error in line['errors']] for line in report['items']],
+                         [['cart_overlap'], [], ['required_interval'], ['cart_overlap'], ['unavailable'], ['booked'],
+                          ['required_missing'], ['invalid_dates']])
+        self.assertEqual(report['cart_item_ids'], [line['cart_item_id'] for line in report['items'] if line['errors']])
+        self.assertEqual([line['price_changed'] for line in report['items'][:3]], [False, True, False])
+        self.assertEqual(report['items'][1]['actual_price'], 1000)
+
+        affected = self.client.get(f'/api/carts/{cart.pk}/items/check_affected/')
+        self.assertEqual(affected.data['cart_item_ids'], [report['items'][6]['cart_item_id']])
+        self.assertEqual(affected.data['required_product_id'], self.guide.required_product_id)
+
+    def test_query_count_does_not_depend_on_cart_size(self):
+        def count(size):
+            cart = self.cart([(self.house, 3 * index, 3 * index + 2, 2000) for index in range(size)] +
+                             [(self.boat, 3 * index, 3 * index + 1, 1000) for index in range(size)])
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(self.report(cart)['is_valid'])
+            return len(queries)
+
+        self.assertEqual(count(1), count(6))
+
+
+class PriceQuoteTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.house = create_house()
+        ProductSpecialInterval.objects.create(product=cls.house, is_weekends=True, additional_price_per_unit=500)
+        cls.sauna = create_sauna()
+        # 2030-01-05 is a Saturday
+        cls.start = datetime(2030, 1, 4, 14, tzinfo=timezone.utc)
+        booked = cls.start + timedelta(weeks=1)
+        order = create_order(status=Order.PAYMENT_STATUS_PENDING)
+        OrderItem.objects.create(order=order, product=cls.house, start_datetime=booked,
+                                 end_datetime=booked + timedelta(days=2), total_price=3000)
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def quote(self, product_id, start, end, quantity=1):
+        return {'product_id': product_id, 'start_datetime': start, 'end_datetime': end, 'quantity': quantity}
+
+    def test_matches_the_single_product_price(self):
+        sauna_start = self.start.replace(hour=18)
+        items = [self.quote(self.house.pk, self.start, self.start + timedelta(days=3)),
+                 self.quote(self.sauna.pk, sauna_start, sauna_start + timedelta(hours=2), 2),
+                 self.quote(self.house.pk, self.start + timedelta(weeks=1), self.start + timedelta(weeks=1, days=1)),
+                 self.quote(self.sauna.pk, sauna_start, sauna_start + timedelta(hours=8)),
+                 self.quote(0, self.start, self.start + timedelta(days=1))]
+
+        response = self.client.post('/api/products/getPrices/', {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, 200, response.data)
+        for item, price in zip(items[:2], response.data):
+            single = self.client.post(f'/api/products/{item["product_id"]}/getPrice/', {
+                'start_datetime': item['start_datetime'], 'end_datetime': item['end_datetime'],
+                'quantity': item['quantity'], 'exclude_order_item_id': None}, format='json')
+            self.assertEqual(price, {'product_id': item['product_id'], **single.data})
+        self.assertEqual([price.get('message') for price in response.data[2:]],
+                         [ALREADY_BOOKED_MESSAGE, 'Некорректный ввод даты', 'Товар не найден'])
+
+    def test_weekends_beyond_a_seasonal_interval_are_charged(self):
+        # Monday to Monday, with two weekends inside
+        ProductSpecialInterval.objects.create(product=self.house, start_datetime=datetime(2030, 1, 7, tzinfo=timezone.utc),
+                                              end_datetime=datetime(2030, 1, 21, tzinfo=timezone.utc), additional_price_per_unit=200)
+        start, end, fixed_end = getStartEnd(self.start, self.start + timedelta(weeks=3), True)
+
+        price = get_tariff(Product.objects.get(pk=self.house.pk)).calculate(start, end, fixed_end, 1, '', info=True)
+
+        # 14 days of the interval, and 6 weekend days of the stay of which 4 fall within the interval
+        self.assertEqual(price['extra_price'], 14 * 200 + 2 * 500)
+        self.assertEqual(price['total_price'], 21 * 1000 + 3800)
+
+    def test_query_count_does_not_depend_on_the_number_of_lines(self):
+        def count(size):
+            items = [self.quote([self.house, self.sauna][index % 2].pk, self.start + timedelta(weeks=index),
+                                self.start + timedelta(weeks=index, hours=2 if index % 2 else 48)) for index in range(size)]
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/products/getPrices/', {'items': items}, format='json')
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        self.assertEqual(count(2), count(10))
+
+    def test_oversized_batches_are_rejected(self):
+        items = [self.quote(self.house.pk, self.start, self.start + timedelta(days=1))] * (settings.MAX_QUOTE_ITEMS + 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/products/getPrices/', {'items': items}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(queries), 0)
+
+
+class TariffCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.product = create_house()
+
+    def test_changes_reach_every_process(self):
+        """ Nothing is deleted from the cache, a worker still holding the old tariff reloads the product """
+        get_tariff(self.product)
+
+        ProductSpecialInterval.objects.create(product=self.product, is_weekends=True, additional_price_per_unit=500)
+        self.assertEqual(get_tariff(Product.objects.get(pk=self.product.pk)).weekends_price, 500)
+
+        product = Product.objects.get(pk=self.product.pk)
+        product.unit_price = 1500
+        product.save()
+        self.assertEqual(get_tariffs([Product.objects.get(pk=self.product.pk)])[self.product.pk].unit_price, 1500)
+
+
+class CatalogueTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = create_house()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_unchanged_catalogue_is_not_modified(self):
+        response = self.client.get('/api/products/catalogue/')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/api/products/catalogue/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(ALLOWED_HOSTS=['testserver', 'example.com'])
+    def test_thumbnails_are_absolute_urls_of_the_host_asked(self):
+        ProductFile.objects.create(product=self.product, file='files/a.jpg', file_thumbnail='files/thumbnails/a.jpg',
+                                   is_primary=True, variants={'webp': {'320': 'files/variants/a_320.webp'}})
+
+        for host in ['testserver', 'example.com']:
+            product = self.client.get('/api/products/catalogue/', HTTP_HOST=host).json()[0]
+            self.assertEqual(product['thumbnail'], f'http://{host}{settings.MEDIA_URL}files/thumbnails/a.jpg')
+            self.assertEqual(product['thumbnail_srcset'], {'webp': f'http://{host}{settings.MEDIA_URL}files/variants/a_320.webp 320w'})
+
+    def test_changes_reach_every_process(self):
+        """ The version lives in the database, a cached body of another process is never served again """
+        etag = self.client.get('/api/products/catalogue/')['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.title = 'Cottage'
+            self.product.save()
+
+        response = self.client.get('/api/products/catalogue/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()[0]['title'], 'Cottage')
+
+    def test_dependency_graph_follows_required_products(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            addon = Product.objects.create(
+                title='Sauna', unit_price=500, min_unit=1, max_unit=30, time_unit=Product.TIME_UNIT_HOUR,
+                use_hotel_booking_time=False)
+        self.assertIsNone(dependencies.get_graph().parent(addon.pk))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            addon.required_product = self.product
+            addon.save()
+        self.assertEqual(dependencies.get_graph().parent(addon.pk), self.product.pk)
+        self.assertEqual(dependencies.get_graph().dependents(self.product.pk), (addon.pk,))
+
+    def test_version_is_bumped_once_per_transaction(self):
+        version = versions.get(catalogue.VERSION)
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            for index in range(3):
+                ProductSpecialInterval.objects.create(
+                    product=self.product, is_weekends=True, additional_price_per_unit=index)
+        self.assertEqual(versions.get(catalogue.VERSION), version + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            catalogue.invalidate()
+        self.assertEqual(versions.get(catalogue.VERSION), version + 2)
+
+    def test_rolled_back_bumps_leave_the_others_to_run(self):
+        version = versions.get(catalogue.VERSION)
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            catalogue.invalidate()
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                catalogue.invalidate()
+                raise IntegrityError
+            catalogue.invalidate()
+        self.assertEqual(versions.get(catalogue.VERSION), version + 1)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'carts': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'carts'}})
+class CacheCartStoreTests(TestCase):
+    def setUp(self):
+        self.product = create_house()
+        self.store = CacheCartStore()
+        self.cart_id = self.store.create(1).pk
+
+    def item(self):
+        start = datetime(2030, 1, 1, 14, tzinfo=timezone.utc)
+        return CartItem(product=self.product, start_datetime=start, end_datetime=start + timedelta(days=1), price=1000)
+
+    def test_concurrent_changes_are_not_lost(self):
+        """ Two requests read the same cart, the one writing second has to start over """
+        first, second = self.store.get(self.cart_id), self.store.get(self.cart_id)
+
+        self.store.save_items(first, [self.item()])
+        with self.assertRaises(CartChanged):
+            self.store.save_items(second, [self.item()])
+
+        retried = self.store.get(self.cart_id)
+        self.store.save_items(retried, [self.item()])
+        self.assertEqual([item.pk for item in self.store.get(self.cart_id).cart_items], [1, 2])
+
+    def test_conflicts_are_reported_to_the_client(self):
+        stale = self.store.get(self.cart_id)
+        self.store.save_cart(self.store.get(self.cart_id))
+
+        with self.assertRaises(CartChanged) as raised:
+            self.store.delete_items(stale, [])
+        self.assertEqual(raised.exception.status_code, 409)
+
+
+class ExpireStaleTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = create_house()
+        cls.start = datetime(2030, 1, 1, 14, tzinfo=timezone.utc)
+
+    def cart(self, age):
+        cart = Cart.objects.create(persons=1)
+        CartItem.objects.create(cart=cart, product=self.product, start_datetime=self.start,
+                                end_datetime=self.start + timedelta(days=2), price=2000)
+        Cart.objects.filter(pk=cart.pk).update(created_at=datetime.now(timezone.utc) - age)
+        return cart
+
+    def order(self, status, hold_expires_at, week):
+        order = create_order(status=status, hold_expires_at=hold_expires_at)
+        start = self.start + timedelta(weeks=week)
+        OrderItem.objects.create(order=order, product=self.product, start_datetime=start,
+                                 end_datetime=start + timedelta(days=2), total_price=2000)
+        return order
+
+    def test_batches_follow_the_primary_key(self):
+        for _ in range(5):
+            self.cart(timedelta())
+        pks = sorted(Cart.objects.values_list('pk', flat=True))
+
+        self.assertEqual(list(cleanup.keyset_batches(Cart.objects.all(), 2)), [pks[:2], pks[2:4], pks[4:]])
+
+    def test_expired_carts_and_holds_are_reclaimed(self):
+        now = datetime.now(timezone.utc)
+        old_carts = [self.cart(timedelta(seconds=settings.CART_TTL + 60)) for _ in range(3)]
+        fresh_cart = self.cart(timedelta())
+        expired_orders = [self.order(Order.PAYMENT_STATUS_WAITING, now - timedelta(minutes=1), week)
+                          for week in range(3)]
+        held = self.order(Order.PAYMENT_STATUS_WAITING, now + timedelta(hours=1), 3)
+        paid = self.order(Order.PAYMENT_STATUS_PENDING, now - timedelta(minutes=1), 4)
+
+        metrics = cleanup.collect(batch_size=2)
+
+        self.assertEqual({name: value for name, value in metrics.items() if name != 'seconds'},
+                         {'carts': 3, 'cart_items': 3, 'orders': 3, 'order_items': 3})
+        self.assertFalse(Cart.objects.filter(pk__in=[cart.pk for cart in old_carts]).exists())
+        self.assertTrue(CartItem.objects.filter(cart=fresh_cart).exists())
+        self.assertEqual([Order.objects.get(pk=order.pk).status for order in expired_orders + [held, paid]],
+                         [Order.PAYMENT_STATUS_FAILED] * 3 + [Order.PAYMENT_STATUS_WAITING, Order.PAYMENT_STATUS_PENDING])
+        self.assertFalse(OrderItem.objects.filter(order__in=expired_orders).exclude(
+            order_status=Order.PAYMENT_STATUS_FAILED).exists())
+        # Only the live hold and the paid order keep their dates in the calendar
+        self.assertEqual(set(AvailabilitySlot.objects.filter(held_until__isnull=False).values_list('held_until', flat=True)),
+                         {held.hold_expires_at})
+        self.assertEqual(AvailabilitySlot.objects.filter(bookings__gt=0).count(), 2)
+
+
+class HoldExpiryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = create_house()
+        cls.start = datetime(2030, 1, 1, 14, tzinfo=timezone.utc)
+        cls.end = cls.start + timedelta(days=2)
+
+    def setUp(self):
+        self.now = datetime.now(timezone.utc)
+        self.order = create_order(hold_expires_at=self.now + timedelta(hours=1))
+        OrderItem.objects.create(order=self.order, product=self.product, start_datetime=self.start,
+                                 end_datetime=self.end, total_price=2000)
+
+    def views(self):
+        """ What the availability check, the calendar and the price quote make of the held dates """
+        client = APIClient()
+        calendar = client.post(f'/api/products/{self.product.pk}/availability/', {
+            'start_datetime': self.start, 'end_datetime': self.end}, format='json')
+        quote = client.post('/api/products/getPrices/', {'items': [{
+            'product_id': self.product.pk, 'start_datetime': self.start, 'end_datetime': self.end}]}, format='json')
+        return (find_conflicts([(self.product.pk, self.start, self.end)]), '1' in calendar.data['bitmap'],
+                quote.data[0].get('message'))
+
+    def test_expired_holds_are_free_before_anything_fails_them(self):
+        self.assertEqual(self.views(), ({0}, True, ALREADY_BOOKED_MESSAGE))
+
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(hours=2)):
+            self.assertEqual(self.views(), (set(), False, None))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAYMENT_STATUS_WAITING)
+
+    def test_expired_holds_are_released_before_booking(self):
+        window = (self.product.pk, self.start + timedelta(days=1), self.end + timedelta(days=1))
+        self.assertEqual(release_expired([window]), 0)
+
+        with mock.patch('django.utils.timezone.now', return_value=self.now + timedelta(hours=2)):
+            self.assertEqual(release_expired([(self.product.pk, self.end, self.end + timedelta(days=1))]), 0)
+            self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAYMENT_STATUS_WAITING)
+            self.assertEqual(release_expired([window]), 1)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAYMENT_STATUS_FAILED)
+        self.assertEqual(self.order.items.get().order_status, Order.PAYMENT_STATUS_FAILED)
+
+    def test_verifying_onto_taken_dates_is_a_conflict(self):
+        # As left by a booking that released the hold while its code was being checked
+        self.order.items.update(order_status=Order.PAYMENT_STATUS_FAILED)
+        paid = create_order(phone='+79990000001', status=Order.PAYMENT_STATUS_PENDING)
+        OrderItem.objects.create(order=paid, product=self.product, start_datetime=self.start,
+                                 end_datetime=self.end, total_price=2000)
+
+        response = APIClient().post(f'/api/orders/{self.order.pk}/verify_order/',
+                                    {'code': '0000', 'phone': '+79990000000'}, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['message'], ALREADY_BOOKED_MESSAGE)
+        self.assertEqual(Order.objects.get(pk=self.order.pk).status, Order.PAYMENT_STATUS_WAITING)
+
+
+class FileLifecycleTests(TestCase):
+    def setUp(self):
+        self.product = create_house(max_persons=2)
+
+    def test_saving_without_file_changes_does_one_query(self):
+        ProductFile.objects.create(product=self.product, file='files/a.jpg')
+        product_file = ProductFile.objects.get()
+
+        product_file.is_primary = True
+        with CaptureQueriesContext(connection) as queries:
+            product_file.save()
+
+        self.assertEqual(len(queries), 1)
+        self.assertFalse(FileDeletion.objects.exists())
+
+    def test_failed_saves_keep_the_replaced_file(self):
+        product_file = ProductFile.objects.create(product=self.product, file='files/a.jpg')
+        product_file.file = 'files/b.jpg'
+
+        # Without a transaction a queued row would stay, whatever happens to the save
+        with mock.patch.object(ProductFile, '_save_table', side_effect=IntegrityError), \
+                mock.patch.object(files, 'queue_deletion') as queue_deletion, \
+                self.assertRaises(IntegrityError), transaction.atomic():
+            product_file.save()
+        queue_deletion.assert_not_called()
+
+        product_file.save()
+        self.assertEqual(list(FileDeletion.objects.values_list('name', flat=True)), ['files/a.jpg'])
+
+    def test_only_files_nothing_refers_to_are_deleted(self):
+        replaced = ProductFile.objects.create(
+            product=self.product, file='files/a.jpg')
+        ProductFile.objects.create(product=self.product, file='files/a.jpg',
+                                   file_thumbnail='files/thumbnails/a.jpg')
+
+        replaced.file = 'files/b.jpg'
+        replaced.save()
+        self.assertFalse(FileDeletion.objects.exists())
+
+        ProductFile.objects.all().delete()
+        self.assertEqual(sorted(FileDeletion.objects.values_list('name', flat=True)), [
+                         'files/a.jpg', 'files/b.jpg', 'files/thumbnails/a.jpg'])
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            self.assertEqual(delete_batch(), 3)
+        self.assertFalse(FileDeletion.objects.exists())
+
+    def test_files_stored_again_after_being_queued_stay(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            names = ['files/a.jpg', 'files/variants/a-320.webp', 'files/b.jpg']
+            for name in names:
+                default_storage.save(name, ContentFile(b'photo'))
+            files.queue_deletion(names)
+            # The same photo uploaded again gets the same names
+            ProductFile.objects.bulk_create([ProductFile(product=self.product, file='files/a.jpg', variants={
+                'webp': {'320': 'files/variants/a-320.webp'}})])
+
+            self.assertEqual(delete_batch(), 3)
+            self.assertEqual([default_storage.exists(name) for name in names], [True, True, False])
+        self.assertFalse(FileDeletion.objects.exists())
+
+    def test_shared_variants_stay_while_referred_to(self):
+        """ The same photo uploaded twice renders to the same variant names """
+        variants = {'webp': {'320': 'files/variants/a-320.webp', '640': 'files/variants/a-640.webp'}}
+        first, second, third = ProductFile.objects.bulk_create([ProductFile(product=self.product, file=f'files/{name}.jpg',
+                                                                            variants=variants) for name in 'abc'])
+        # Names that merely resemble the shared ones don't keep them
+        ProductFile.objects.bulk_create([ProductFile(product=self.product, file='files/d.jpg', variants={'webp': {
+            '320': 'files/variants/A-320.webp', '640': 'files/variants/a-640.webp.tmp'}})])
+
+        serializer = DeleteProductFilesSerializer(data={'files_ids': [first.pk]}, context={'product_id': self.product.pk})
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        second.delete()
+        self.assertEqual(sorted(FileDeletion.objects.values_list('name', flat=True)), ['files/a.jpg', 'files/b.jpg'])
+
+        third.delete()
+        self.assertEqual(sorted(FileDeletion.objects.filter(name__startswith='files/variants/').values_list('name', flat=True)),
+                         ['files/variants/a-320.webp', 'files/variants/a-640.webp'])
+
+    def delete_gallery(self, size):
+        product_files = ProductFile.objects.bulk_create([ProductFile(
+            product=self.product, file=f'files/{size}-{number}.jpg', variants={'webp': {'320': f'files/variants/{size}-{number}-320.webp'}})
+            for number in range(size)])
+        with CaptureQueriesContext(connection) as queries:
+            serializer = DeleteProductFilesSerializer(data={'files_ids': [product_file.pk for product_file in product_files]},
+                                                      context={'product_id': self.product.pk})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+        return len(queries)
+
+    def test_bulk_deletion_queries_do_not_depend_on_gallery_size(self):
+        self.assertEqual(self.delete_gallery(2), self.delete_gallery(6))
+        self.assertEqual(FileDeletion.objects.count(), 16)
+
+    def test_s3_files_are_deleted_in_one_call_and_failures_retried(self):
+        class Bucket:
+            calls = []
+
+            def delete_objects(self, Delete):
+                self.calls.append([item['Key'] for item in Delete['Objects']])
+                return {'Errors': [{'Key': 'media/files/b.jpg', 'Message': 'Slow down'}]}
+
+        class Storage:
+            bucket = Bucket()
+
+            def _normalize_name(self, name):
+                return f'media/{name}'
+
+        FileDeletion.objects.bulk_create(
+            [FileDeletion(name='files/a.jpg'), FileDeletion(name='files/b.jpg')])
+
+        self.assertEqual(delete_batch(Storage()), 2)
+        self.assertEqual(Bucket.calls, [['media/files/a.jpg', 'media/files/b.jpg']])
+        failed = FileDeletion.objects.get()
+        self.assertEqual((failed.name, failed.attempts, failed.last_error), ('files/b.jpg', 1, 'Slow down'))
+
+
+@override_settings(UPLOAD_BACKEND='api.uploads.LocalUploadBackend')
+class ImageProcessingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = create_house()
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root.name, IMAGE_VARIANT_WIDTHS=[320, 640, 1280])
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def upload(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return ProductFile.objects.create(product=self.product, original=ContentFile(data, 'photo.jpg'),
+                                              status=ProductFile.STATUS_PENDING)
+
+    def test_pending_uploads_get_their_images_and_variants(self):
+        photo = BytesIO()
+        Image.new('RGB', (800, 500), 'red').save(photo, 'JPEG')
+        product_file = self.upload(photo.getvalue())
+        broken = self.upload(b'not an image')
+        missing = self.upload(photo.getvalue())
+        default_storage.delete(missing.original.name)
+        version = versions.get(catalogue.VERSION)
+
+        with ThreadPoolExecutor() as pool, self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(images.process_batch(pool), 3)
+
+        product_file.refresh_from_db()
+        self.assertEqual(product_file.status, ProductFile.STATUS_READY)
+        self.assertEqual(sorted(product_file.variants['webp'], key=int), ['320', '640'])
+        for name in [product_file.file.name, product_file.file_thumbnail.name, *images.variant_names(product_file)]:
+            self.assertTrue(default_storage.exists(name))
+        self.assertEqual(Image.open(product_file.file_thumbnail).size, images.THUMBNAIL_SIZE)
+
+        # Neither an undecodable nor a lost original holds up the batch or stays leased
+        for failed in [broken, missing]:
+            failed.refresh_from_db()
+            self.assertEqual((failed.status, failed.claimed_until), (ProductFile.STATUS_FAILED, None))
+        # The web workers see the new photos in the catalogue right away
+        self.assertEqual(versions.get(catalogue.VERSION), version + 1)
+
+        with ThreadPoolExecutor() as pool:
+            self.assertEqual(images.process_batch(pool), 0)
+
+    def test_photos_deleted_while_converted_leave_their_files_to_the_queue(self):
+        photo = BytesIO()
+        Image.new('RGB', (800, 500), 'red').save(photo, 'JPEG')
+        product_file = self.upload(photo.getvalue())
+        store = images.store
+
+        def delete_and_store(claimed, rendered):
+            # Other workers don't take the claimed upload meanwhile, and the admin can delete it
+            self.assertEqual(images.claim(8), [])
+            ProductFile.objects.get(pk=claimed.pk).delete()
+            store(claimed, rendered)
+
+        with ThreadPoolExecutor() as pool, mock.patch.object(images, 'store', delete_and_store):
+            self.assertEqual(images.process_batch(pool), 1)
+
+        self.assertFalse(ProductFile.objects.exists())
+        stored = {name for name in FileDeletion.objects.values_list('name', flat=True) if default_storage.exists(name)}
+        self.assertEqual(len(stored), 5)
+        self.assertIn(product_file.original.name, stored)
+
+
+class DirectUploadTests(TestCase):
+    def setUp(self):
+        self.product = create_house(max_persons=2)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def presign(self, count):
+        response = self.client.post(f'/api/products/{self.product.pk}/files/presign/', {
+            'files': [{'name': f'photo{number}.JPG', 'content_type': 'image/jpeg'} for number in range(count)]}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['uploads']
+
+    def upload(self, upload, content_type='image/jpeg'):
+        return APIClient().post(upload['url'], {'file': SimpleUploadedFile('photo.jpg', b'jpeg', content_type=content_type)},
+                                format='multipart', **upload['fields'])
+
+    def confirm(self, upload_ids):
+        return self.client.post(f'/api/products/{self.product.pk}/files/confirm/', {'upload_ids': upload_ids}, format='json')
+
+    def test_confirmed_uploads_are_registered_once(self):
+        issued = self.presign(2)
+        for upload in issued:
+            self.assertEqual(self.upload(upload).status_code, 204)
+
+        upload_ids = [upload['upload_id'] for upload in issued]
+        self.assertEqual(self.confirm(upload_ids).status_code, 201)
+        self.assertEqual(self.confirm(upload_ids).status_code, 201)
+
+        product_files = ProductFile.objects.filter(product=self.product).order_by('pk')
+        self.assertEqual([(product_file.status, product_file.is_primary) for product_file in product_files],
+                         [(ProductFile.STATUS_PENDING, True), (ProductFile.STATUS_PENDING, False)])
+        self.assertTrue(product_files[0].original.name.endswith('.jpg'))
+
+    def test_concurrent_confirms_register_once(self):
+        upload = self.presign(1)[0]
+        self.upload(upload)
+        select_for_update = QuerySet.select_for_update
+
+        def lock(queryset, *args, **kwargs):
+            # The other request held the lock and registered the photo meanwhile
+            if queryset.model is Product:
+                uploads.register(self.product, uploads.confirmed_keys(self.product.pk, [upload['upload_id']]))
+            return select_for_update(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, 'select_for_update', autospec=True, side_effect=lock) as locked:
+            self.assertEqual(self.confirm([upload['upload_id']]).status_code, 201)
+        locked.assert_called()
+        self.assertEqual(ProductFile.objects.filter(product=self.product).count(), 1)
+
+    def test_the_backend_follows_the_storage(self):
+        self.assertIsInstance(uploads.get_backend(), uploads.LocalUploadBackend)
+        with mock.patch.object(uploads, 'default_storage', mock.Mock(bucket=object())):
+            self.assertIsInstance(uploads.get_backend(), uploads.S3UploadBackend)
+            with override_settings(UPLOAD_BACKEND='api.uploads.LocalUploadBackend'):
+                self.assertIsInstance(uploads.get_backend(), uploads.LocalUploadBackend)
+
+    def test_missing_and_foreign_uploads_are_rejected(self):
+        upload = self.presign(1)[0]
+        self.assertEqual(self.upload(upload, content_type='image/png').status_code, 400)
+        self.assertEqual(self.confirm([upload['upload_id']]).status_code, 400)
+        self.assertEqual(self.confirm([upload['upload_id'] + 'x']).status_code, 400)
+        self.assertEqual(self.client.post(upload['url'].replace('uploads/', 'uploads/x'), {}).status_code, 403)
+        self.assertFalse(ProductFile.objects.exists())
+
+
+class MediaServingTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def test_hashed_names_are_immutable_and_ranges_served(self):
+        name = default_storage.save(hashed_name('files', b'0123456789', 'jpg'), ContentFile(b'0123456789'))
+
+        response = self.client.get(f'/media/{name}')
+        self.assertEqual(response['Cache-Control'], f'public, max-age={settings.MEDIA_MAX_AGE}, immutable')
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+        response = self.client.get(f'/media/{name}', HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+
+        self.assertEqual(self.client.get(f'/media/{name}', HTTP_RANGE='bytes=10-').status_code, 416)
+        self.assertEqual(self.client.get(f'/media/{name}', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_legacy_names_are_revalidated(self):
+        name = default_storage.save('files/photo.jpg', ContentFile(b'photo'))
+
+        response = self.client.get(f'/media/{name}')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        self.assertEqual(b''.join(response.streaming_content), b'photo')
+        self.assertEqual(self.client.get(f'/media/{name}', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_originals_are_not_served(self):
+        name = default_storage.save(hashed_name('files/originals/uploads', b'photo', 'jpg'), ContentFile(b'photo'))
+
+        for path in [name, f'files/../{name}', f'files/thumbnails/../../{name}']:
+            self.assertEqual(self.client.get(f'/media/{path}').status_code, 404)
+
+
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        Order.objects.bulk_create([new_order(name=f'guest {number}') for number in range(25)])
+
+    def test_pages_cover_every_order_once(self):
+        seen = []
+        url = '/api/orders/?page_size=7'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            seen += [order['id'] for order in response.data['results']]
+            url = response.data['next']
+
+        self.assertEqual(seen, list(Order.objects.order_by(
+            '-created_at', '-id').values_list('pk', flat=True)))
+
+    def test_page_size_is_capped(self):
+        with mock.patch.object(OrderPagination, 'max_page_size', 5):
+            response = self.client.get('/api/orders/?page_size=1000')
+        self.assertEqual(len(response.data['results']), 5)
+
+
+class IndexUsageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = benchmark.seed()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertTrue(explain.uses_index(queryset, index_name),
+                        explain.plan(queryset))
+
+    def test_booking_lookups(self):
+        start = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        product_id = self.data['house'].pk
+
+        self.assertUsesIndex(active_order_items().filter(product_id=product_id).filter(
+            condition_constructor(start, start + timedelta(days=3))), 'api_orderitem_booking_idx')
+        self.assertUsesIndex(active_order_items().filter(
+            product_id=product_id, end_datetime__gt=start), 'api_orderitem_booking_idx')
+
+    def test_booking_lookups_read_only_order_items(self):
+        queryset = active_order_items().filter(product_id=self.data['house'].pk).filter(condition_constructor(
+            datetime(2030, 1, 1, tzinfo=timezone.utc), datetime(2030, 1, 4, tzinfo=timezone.utc)))
+
+        self.assertNotIn('"api_order"', str(queryset.query))
+
+    def test_status_changes_reach_the_items(self):
+        order = self.data['waiting_order']
+        order.status = Order.PAYMENT_STATUS_PENDING
+        order.hold_expires_at = datetime(2030, 1, 1, tzinfo=timezone.utc)
+        order.save()
+
+        self.assertEqual(set(order.items.values_list('order_status', 'hold_expires_at')),
+                         {(Order.PAYMENT_STATUS_PENDING, order.hold_expires_at)})
+
+    def test_admin_lists(self):
+        self.assertUsesIndex(Order.objects.order_by(
+            '-created_at', '-id')[:10], 'api_order_created_idx')
+        self.assertUsesIndex(OrderItem.objects.filter(order_status=Order.PAYMENT_STATUS_PENDING).order_by(
+            '-start_datetime', '-id')[:10], 'api_orderitem_paid_feed_idx')
+
+    def test_verification_and_cleanup(self):
+        order = self.data['waiting_order']
+
+        self.assertUsesIndex(Order.objects.filter(pk=order.pk, status=Order.PAYMENT_STATUS_WAITING,
+                                                  phone=order.phone), explain.primary_key_index(Order))
+        self.assertUsesIndex(Order.objects.filter(
+            expired()), 'api_order_waiting_hold_idx')
+        self.assertUsesIndex(Cart.objects.filter(
+            created_at__lt=datetime(2030, 1, 1, tzinfo=timezone.utc)), 'api_cart_created_idx')
+
+
+class SmsOutboxTests(TestCase):
+    def test_a_failing_group_does_not_resend_the_others(self):
+        class Gateway:
+            sent = []
+
+            def send(self, numbers, text):
+                if text == 'broken':
+                    raise TypeError("a bytes-like object is required, not 'str'")
+                self.sent.append(text)
+
+        sent = queue_sms('+79990000000', 'code 1234')
+        broken = queue_sms('+79990000001', 'broken')
+
+        self.assertEqual(dispatch_batch(Gateway()), 2)
+        self.assertEqual(dispatch_batch(Gateway()), 0)
+
+        sent.refresh_from_db()
+        broken.refresh_from_db()
+        self.assertEqual(Gateway.sent, ['code 1234'])
+        self.assertEqual(sent.status, SmsMessage.STATUS_SENT)
+        self.assertEqual((broken.status, broken.attempts), (SmsMessage.STATUS_PENDING, 1))
+        self.assertIn('TypeError', broken.last_error)
+
+    def test_messages_are_claimed_before_sending(self):
+        class Gateway:
+            seen_by_others = []
+
+            def send(self, numbers, text):
+                # Sent outside the claiming transaction, another worker polling meanwhile doesn't pick the batch up
+                self.seen_by_others.append((len(connection.savepoint_ids), dispatch_batch(FakeGateway())))
+
+        queue_sms('+79990000000', 'code 1234')
+
+        self.assertEqual(dispatch_batch(Gateway()), 1)
+        self.assertEqual(Gateway.seen_by_others, [(len(connection.savepoint_ids), 0)])
+        self.assertEqual(SmsMessage.objects.get().status, SmsMessage.STATUS_SENT)
+
+    def test_unreadable_gateway_responses_are_gateway_errors(self):
+        with self.assertRaises(SmsAeroError):
+            SmsAero._check_response(b'incorrect language')
+
+
+class PushNotificationTests(TestCase):
+    def ticket(self, ticket_id, token, age):
+        ticket = PushNotificationTicket.objects.create(ticket_id=ticket_id, push_token=token)
+        PushNotificationTicket.objects.filter(pk=ticket.pk).update(created_at=datetime.now(timezone.utc) - age)
+        return ticket
+
+    def test_tickets_without_receipts_are_checked_again(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        UserPushNotificationToken.objects.create(user=user, push_token='ExponentPushToken[gone]')
+        self.ticket('delivered', 'ExponentPushToken[kept]', timedelta(hours=1))
+        self.ticket('unregistered', 'ExponentPushToken[gone]', timedelta(hours=1))
+        waiting = self.ticket('waiting', 'ExponentPushToken[kept]', timedelta(hours=1))
+        self.ticket('forgotten', 'ExponentPushToken[kept]', timedelta(days=2))
+
+        receipts = [PushReceipt('delivered', 'ok', None, None),
+                    PushReceipt('unregistered', 'error', 'Gone', {'error': 'DeviceNotRegistered'})]
+        with mock.patch.object(PushClient, 'check_receipts_multiple', return_value=receipts):
+            self.assertEqual(pushNotifications.check_push_receipts(), 2)
+
+        self.assertEqual(list(PushNotificationTicket.objects.all()), [waiting])
+        self.assertFalse(UserPushNotificationToken.objects.exists())
+
+    def test_background_failures_are_logged(self):
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        UserPushNotificationToken.objects.create(user=user, push_token='ExponentPushToken[admin]')
+
+        with mock.patch.object(pushNotifications, 'send_push_messages', side_effect=ValueError('bad token')), \
+                mock.patch.object(pushNotifications, 'connection'), \
+                self.assertLogs(pushNotifications.logger, 'ERROR'):
+            pushNotifications._notify_admins('Forest House', 'New order')
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.product = create_house(max_persons=2)
+        self.client = APIClient()
+
+    def request(self, method, path, data=None):
+        """ The response and, for each read, whether it would have gone to a replica """
+        reads = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            database = db_for_read(router, model, **hints)
+            reads.append(database != 'default')
+            return 'default'
+
+        with mock.patch.object(ReplicaRouter, 'db_for_read', spy), \
+                mock.patch.object(db_router, 'replicas', return_value=['replica_1']):
+            response = getattr(self.client, method)(path, data, format='json')
+        return response, reads
+
+    def test_public_reads_go_to_replicas(self):
+        response, reads = self.request('get', f'/api/products/{self.product.pk}/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(reads)
+        self.assertTrue(all(reads))
+
+    def test_pricing_stays_on_the_primary(self):
+        response, reads = self.request('post', f'/api/products/{self.product.pk}/getPrice/', {
+            'start_datetime': '2030-01-01T14:00:00Z', 'end_datetime': '2030-01-03T12:00:00Z', 'quantity': 1,
+            'exclude_order_item_id': None})
+
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertFalse(any(reads))
+
+    def test_writers_read_from_the_primary(self):
+        self.client.force_authenticate(User.objects.create_superuser('admin', 'admin@example.com', 'admin'))
+        response, _ = self.request('post', '/api/push-tokens/', {'push_token': 'ExponentPushToken[test]'})
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertIn(db_router.STICKY_COOKIE, response.cookies)
+
+        _, reads = self.request('get', f'/api/products/{self.product.pk}/')
+        self.assertFalse(any(reads))
+
+
+class ConnectionHealthCheckTests(TestCase):
+    def setUp(self):
+        self.conn = DatabaseWrapper(dict(connection.settings_dict), alias='health-checked')
+        self.addCleanup(self.conn.close)
+        stats = mock.patch.dict(db_connections.stats, {key: 0 for key in db_connections.stats})
+        stats.start()
+        self.addCleanup(stats.stop)
+
+    def serve_request(self, idle):
+        """ Ends the previous request and starts one `idle` seconds later """
+        self.conn.finish_request()
+        self.conn.idle_since -= idle
+        self.conn.start_request()
+
+    def test_idle_connections_are_checked_and_reopened(self):
+        self.conn.ensure_connection()
+        self.serve_request(idle=settings.DATABASE_HEALTH_CHECK_IDLE + 1)
+
+        with mock.patch.object(self.conn, 'is_usable', return_value=False) as is_usable, \
+                mock.patch.object(self.conn, 'close', wraps=self.conn.close) as close:
+            self.conn.ensure_connection()
+            self.conn.ensure_connection()
+
+        is_usable.assert_called_once()
+        close.assert_called_once()
+        self.assertIsNotNone(self.conn.connection)
+        self.assertEqual((db_connections.stats['reused'], db_connections.stats['dropped']), (1, 1))
+
+    def test_busy_connections_skip_the_check(self):
+        self.conn.ensure_connection()
+        self.serve_request(idle=0)
+
+        with mock.patch.object(self.conn, 'is_usable') as is_usable:
+            self.conn.ensure_connection()
+
+        is_usable.assert_not_called()
+        self.assertEqual((db_connections.stats['reused'], db_connections.stats['opened']), (1, 1))
+
+
+class ApiQueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = benchmark.seed()
+
+    def test_routes_stay_within_baseline(self):
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            results = benchmark.run(self.data)
+
+        self.assertEqual(benchmark.compare(
+            results, benchmark.load_baseline()), [])
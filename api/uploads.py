@@ -0,0 +1,94 @@
+""" Product photos uploaded straight to the storage.
+
+The API hands out a signed upload id and a form the client posts the file to, the storage checks type, size and
+expiry itself. Once uploaded, confirming the ids registers the photos as pending for process_images. With
+S3UploadBackend the form goes to the bucket as a presigned POST, LocalUploadBackend serves the same form from
+the API and writes to the default storage, for development and tests. Which one is used follows the default
+storage unless UPLOAD_BACKEND is set.
+"""
+import os
+from uuid import uuid4
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from django.utils.module_loading import import_string
+
+from api import catalogue
+from api.models import ProductFile
+
+SALT = 'api.uploads'
+UPLOAD_PREFIX = 'files/originals/uploads'
+
+
+class S3UploadBackend(object):
+    """ Needs the default storage to be S3Boto3Storage """
+
+    def form(self, key, content_type, request):
+        return default_storage.bucket.meta.client.generate_presigned_post(
+            Bucket=default_storage.bucket_name, Key=default_storage._normalize_name(key),
+            Fields={'Content-Type': content_type},
+            Conditions=[{'Content-Type': content_type},
+                        ['content-length-range', 1, settings.UPLOAD_MAX_SIZE]],
+            ExpiresIn=settings.UPLOAD_URL_TTL)
+
+
+class LocalUploadBackend(object):
+    def form(self, key, content_type, request):
+        token = signing.dumps(
+            {'key': key, 'content_type': content_type}, salt=f'{SALT}.local')
+        return {'url': request.build_absolute_uri(reverse('local-upload', args=[token])), 'fields': {}}
+
+
+def get_backend():
+    if settings.UPLOAD_BACKEND:
+        return import_string(settings.UPLOAD_BACKEND)()
+    # Only S3 storages have a bucket, as in files.delete_from_storage
+    return S3UploadBackend() if getattr(default_storage, 'bucket', None) is not None else LocalUploadBackend()
+
+
+def issue(product_id, name, content_type, request):
+    """ Upload id and {'url', 'fields'} of the form to post the file to, as the `file` field """
+    key = f'{UPLOAD_PREFIX}/{uuid4().hex}{os.path.splitext(name)[1].lower()}'
+    return {
+        'upload_id': signing.dumps({'key': key, 'product_id': product_id}, salt=SALT),
+        **get_backend().form(key, content_type, request),
+    }
+
+
+def load_local_token(token):
+    """ {'key', 'content_type'} behind a LocalUploadBackend url, None once expired or if tampered with """
+    try:
+        return signing.loads(token, salt=f'{SALT}.local', max_age=settings.UPLOAD_URL_TTL)
+    except signing.BadSignature:
+        return None
+
+
+def confirmed_keys(product_id, upload_ids):
+    """ Storage keys of the uploads issued for this product, or None if an id is invalid """
+    keys = []
+    for upload_id in upload_ids:
+        try:
+            upload = signing.loads(
+                upload_id, salt=SALT, max_age=settings.UPLOAD_CONFIRM_TTL)
+        except signing.BadSignature:
+            return None
+        if upload['product_id'] != product_id:
+            return None
+        keys.append(upload['key'])
+    return keys
+
+
+def register(product, originals):
+    """ Pending ProductFile rows for the stored or uploaded originals, the first one is primary if the product has none """
+    list_for_create = [ProductFile(
+        product=product, original=original, status=ProductFile.STATUS_PENDING) for original in originals]
+    if not list_for_create:
+        return []
+
+    if not ProductFile.objects.filter(product=product).exists():
+        list_for_create[0].is_primary = True
+
+    ProductFile.objects.bulk_create(list_for_create)
+    catalogue.invalidate()
+    return list_for_create
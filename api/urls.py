@@ -1,3 +1,4 @@
+from django.urls import path
 from rest_framework_nested import routers
 from . import views
 
@@ -18,4 +19,6 @@ orders_router.register('items', views.OrderItemViewSet, basename='order-items')
 carts_router = routers.NestedDefaultRouter(router, 'carts', lookup='cart')
 carts_router.register('items', views.CartItemViewSet, basename='cart-items')
 
-urlpatterns = router.urls + products_router.urls + orders_router.urls + carts_router.urls
\ No newline at end of file
+urlpatterns = router.urls + products_router.urls + orders_router.urls + carts_router.urls + [
+    path('uploads/<str:token>/', views.LocalUploadView.as_view(), name='local-upload'),
+]
\ No newline at end of file
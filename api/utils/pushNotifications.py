@@ -1,21 +1,106 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
 from exponent_server_sdk import (
     DeviceNotRegisteredError,
     PushClient,
     PushMessage,
-    PushServerError,
+    PushTicket,
     PushTicketError,
 )
-from requests.exceptions import ConnectionError, HTTPError
+from requests import Session
 
+from api.models import PushNotificationTicket, UserPushNotificationToken
 
-# Basic arguments. You should extend this function with the push features you
-# want to use, or simply pass in a `PushMessage` object.
-def send_push_message(token, title, body, extra={"_displayInForeground": True}):
-    response = PushClient().publish(
+logger = logging.getLogger(__name__)
+
+# One HTTP session for every push request of the process
+session = Session()
+session.headers.update({
+    'accept': 'application/json',
+    'accept-encoding': 'gzip, deflate',
+    'content-type': 'application/json',
+})
+
+# Notifications are sent one after another off the request thread
+executor = ThreadPoolExecutor(max_workers=1)
+
+
+def send_push_messages(tokens, title, body, extra={"_displayInForeground": True}):
+    """ Publish to every token in chunks, forget the tokens Expo reports as unregistered and keep the other tickets to check their receipts later. """
+    tickets = PushClient(session=session).publish_multiple([
         PushMessage(to=token,
                     title=title,
                     body=body,
                     sound='default',
-                    data=extra))
+                    data=extra) for token in tokens])
+
+    unregistered = []
+    pending = []
+    for ticket in tickets:
+        try:
+            ticket.validate_response()
+            pending.append(PushNotificationTicket(
+                ticket_id=ticket.id, push_token=ticket.push_message.to))
+        except DeviceNotRegisteredError:
+            unregistered.append(ticket.push_message.to)
+        except PushTicketError as error:
+            logger.warning('Push to %s failed: %s',
+                           ticket.push_message.to, error)
+
+    UserPushNotificationToken.objects.filter(
+        push_token__in=unregistered).delete()
+    PushNotificationTicket.objects.bulk_create(pending)
+
+
+def _notify_admins(title, body):
+    try:
+        tokens = list(UserPushNotificationToken.objects.values_list(
+            'push_token', flat=True))
+        if tokens:
+            send_push_messages(tokens, title, body)
+    except Exception:
+        # Nobody reads the future of the executor, whatever went wrong has to be logged here
+        logger.exception('Could not send push notifications')
+    finally:
+        connection.close()
+
+
+def notify_admins(title, body):
+    """ Notify every admin device once the current transaction commits, without waiting for Expo """
+    transaction.on_commit(lambda: executor.submit(_notify_admins, title, body))
+
+
+def check_push_receipts():
+    """ Drop the tokens whose receipts say the device is no longer registered. Returns how many receipts were checked.
+
+    Tickets Expo has no receipt for yet are checked again on the next run, until PUSH_RECEIPTS_MAX_AGE.
+    """
+    now = timezone.now()
+    tickets = {ticket.ticket_id: ticket for ticket in PushNotificationTicket.objects.filter(
+        created_at__lte=now - timedelta(seconds=settings.PUSH_RECEIPTS_DELAY))}
+    if not tickets:
+        return 0
+
+    receipts = [receipt for receipt in PushClient(session=session).check_receipts_multiple(
+        [PushTicket(None, None, None, None, ticket_id) for ticket_id in tickets]) if receipt.id in tickets]
+
+    unregistered = []
+    for receipt in receipts:
+        try:
+            receipt.validate_response()
+        except DeviceNotRegisteredError:
+            unregistered.append(tickets[receipt.id].push_token)
+        except PushTicketError as error:
+            logger.warning('Push receipt %s failed: %s', receipt.id, error)
 
-    response.validate_response()
+    UserPushNotificationToken.objects.filter(
+        push_token__in=unregistered).delete()
+    PushNotificationTicket.objects.filter(pk__in=[tickets[receipt.id].pk for receipt in receipts]).delete()
+    # Expo forgets receipts after a day, these will never get one
+    PushNotificationTicket.objects.filter(
+        created_at__lte=now - timedelta(seconds=settings.PUSH_RECEIPTS_MAX_AGE)).delete()
+    return len(receipts)
@@ -0,0 +1,44 @@
+""" Versions of cached data kept in the database, so a change reaches every process at once.
+
+A cache key carrying the version can't be read after the change in any process, whatever the cache backend.
+A bump waits for the transaction to commit and runs once per commit however many rows it changed.
+"""
+import threading
+from django.db import transaction
+from django.db.models import F
+
+from api.db_router import primary
+from api.models import CacheVersion
+
+# Name -> the bump every on_commit of this thread shares until it has run
+_pending = threading.local()
+
+
+def get(name):
+    with primary():
+        return CacheVersion.objects.filter(name=name).values_list('version', flat=True).first() or 0
+
+
+class _Bump(object):
+    def __init__(self, name):
+        self.name = name
+        self.done = False
+
+    def __call__(self):
+        # Registered once per change, only the first one to run after the commit writes
+        if self.done:
+            return
+        self.done = True
+        if not CacheVersion.objects.filter(name=self.name).update(version=F('version') + 1):
+            CacheVersion.objects.get_or_create(name=self.name, defaults={'version': 1})
+
+
+def bump(name):
+    bumps = getattr(_pending, 'bumps', None)
+    if bumps is None:
+        bumps = _pending.bumps = {}
+    callback = bumps.get(name)
+    if callback is None or callback.done:
+        callback = bumps[name] = _Bump(name)
+    # Registered again each time, a rollback drops only the registrations it undid and the others still run it
+    transaction.on_commit(callback)
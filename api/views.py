@@ -1,20 +1,28 @@
 from multiprocessing import context
-from django.db.models import Q
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.shortcuts import get_object_or_404
+from rest_framework.parsers import MultiPartParser
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAdminUser, AllowAny, SAFE_METHODS
 from rest_framework.decorators import action
 
+from api import catalogue, uploads
+from api.cart_store import get_cart_or_404, get_store, prefetch_product_details
+from api.db_router import ReplicaReadsMixin
 from api.models import Cart, CartItem, ProductFile, ProductSpecialInterval, Order, OrderItem, Product, UserPushNotificationToken
-from api.pagination import DefaultPagination
+from api.pagination import DefaultPagination, OrderItemFeedPagination, OrderPagination
 from api.permissions import IsAdminUserOrPostOnly, IsOwner
-from api.serializers import CartItemSerializer, CartSerializer, CheckAffectedInCart, CheckAffectedInOrder, CreateCartItemSerializer, CreateOrderItemSerializer, CreateOrderSerializer, CreateProductFilesSerializer, DeleteOrderItemsSerializer, DeleteProductFilesSerializer, DeleteSpecialIntervalsSerializer, GetAllowedIntervalInCart, GetAllowedIntervalInOrder, GetNewOrderCodeSerializer, GetProductPriceSerializer, IsCartValid, MakeFilePrimarySerializer, MarkOrderAsFailedSerializer, ProductFileSerializer, ProductSpecialIntervalSerializer, GetOrderSerializer, UpdateCartItemSerializer, UpdateOrderItemSerializer, UserPushNotificationTokenSerializer, VerifyOrderWithCodeSerializer, OrderItemSerializer, OrderItemTimeSerializer, OrderSerializer, ProductSerializer, ProductSimpleSerializer
+from api.serializers import booking_conflict_as_validation_error, CartItemSerializer, CartSerializer, CheckAffectedInCart, CheckAffectedInOrder, ConfirmProductFilesSerializer, CreateCartItemSerializer, CreateOrderItemSerializer, CreateOrderSerializer, CreateProductFilesSerializer, DeleteOrderItemsSerializer, DeleteProductFilesSerializer, DeleteSpecialIntervalsSerializer, GetAllowedIntervalInCart, GetAllowedIntervalInOrder, GetNewOrderCodeSerializer, GetProductPriceSerializer, GetProductsPricesSerializer, IsCartValid, MakeFilePrimarySerializer, MarkOrderAsFailedSerializer, PresignProductFilesSerializer, ProductFileSerializer, ProductSpecialIntervalSerializer, GetOrderSerializer, UpdateCartItemSerializer, UpdateOrderItemSerializer, UserPushNotificationTokenSerializer, VerifyOrderWithCodeSerializer, OrderItemSerializer, OrderItemTimeSerializer, OrderSerializer, ProductAvailabilitySerializer, ProductSerializer, ProductSimpleSerializer
 
 
 class OrderViewSet(ModelViewSet):
-    pagination_class = DefaultPagination
+    pagination_class = OrderPagination
     queryset = Order.objects.prefetch_related(
         'items__product__files', 'items__product__product_special_intervals', 'items__product__required_product').order_by('-created_at')
 
@@ -23,9 +31,16 @@ class OrderViewSet(ModelViewSet):
             data=request.data, context=self.get_serializer_context())
         serializer.is_valid(raise_exception=True)
         order = serializer.save()
+        prefetch_related_objects(
+            [order], 'items__product__files', 'items__product__product_special_intervals', 'items__product__required_product')
 
         return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
 
+    def perform_update(self, serializer):
+        # Moving a failed order back books its dates again, someone may have taken them meanwhile
+        with booking_conflict_as_validation_error():
+            serializer.save()
+
     def get_permissions(self):
         if (self.action == 'mark_order_as_failed') or (self.request.method != 'POST'):
             return [IsAdminUser()]
@@ -130,33 +145,50 @@ class OrderItemViewSet(ModelViewSet):
 
 
 class AllOrderItemsViewSet(ModelViewSet):
-    pagination_class = DefaultPagination
+    pagination_class = OrderItemFeedPagination
     http_method_names = ['get']
     serializer_class = OrderItemSerializer
     permission_classes = [IsAdminUser]
-    queryset = OrderItem.objects.filter(Q(order__status='P')).prefetch_related(
+    # The status copied on the items keeps the feed on a single table and its partial index
+    queryset = OrderItem.objects.filter(order_status=Order.PAYMENT_STATUS_PENDING).prefetch_related(
         'product__files', 'product__product_special_intervals', 'product__required_product').order_by('-start_datetime')
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(ReplicaReadsMixin, ModelViewSet):
+    # Checkout and pricing validate again on the primary, the catalogue is cached and always built from it
+    replica_actions = ['list', 'retrieve', 'timeView', 'availability']
     queryset = Product.objects.prefetch_related(
         'files', 'product_special_intervals').select_related('required_product')
 
     def get_serializer_class(self):
         if self.action == 'getPrice':
             return GetProductPriceSerializer
+        if self.action == 'getPrices':
+            return GetProductsPricesSerializer
         if self.action == 'timeView':
             return OrderItemTimeSerializer
+        if self.action == 'availability':
+            return ProductAvailabilitySerializer
         if self.request.method in SAFE_METHODS:
             return ProductSerializer
         return ProductSimpleSerializer
 
     def get_permissions(self):
         method = self.request.method
-        if (method in SAFE_METHODS) or (self.action == 'timeView') or (self.action == 'getPrice'):
+        if (method in SAFE_METHODS) or (self.action == 'timeView') or (self.action == 'getPrice') or (self.action == 'getPrices') or (self.action == 'availability') or (self.action == 'catalogue'):
             return [AllowAny()]
         return [IsAdminUser()]
 
+    @action(detail=False, methods=['get'])
+    def catalogue(self, request):
+        etag, body = catalogue.rendered(request)
+        if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(body, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
     @action(detail=True, methods=['post'])
     def timeView(self, request, pk):
         serializer = OrderItemTimeSerializer(
@@ -166,6 +198,15 @@ class ProductViewSet(ModelViewSet):
 
         return Response(data, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['post'])
+    def availability(self, request, pk):
+        serializer = ProductAvailabilitySerializer(
+            data=request.data, context={'product_id': pk})
+        serializer.is_valid(raise_exception=True)
+        data = serializer.save()
+
+        return Response(data, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['post'])
     def getPrice(self, request, pk):
         serializer = GetProductPriceSerializer(
@@ -175,6 +216,14 @@ class ProductViewSet(ModelViewSet):
 
         return Response(data, status=status.HTTP_200_OK)
 
+    @action(detail=False, methods=['post'])
+    def getPrices(self, request):
+        serializer = GetProductsPricesSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.save()
+
+        return Response(data, status=status.HTTP_200_OK)
+
 
 class ProductFileViewSet(ModelViewSet):
     permission_classes = [IsAdminUser]
@@ -187,6 +236,10 @@ class ProductFileViewSet(ModelViewSet):
             return MakeFilePrimarySerializer
         if self.action == 'deleteIds':
             return DeleteProductFilesSerializer
+        if self.action == 'presign':
+            return PresignProductFilesSerializer
+        if self.action == 'confirm':
+            return ConfirmProductFilesSerializer
         if self.request.method == 'POST':
             return CreateProductFilesSerializer
         return ProductFileSerializer
@@ -212,8 +265,46 @@ class ProductFileViewSet(ModelViewSet):
 
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+    @action(methods=['post'], detail=False)
+    def presign(self, request, product_pk):
+        serializer = PresignProductFilesSerializer(
+            data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        data = serializer.save()
+
+        return Response(data, status=status.HTTP_200_OK)
+
+    @action(methods=['post'], detail=False)
+    def confirm(self, request, product_pk):
+        serializer = ConfirmProductFilesSerializer(
+            data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        data = serializer.save()
+
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class LocalUploadView(APIView):
+    """ Stands in for the bucket of S3UploadBackend, the signed url is the only credential """
+    authentication_classes = []
+    permission_classes = [AllowAny]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, token):
+        upload = uploads.load_local_token(token)
+        file = request.data.get('file')
+        if upload is None:
+            return Response({}, status=status.HTTP_403_FORBIDDEN)
+        if file is None or file.content_type != upload['content_type'] or not 0 < file.size <= settings.UPLOAD_MAX_SIZE:
+            return Response({}, status=status.HTTP_400_BAD_REQUEST)
+
+        default_storage.save(upload['key'], file)
+        return Response({}, status=status.HTTP_204_NO_CONTENT)
+
+
+class ProductSpecialIntervalViewSet(ReplicaReadsMixin, ModelViewSet):
+    replica_actions = ['list', 'retrieve']
 
-class ProductSpecialIntervalViewSet(ModelViewSet):
     def get_serializer_class(self):
         if self.action == 'deleteIds':
             return DeleteSpecialIntervalsSerializer
@@ -241,9 +332,10 @@ class ProductSpecialIntervalViewSet(ModelViewSet):
 
 
 class CartViewSet(ModelViewSet):
+    """ Carts are read and written through the cart store, only the admin list reads the Cart table """
     pagination_class = DefaultPagination
-    queryset = Cart.objects.prefetch_related(
-        'items__product__files', 'items__product__product_special_intervals', 'items__product__required_product')
+    queryset = Cart.objects.prefetch_related(Prefetch('items', queryset=CartItem.objects.order_by('pk').prefetch_related(
+        'product__files', 'product__product_special_intervals', 'product__required_product'), to_attr='cart_items')).order_by('pk')
     serializer_class = CartSerializer
 
     def get_permissions(self):
@@ -251,14 +343,44 @@ class CartViewSet(ModelViewSet):
             return [AllowAny()]
         return [IsAdminUserOrPostOnly()]
 
+    def get_object(self):
+        cart = get_cart_or_404(self.kwargs['pk'])
+        self.check_object_permissions(self.request, cart)
+        prefetch_product_details(cart.cart_items)
+        return cart
+
+    def perform_destroy(self, instance):
+        get_store().delete(instance)
+
 
 class CartItemViewSet(ModelViewSet):
+    def get_cart(self):
+        if not hasattr(self, 'cart'):
+            self.cart = get_cart_or_404(self.kwargs['cart_pk'])
+        return self.cart
+
     def get_queryset(self):
-        return CartItem.objects.filter(cart=self.kwargs['cart_pk']).prefetch_related('product__files', 'product__product_special_intervals', 'product__required_product')
+        cart_items = self.get_cart().cart_items
+        prefetch_product_details(cart_items)
+        return cart_items
+
+    def get_object(self):
+        for cart_item in self.get_cart().cart_items:
+            if str(cart_item.pk) == self.kwargs['pk']:
+                self.check_object_permissions(self.request, cart_item)
+                if self.action != 'destroy':
+                    prefetch_product_details([cart_item])
+                return cart_item
+        raise Http404
+
+    def perform_destroy(self, instance):
+        get_store().delete_items(self.get_cart(), [instance])
 
     def get_serializer_class(self):
         if self.action == 'is_valid':
             return IsCartValid
+        if self.action == 'check_affected':
+            return CheckAffectedInCart
         if self.action == 'get_allowed_interval':
             return GetAllowedIntervalInCart
         if self.request.method == 'POST':
@@ -268,7 +390,7 @@ class CartItemViewSet(ModelViewSet):
         return CartItemSerializer
 
     def get_serializer_context(self):
-        return {'request': self.request, 'cart_id': self.kwargs['cart_pk']}
+        return {'request': self.request, 'cart': self.get_cart()}
 
     @action(methods=['get'], detail=False)
     def is_valid(self, request, cart_pk):
@@ -277,6 +399,13 @@ class CartItemViewSet(ModelViewSet):
 
         return Response(data, status=status.HTTP_200_OK)
 
+    @action(methods=['get'], detail=False)
+    def check_affected(self, request, cart_pk):
+        serializer = CheckAffectedInCart(context=self.get_serializer_context())
+        data = serializer.save()
+
+        return Response({}, status=status.HTTP_404_NOT_FOUND) if data.get('not_found') else Response(data, status=status.HTTP_200_OK)
+
     @action(methods=['post'], detail=False)
     def get_allowed_interval(self, request, cart_pk):
         serializer = GetAllowedIntervalInCart(
@@ -0,0 +1,21 @@
+# Loaded by `gunicorn -c gunicorn.conf.py`, the web process in the Procfile.
+# Each worker logs its database connection metrics (api.db_connections) every
+# METRICS_EVERY requests and when it exits. Keep the default sync workers, a
+# persistent connection belongs to the thread that opened it.
+import os
+
+METRICS_EVERY = int(os.environ.get('DATABASE_METRICS_EVERY', 1000))
+
+
+def log_connections(worker):
+    from api import db_connections
+    worker.log.info('Worker %s database connections: %s', worker.pid, db_connections.summary())
+
+
+def post_request(worker, req, environ, resp):
+    if worker.nr % METRICS_EVERY == 0:
+        log_connections(worker)
+
+
+def worker_exit(server, worker):
+    log_connections(worker)